@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+AI旅行助手 - 聊天接口准入控制模块
+按用户和IP的令牌桶限流，以及所有worker合计的上游并发上限
+"""
+
+import fcntl
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from config import app_config
+
+logger = logging.getLogger(f'app.{__name__}')
+
+class AdmissionController:
+    """聊天接口准入控制 - 按user_id和IP的令牌桶限流，以及所有worker合计的上游并发上限
+    
+    令牌桶保存在本机SQLite文件中，各worker在 BEGIN IMMEDIATE 事务内读改写，进程内共用一个连接并由锁串行化
+    （gevent worker下threading.local按协程区分，按线程建连接会为每个请求新建连接）；
+    并发名额是一组槽位文件，持有其中一个的排他锁即占用一个名额，进程退出时锁由内核释放。
+    """
+    
+    PRUNE_EVERY = 1000  # 每取N次令牌清理一次已回满的桶
+    SLOT_POLL_INTERVAL = 0.2  # 后台轮次等待并发名额的轮询间隔（秒）
+    
+    def __init__(self, directory, user_burst, user_per_minute, ip_burst, ip_per_minute,
+                 max_concurrent, busy_retry_after, enabled=True):
+        self.directory = directory
+        self.user_limit = (user_burst, user_per_minute / 60)
+        self.ip_limit = (ip_burst, ip_per_minute / 60)
+        self.max_concurrent = max_concurrent
+        self.busy_retry_after = busy_retry_after
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._connection_pid = None
+        self._takes = 0
+    
+    def _connection(self):
+        # 调用方持有self._lock；sqlite3连接不能跨fork使用，进程ID变化时重建
+        if self._connection_pid != os.getpid():
+            os.makedirs(self.directory, exist_ok=True)
+            connection = sqlite3.connect(os.path.join(self.directory, 'buckets.db'), timeout=5,
+                                         isolation_level=None, check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=OFF')  # 限流状态丢失无害，不需要落盘
+            connection.execute('CREATE TABLE IF NOT EXISTS buckets '
+                               '(key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)')
+            self._shared_connection, self._connection_pid = connection, os.getpid()
+        return self._shared_connection
+    
+    def take(self, buckets):
+        """从每个令牌桶各取一个令牌，任一桶不足时都不扣减
+        buckets: [(key, 容量, 每秒补充的令牌数)]；返回需要等待的秒数，0表示放行"""
+        with self._lock:
+            return self._take(buckets)
+    
+    def _take(self, buckets):
+        now = time.time()
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            levels = []
+            wait = 0.0
+            for key, burst, rate in buckets:
+                row = connection.execute('SELECT tokens, updated FROM buckets WHERE key = ?', (key,)).fetchone()
+                tokens = burst if row is None else min(burst, row[0] + max(0.0, now - row[1]) * rate)
+                if tokens < 1:
+                    wait = max(wait, (1 - tokens) / rate)
+                levels.append((key, tokens - 1, now))
+            if not wait:
+                connection.executemany('INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)', levels)
+                self._takes += 1
+                if self._takes % self.PRUNE_EVERY == 0:
+                    # 超过回满所需时间未使用的桶与新桶等价，可以删除
+                    idle = max(burst / rate for _, burst, rate in buckets)
+                    connection.execute('DELETE FROM buckets WHERE updated < ?', (now - idle,))
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        return wait
+    
+    def acquire_slot(self):
+        """占用一个上游并发名额，返回持有锁的文件描述符；名额已满时返回None"""
+        os.makedirs(self.directory, exist_ok=True)
+        # 从不同位置开始尝试，减少各worker争抢同一个槽位
+        start = (os.getpid() + threading.get_ident()) % self.max_concurrent
+        for offset in range(self.max_concurrent):
+            path = os.path.join(self.directory, f'slot-{(start + offset) % self.max_concurrent}.lock')
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fd
+            except BlockingIOError:
+                os.close(fd)
+        return None
+    
+    def release_slot(self, fd):
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+    
+    def wait_for_slot(self):
+        """后台线程占用一个上游并发名额，名额已满时等待；未启用准入控制或不限并发时返回None"""
+        if not self.enabled or self.max_concurrent <= 0:
+            return None
+        while True:
+            slot = self.acquire_slot()
+            if slot is not None:
+                return slot
+            time.sleep(self.SLOT_POLL_INTERVAL)
+    
+    def admit(self, user_id, ip):
+        """检查并发名额和限流，返回 (槽位, None) 或 (None, (错误码, 建议重试秒数))"""
+        slot = self.acquire_slot() if self.max_concurrent > 0 else None
+        if self.max_concurrent > 0 and slot is None:
+            return None, ('SERVER_BUSY', self.busy_retry_after)
+        
+        buckets = [(f'{kind}:{key}', burst, rate)
+                   for kind, key, (burst, rate) in (('user', user_id, self.user_limit), ('ip', ip, self.ip_limit))
+                   if burst > 0 and rate > 0]
+        try:
+            wait = self.take(buckets) if buckets else 0
+        except sqlite3.Error as e:
+            # 限流存储不可用时放行，只保留并发上限
+            logger.warning(f'⚠️ 限流状态读写失败，本次请求不限流: {str(e)}')
+            wait = 0
+        if wait:
+            if slot is not None:
+                self.release_slot(slot)
+            return None, ('TOO_MANY_REQUESTS', wait)
+        return slot, None
+
+admission = AdmissionController(
+    app_config.RATE_LIMIT_DIRECTORY,
+    app_config.RATE_LIMIT_USER_BURST,
+    app_config.RATE_LIMIT_USER_PER_MINUTE,
+    app_config.RATE_LIMIT_IP_BURST,
+    app_config.RATE_LIMIT_IP_PER_MINUTE,
+    app_config.CHAT_MAX_CONCURRENT,
+    app_config.CHAT_BUSY_RETRY_AFTER,
+    enabled=app_config.RATE_LIMIT_ENABLED
+)
@@ -5,47 +5,66 @@ AI旅行助手 - Flask API后端服务
 为React前端提供API接口，集成Dify AI服务
 """
 
+import gc
+import hashlib
+import heapq
+import html
+import json
 import logging
-import requests
+import math
+import os
 import re
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
-from flask import Flask, request, jsonify
-from flask_sqlalchemy import SQLAlchemy
+from functools import wraps
+from flask import Blueprint, Flask, Response, current_app, has_app_context, request, jsonify, make_response, stream_with_context
 from flask_cors import CORS
 from logging.handlers import RotatingFileHandler
+from sqlalchemy import Text, case, create_engine, delete, event, func, insert, inspect, or_, select, text, update
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import DisconnectionError
+from werkzeug.http import is_resource_modified
+import click
 import pytz
 
 # 导入配置管理模块
-from config import app_config, dify_config, nav_config, log_config, validate_all_configs
+from config import app_config, dify_config, nav_config, log_config, shard_binds, shard_database_path, validate_all_configs
+from content_codec import content_codec, sqlite_content_text, train_dictionary
+from text_cleaning import clean_ai_text
+# 数据模型和各后台子系统，这些模块都不导入app
+from models import (MESSAGE_LIST_COLUMNS, Attraction, Conversation, ConversationArchive, ConversationEvent,
+                    IdempotencyKey, Message, db, display_timezone, new_conversation, serialize_message_rows)
+from sharding import (conversation_id_sequence, current_shard, each_shard, group_by_shard, shard_catalog, shard_count,
+                      shard_for, shard_keys, use_shard)
+from upstream_scheduler import UpstreamDropped, UpstreamScheduler
+from archive import ArchiveWorker, bulk_insert, delete_conversations, restore_conversation, archive_cold_conversations
+from write_behind import write_behind
+from admission import admission
+from idempotency import idempotency
+from conversation_locks import conversation_locks
+from turn_pipeline import TurnPipeline
+from conversation_events import event_broker
 
 # 验证配置
 if not validate_all_configs():
     print("❌ 配置验证失败，应用无法启动")
     exit(1)
 
-# 创建Flask应用
-app = Flask(__name__)
-
-# 应用配置 - 使用统一配置管理
-app.config['SECRET_KEY'] = app_config.SECRET_KEY
-app.config['SQLALCHEMY_DATABASE_URI'] = app_config.SQLALCHEMY_DATABASE_URI
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = app_config.SQLALCHEMY_TRACK_MODIFICATIONS
-app.config['SQLALCHEMY_ENGINE_OPTIONS'] = app_config.SQLALCHEMY_ENGINE_OPTIONS
-
-# 配置CORS - 使用统一配置管理
-CORS(app, origins=app_config.CORS_ORIGINS)
-
-# 创建目录
-import os
-os.makedirs('database', exist_ok=True)
-os.makedirs(app_config.LOG_DIRECTORY, exist_ok=True)
-
-# 初始化数据库
-db = SQLAlchemy(app)
+def owning_app():
+    """后台任务所属的应用：在应用上下文中为当前应用（包括create_app创建的测试应用），
+    否则（gunicorn worker启动后台任务时）为模块级应用"""
+    return current_app._get_current_object() if has_app_context() else app
 
 # 配置日志 - 使用统一配置管理
 def setup_logging():
-    """配置日志系统"""
+    """配置日志系统（直接运行和gunicorn worker启动时调用，重复调用不会重复添加处理器）
+    各子系统模块的日志记录器名为 app.<模块名>，向上传递到这里的处理器"""
+    if any(isinstance(handler, RotatingFileHandler) for handler in app.logger.handlers):
+        return
     log_level = getattr(logging, app_config.LOG_LEVEL)
     
     formatter = logging.Formatter(
@@ -74,52 +93,108 @@ def setup_logging():
     app.logger.addHandler(console_handler)
     app.logger.setLevel(log_level)
 
-# 数据库模型
-class Conversation(db.Model):
-    """对话会话模型"""
-    __tablename__ = 'conversations'
-    
-    id = db.Column(db.Integer, primary_key=True)
-    title = db.Column(db.String(255), nullable=False)
-    dify_conversation_id = db.Column(db.String(255), nullable=True)  # 存储Dify的对话ID
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+@event.listens_for(Engine, 'connect')
+def register_sqlite_functions(dbapi_connection, connection_record):
+    """为SQLite连接注册content_text()，在SQL中读取压缩消息的明文"""
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.create_function('content_text', 1, sqlite_content_text, deterministic=True)
+
+def record_checkin_time(dbapi_connection, connection_record):
+    connection_record.info['checked_in_at'] = time.monotonic()
+
+def check_idle_connection(dbapi_connection, connection_record, connection_proxy):
+    """代替pool_pre_ping：只对空闲超过 DB_LIVENESS_IDLE_SECONDS 的服务端连接检测一次存活，
+    刚归还的连接直接使用；检测失败时连接池丢弃该连接并重新建立，请求不会因此失败"""
+    checked_in_at = connection_record.info.get('checked_in_at')
+    if checked_in_at is None or time.monotonic() - checked_in_at < app_config.DB_LIVENESS_IDLE_SECONDS:
+        return
+    try:
+        cursor = dbapi_connection.cursor()
+        cursor.execute('SELECT 1')
+        cursor.close()
+    except Exception as e:
+        raise DisconnectionError(f'空闲连接已断开: {str(e)}')
+
+def watch_idle_connections(engine):
+    """只在PostgreSQL引擎自己的连接池上注册空闲连接检测（engine.dispose()重建的连接池沿用这些监听器）"""
+    event.listen(engine.pool, 'checkin', record_checkin_time)
+    event.listen(engine.pool, 'checkout', check_idle_connection)
+
+# 全文检索索引 - SQLite FTS5外部内容表，trigram分词支持中文子串检索
+# 消息内容可能压缩存储，索引通过解压视图读取明文
+SEARCH_INDEX_DDL = [
+    """CREATE VIEW IF NOT EXISTS messages_fts_source AS
+        SELECT id, content_text(content) AS content FROM messages""",
+    """CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+        content, content='messages_fts_source', content_rowid='id', tokenize='trigram')""",
+    """CREATE VIRTUAL TABLE IF NOT EXISTS conversations_fts USING fts5(
+        title, content='conversations', content_rowid='id', tokenize='trigram')""",
+    """CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts(rowid, content) VALUES (new.id, content_text(new.content));
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS messages_fts_ad AFTER DELETE ON messages BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, content_text(old.content));
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS messages_fts_au AFTER UPDATE OF content ON messages BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, content_text(old.content));
+        INSERT INTO messages_fts(rowid, content) VALUES (new.id, content_text(new.content));
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS conversations_fts_ai AFTER INSERT ON conversations BEGIN
+        INSERT INTO conversations_fts(rowid, title) VALUES (new.id, new.title);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS conversations_fts_ad AFTER DELETE ON conversations BEGIN
+        INSERT INTO conversations_fts(conversations_fts, rowid, title) VALUES ('delete', old.id, old.title);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS conversations_fts_au AFTER UPDATE OF title ON conversations BEGIN
+        INSERT INTO conversations_fts(conversations_fts, rowid, title) VALUES ('delete', old.id, old.title);
+        INSERT INTO conversations_fts(rowid, title) VALUES (new.id, new.title);
+    END""",
+]
+
+SEARCH_INDEX_TABLES = ['messages_fts', 'conversations_fts']
+
+@event.listens_for(db.metadata, 'after_create')
+def create_search_index(target, connection, **kw):
+    """create_all之后建立FTS5索引和同步触发器，已有数据首次建索引时全量重建"""
+    if connection.dialect.name != 'sqlite':
+        return
     
-    messages = db.relationship('Message', backref='conversation', lazy=True, cascade='all, delete-orphan')
+    existing = {row.name: row.sql for row in connection.execute(
+        text("SELECT name, sql FROM sqlite_master WHERE type = 'table' AND name IN ('messages_fts', 'conversations_fts')"))}
     
-    def to_dict(self):
-        beijing_tz = pytz.timezone(os.getenv('TIMEZONE', 'Asia/Shanghai'))
-        created_beijing = self.created_at.replace(tzinfo=pytz.UTC).astimezone(beijing_tz)
-        
-        return {
-            'id': self.id,
-            'title': self.title,
-            'dify_conversation_id': self.dify_conversation_id,
-            'created_at': created_beijing.strftime('%Y-%m-%d %H:%M:%S'),
-            'message_count': len(self.messages)
-        }
-
-class Message(db.Model):
-    """聊天消息模型"""
-    __tablename__ = 'messages'
+    # 早期版本的消息索引直接读取messages.content，需改为读取解压视图后重建
+    if 'messages_fts' in existing and 'messages_fts_source' not in existing['messages_fts']:
+        for trigger in ('messages_fts_ai', 'messages_fts_ad', 'messages_fts_au'):
+            connection.execute(text(f'DROP TRIGGER IF EXISTS {trigger}'))
+        connection.execute(text('DROP TABLE messages_fts'))
+        del existing['messages_fts']
     
-    id = db.Column(db.Integer, primary_key=True)
-    conversation_id = db.Column(db.Integer, db.ForeignKey('conversations.id'), nullable=False)
-    content = db.Column(db.Text, nullable=False)
-    sender_type = db.Column(db.String(10), nullable=False)  # 'user' or 'ai'
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    try:
+        for ddl in SEARCH_INDEX_DDL:
+            connection.execute(text(ddl))
+    except Exception as e:
+        # SQLite未编译FTS5时搜索接口回退为LIKE查询
+        app.logger.warning(f'⚠️ 全文检索索引创建失败，搜索将使用LIKE查询: {str(e)}')
+        return
     
-    def to_dict(self):
-        beijing_tz = pytz.timezone(os.getenv('TIMEZONE', 'Asia/Shanghai'))
-        created_beijing = self.created_at.replace(tzinfo=pytz.UTC).astimezone(beijing_tz)
-        
-        return {
-            'id': self.id,
-            'content': self.content,
-            'sender_type': self.sender_type,
-            'created_at': created_beijing.strftime('%H:%M:%S'),
-            'timestamp': created_beijing.isoformat()
-        }
+    for table in SEARCH_INDEX_TABLES:
+        if table not in existing:
+            connection.execute(text(f"INSERT INTO {table}({table}) VALUES ('rebuild')"))
+
+@event.listens_for(db.metadata, 'before_drop')
+def drop_search_index(target, connection, **kw):
+    """drop_all之前删除FTS5索引（触发器随基础表一起删除）"""
+    if connection.dialect.name != 'sqlite':
+        return
+    for table in SEARCH_INDEX_TABLES:
+        connection.execute(text(f'DROP TABLE IF EXISTS {table}'))
+    connection.execute(text('DROP VIEW IF EXISTS messages_fts_source'))
+
+# 按数字编号分割AI回复（如：1. 八达岭长城）
+# 景点提取的正则都只从空白串或分句的起点开始匹配，匹配结果与逐位置尝试相同，但保证线性时间
+NUMBERED_SECTION_SPLIT = re.compile(r'(?<!\s)[^\S\n]*\n\s*\d+\.\s*')
+# 文本末尾尚未完整的编号分割标记（流式提取时等待后续文本）
+NUMBERED_SECTION_PREFIX = re.compile(r'(?<!\s)[^\S\n]*(?:\n\s*(?:\d+(?:\.\s*)?)?)?\Z')
 
 # Dify API服务 - 使用统一配置管理
 class DifyService:
@@ -131,11 +206,32 @@ class DifyService:
         self.api_key = dify_config.API_KEY
         self.timeout = dify_config.TIMEOUT
         self.max_retries = dify_config.MAX_RETRIES
-        
-        # 配置验证在应用启动时已完成
-        app.logger.info(f'🤖 初始化Dify服务: {self.api_url}')
+        self.scheduler = UpstreamScheduler(dify_config.MAX_CONCURRENT, dify_config.SCHEDULER_POLL_INTERVAL)
+        self.connection_status = {'checked': False, 'success': None, 'message': '尚未检测'}
+        self._session = None
+        self._session_pid = None
     
-    def send_message(self, message, conversation_id=None, user_id=None):
+    @property
+    def session(self):
+        """HTTP连接池 - 首次调用Dify时创建，fork出的子进程不复用父进程的连接"""
+        if self._session is None or self._session_pid != os.getpid():
+            import requests  # 延迟导入，缩短冷启动时间
+            from requests.adapters import HTTPAdapter
+            
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=dify_config.HTTP_POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self._session, self._session_pid = session, os.getpid()
+        return self._session
+    
+    def _request_timeout(self, deadline):
+        """单次HTTP请求的超时时间，不超过调用截止时间"""
+        if deadline is None:
+            return self.timeout
+        return max(0.1, min(self.timeout, deadline - time.monotonic()))
+    
+    def send_message(self, message, conversation_id=None, user_id=None, deadline=None, cancelled=None):
         """
         发送消息到Dify API - 使用统一配置管理
         
@@ -143,10 +239,14 @@ class DifyService:
             message: 用户输入的消息
             conversation_id: 对话ID，如果为None则开始新对话
             user_id: 用户标识符
-            
+            deadline: 调用截止时间（time.monotonic()），排队超过时不再调用Dify
+            cancelled: 返回True表示客户端已断开，排队期间定期检查
+        
         Returns:
             dict: 包含success状态和响应数据的字典
         """
+        import requests
+        
         try:
             if not self.api_key:
                 return {
@@ -170,15 +270,22 @@ class DifyService:
             else:
                 app.logger.info(f'🆕 开始新对话: {message[:50]}...')
             
+            # 继续对话优先于新对话获得上游名额
+            priority = UpstreamScheduler.PRIORITY_CONTINUING if conversation_id else UpstreamScheduler.PRIORITY_NEW
+            ticket = self.scheduler.acquire(priority, deadline, cancelled)
+            
             app.logger.info(f'🤖 调用Dify API: {dify_config.CHAT_MESSAGES_ENDPOINT}')
             
             # 发送请求到Dify API - 使用配置的端点和超时时间
-            response = requests.post(
-                dify_config.CHAT_MESSAGES_ENDPOINT,
-                headers=headers,
-                json=data,
-                timeout=self.timeout
-            )
+            try:
+                response = self.session.post(
+                    dify_config.CHAT_MESSAGES_ENDPOINT,
+                    headers=headers,
+                    json=data,
+                    timeout=self._request_timeout(deadline)
+                )
+            finally:
+                self.scheduler.release(ticket)
             
             app.logger.info(f'📡 Dify API响应状态: {response.status_code}')
             
@@ -205,22 +312,19 @@ class DifyService:
                 app.logger.error(f'   - 状态码: {response.status_code}')
                 app.logger.error(f'   - 错误内容: {error_text}')
                 
-                # 使用统一配置的错误消息
-                if response.status_code == 401:
-                    error_msg = dify_config.ERROR_MESSAGES['API_KEY_INVALID']
-                elif response.status_code == 429:
-                    error_msg = dify_config.ERROR_MESSAGES['RATE_LIMIT']
-                elif response.status_code == 500:
-                    error_msg = dify_config.ERROR_MESSAGES['SERVER_ERROR']
-                else:
-                    error_msg = f'API调用失败 (状态码: {response.status_code})'
-                
                 return {
                     'success': False,
-                    'error': error_msg,
+                    'error': self._status_error(response.status_code),
                     'details': error_text
                 }
-                
+        
+        except UpstreamDropped as e:
+            app.logger.warning(f'⏳ 丢弃排队中的Dify调用 ({e})')
+            return {
+                'success': False,
+                'error': dify_config.ERROR_MESSAGES['DEADLINE_EXCEEDED'],
+                'code': 'DEADLINE_EXCEEDED'
+            }
         except requests.exceptions.Timeout:
             app.logger.error('⏰ Dify API调用超时')
             return {
@@ -240,6 +344,89 @@ class DifyService:
             # 使用本地模拟回复功能
             return self._get_local_mock_response(message, conversation_id)
     
+    def stream_message(self, message, conversation_id=None, user_id=None, deadline=None):
+        """
+        以streaming模式调用Dify API，逐段产出回复
+        
+        Yields:
+            dict: {'event': 'message', 'answer': 文本片段, 'conversation_id': Dify对话ID}，
+                  正常结束时产出 {'event': 'message_end', ...}，失败时产出 {'event': 'error', 'error': 错误信息}；
+                  排队等待上游名额期间每 SCHEDULER_POLL_INTERVAL 秒产出 {'event': 'queued'}，
+                  调用方写出心跳时发现客户端断开会关闭生成器，排队随之取消
+        """
+        import requests
+        
+        if not self.api_key:
+            yield {'event': 'error', 'error': dify_config.ERROR_MESSAGES['NO_API_KEY']}
+            return
+        
+        data = dify_config.build_chat_request(
+            message=message,
+            conversation_id=conversation_id,
+            user_id=user_id or dify_config.DEFAULT_USER_ID,
+            response_mode=dify_config.RESPONSE_MODE_STREAMING
+        )
+        priority = UpstreamScheduler.PRIORITY_CONTINUING if conversation_id else UpstreamScheduler.PRIORITY_NEW
+        ticket = self.scheduler.enqueue(priority, deadline)
+        try:
+            while not self.scheduler.wait(ticket, self.scheduler.poll_interval):
+                yield {'event': 'queued'}
+        except UpstreamDropped as e:
+            app.logger.warning(f'⏳ 丢弃排队中的Dify流式调用 ({e})')
+            yield {'event': 'error', 'error': dify_config.ERROR_MESSAGES['DEADLINE_EXCEEDED'], 'code': 'DEADLINE_EXCEEDED'}
+            return
+        finally:
+            if not ticket.granted:
+                self.scheduler.release(ticket)
+        app.logger.info(f'🤖 流式调用Dify API: {message[:50]}...')
+        
+        try:
+            with self.session.post(dify_config.CHAT_MESSAGES_ENDPOINT, headers=dify_config.get_headers(),
+                                   json=data, timeout=self._request_timeout(deadline), stream=True) as response:
+                if response.status_code != 200:
+                    app.logger.error(f'❌ Dify流式调用失败: {response.status_code} {response.text}')
+                    yield {'event': 'error', 'error': self._status_error(response.status_code)}
+                    return
+                
+                # Server-Sent Events: 每个事件一行 "data: {json}"
+                for line in response.iter_lines():
+                    if not line.startswith(b'data:'):
+                        continue
+                    event = json.loads(line[5:].decode('utf-8'))
+                    name = event.get('event')
+                    if name in ('message', 'agent_message'):
+                        yield {'event': 'message', 'answer': event.get('answer', ''),
+                               'conversation_id': event.get('conversation_id', '')}
+                    elif name == 'message_end':
+                        yield {'event': 'message_end', 'conversation_id': event.get('conversation_id', '')}
+                        return
+                    elif name == 'error':
+                        yield {'event': 'error', 'error': event.get('message') or dify_config.ERROR_MESSAGES['SERVER_ERROR']}
+                        return
+                
+                yield {'event': 'error', 'error': '流式响应意外结束'}
+        
+        except requests.exceptions.Timeout:
+            app.logger.error('⏰ Dify流式调用超时')
+            yield {'event': 'error', 'error': dify_config.ERROR_MESSAGES['TIMEOUT']}
+        except requests.exceptions.RequestException as e:
+            app.logger.error(f'📡 网络请求异常: {str(e)}，使用本地模拟回复')
+            mock = self._get_local_mock_response(message, conversation_id)['data']
+            yield {'event': 'message', 'answer': mock['answer'], 'conversation_id': mock['conversation_id']}
+            yield {'event': 'message_end', 'conversation_id': mock['conversation_id']}
+        finally:
+            self.scheduler.release(ticket)
+    
+    def _status_error(self, status_code):
+        """根据Dify响应状态码返回统一配置的错误消息"""
+        if status_code == 401:
+            return dify_config.ERROR_MESSAGES['API_KEY_INVALID']
+        if status_code == 429:
+            return dify_config.ERROR_MESSAGES['RATE_LIMIT']
+        if status_code == 500:
+            return dify_config.ERROR_MESSAGES['SERVER_ERROR']
+        return f'API调用失败 (状态码: {status_code})'
+    
     def _get_local_mock_response(self, message, conversation_id=None):
         """
         本地模拟AI回复功能 - 当Dify不可用时提供智能回复
@@ -312,8 +499,14 @@ class DifyService:
         app.logger.info(f'📝 文本预览: {text[:200]}...')
         
         
+        # 超长回复只解析开头部分，避免单条异常回复占满工作进程
+        if len(text) > dify_config.EXTRACTION_MAX_CHARS:
+            app.logger.warning(f'⚠️ AI文本过长（{len(text)}字符），只解析前 {dify_config.EXTRACTION_MAX_CHARS} 个字符')
+            text = text[:dify_config.EXTRACTION_MAX_CHARS]
+        deadline = time.monotonic() + dify_config.EXTRACTION_TIME_BUDGET
+        
         # 先尝试按数字编号分割（如：1. 八达岭长城）
-        numbered_sections = re.split(r'\n\s*\d+\.\s*', text)
+        numbered_sections = NUMBERED_SECTION_SPLIT.split(text)
         
         # 如果没有数字编号，按段落分割
         if len(numbered_sections) <= 2:
@@ -322,137 +515,17 @@ class DifyService:
         app.logger.info(f'📝 分割成 {len(numbered_sections)} 个段落')
         
         for i, section in enumerate(numbered_sections):
-            section = section.strip()
-            if len(section) < 5:  # 跳过太短的段落
-                continue
-                
-            app.logger.info(f'📝 处理段落 {i}: {section[:100]}...')
-            
-            # 提取地点名称 - 增加智能过滤
-            attraction_name = None
-            
-            # 方法1: 查找段落开头的地点名称
-            first_line = section.split('\n')[0].strip()
-            if len(first_line) > 0 and len(first_line) < 50:
-                # 清理可能的序号 - 更彻底的清理
-                clean_name = re.sub(r'^\d+[\.\。、]\s*', '', first_line)  # 数字+点/句号/顿号
-                clean_name = re.sub(r'^[•·\-\*]\s*', '', clean_name)     # 符号
-                clean_name = re.sub(r'^[一二三四五六七八九十]\s*[\.\。、]\s*', '', clean_name)  # 中文数字
-                clean_name = clean_name.strip()  # 确保去掉多余空格
-                
-                if len(clean_name) > 1:
-                    # 过滤掉明显不是地点的内容
-                    invalid_patterns = [
-                        # 行程规划类
-                        r'(行程|规划|总结|建议|推荐|注意|提醒|小贴士|攻略)',
-                        # 时间类
-                        r'(第\d+天|上午|下午|晚上|早上|中午|时间|安排)',
-                        # 交通类描述
-                        r'(交通|路线|导航|距离|车程|步行|地铁|公交)',
-                        # 费用类
-                        r'(费用|价格|门票|花费|预算|成本)',
-                        # 其他非地点内容
-                        r'(总体|整体|概述|介绍|说明|详情|特色|亮点)',
-                        r'^(如何|怎么|为什么|什么|哪里|当地)',
-                        # 问候语和结束语
-                        r'^(希望|祝您|欢迎|感谢|如果|需要)'
-                    ]
-                    
-                    # 检查是否匹配无效模式
-                    is_invalid = any(re.search(pattern, clean_name, re.IGNORECASE) for pattern in invalid_patterns)
-                    
-                    if not is_invalid:
-                        # 检查是否包含地点关键词
-                        location_keywords = [
-                            '景区', '景点', '公园', '广场', '寺庙', '教堂', '博物馆', '纪念馆',
-                            '古城', '古镇', '老街', '步行街', '商业街', '购物中心',
-                            '山', '湖', '河', '海', '岛', '峡', '谷', '洞', '泉',
-                            '长城', '故宫', '天安门', '颐和园', '天坛', '圆明园',
-                            '大厦', '中心', '塔', '桥', '门', '城', '府', '院',
-                            '村', '镇', '县', '区', '路', '街', '巷'
-                        ]
-                        
-                        has_location_keyword = any(keyword in clean_name for keyword in location_keywords)
-                        
-                        # 只有包含地点关键词的才被认为是有效地点
-                        if has_location_keyword:
-                            attraction_name = clean_name
-            
-            # 方法2: 查找包含景点关键词的名称
-            if not attraction_name:
-                attraction_patterns = [
-                    r'([^，,。.！!？?；;：:\n]{2,}(?:长城|山|湖|河|海|岛|公园|寺|庙|塔|景区|风景区))',
-                    r'([^，,。.！!？?；;：:\n]{2,}(?:博物馆|纪念馆|展览馆|文化宫|体育馆|图书馆))',
-                    r'([^，,。.！!？?；;：:\n]{2,}(?:广场|中心|大厦|大楼|桥|古城|古镇))'
-                ]
-                
-                for pattern in attraction_patterns:
-                    matches = re.findall(pattern, section)
-                    if matches:
-                        attraction_name = matches[0].strip()
-                        break
+            if time.monotonic() >= deadline:
+                app.logger.warning(f'⚠️ 景点提取超出时间预算 {dify_config.EXTRACTION_TIME_BUDGET}s，'
+                                   f'已处理 {i}/{len(numbered_sections)} 个段落，返回已提取的景点')
+                break
             
-            if not attraction_name or len(attraction_name) < 2:
-                app.logger.info(f'📝 段落 {i} 未找到有效地点名称或被过滤')
+            attraction_data = self.parse_section(i, section, len(attractions))
+            if not attraction_data:
                 continue
-                
-            app.logger.info(f'📝 提取到地点名称: {attraction_name}')
-                
-            # 提取经纬度信息
-            coordinates = None
-            coord_patterns = [
-                r'经纬度[：:]\s*([0-9.]+)[,，]\s*([0-9.]+)',
-                r'坐标[：:]\s*([0-9.]+)[,，]\s*([0-9.]+)',
-                r'([0-9]+\.[0-9]+)[,，]\s*([0-9]+\.[0-9]+)'
-            ]
-            
-            for pattern in coord_patterns:
-                coord_match = re.search(pattern, section)
-                if coord_match:
-                    try:
-                        lat = float(coord_match.group(1))
-                        lng = float(coord_match.group(2))
-                        # 验证经纬度范围
-                        if -90 <= lat <= 90 and -180 <= lng <= 180:
-                            coordinates = {'lat': lat, 'lng': lng}
-                            app.logger.info(f'📝 提取到经纬度: {lat}, {lng}')
-                            break
-                    except ValueError:
-                        continue
-            
-            # 提取地址信息
-            address = f'{attraction_name}'  # 默认使用地点名称
-            address_patterns = [
-                r'地址[：:]\s*([^，,。.！!？?；;：:\n]+)',
-                r'位于\s*([^，,。.！!？?；;：:\n]+)',
-                r'坐落在\s*([^，,。.！!？?；;：:\n]+)',
-                r'([^，,。.！!？?；;：:\n]*(?:省|市|区|县|镇|街道|路|街|巷|号)[^，,。.！!？?；;：:\n]*)'
-            ]
-            
-            for pattern in address_patterns:
-                match = re.search(pattern, section)
-                if match:
-                    found_address = match.group(1).strip()
-                    if 5 <= len(found_address) <= 100:  # 合理长度的地址
-                        address = found_address
-                        app.logger.info(f'📝 提取到地址: {address}')
-                        break
-            
-            # 创建景点对象
-            attraction_data = {
-                'id': f'attraction_{int(datetime.now().timestamp())}_{len(attractions)}',
-                'name': attraction_name,
-                'address': address,
-                'image': dify_config.DEFAULT_ATTRACTION_IMAGE,
-                'type': '景点'
-            }
-            
-            # 如果有经纬度信息，添加到景点数据中
-            if coordinates:
-                attraction_data['coordinates'] = coordinates
             
             attractions.append(attraction_data)
-            app.logger.info(f'📝 成功创建景点: {attraction_name}')
+            app.logger.info(f"📝 成功创建景点: {attraction_data['name']}")
             
             # 限制景点数量
             if len(attractions) >= dify_config.MAX_ATTRACTIONS_PER_RESPONSE:
@@ -465,54 +538,537 @@ class DifyService:
         
         return attractions
     
-    def test_connection(self):
+    def parse_section(self, index, section, position):
+        """
+        解析单个段落中的景点名称、地址和经纬度
+        
+        Args:
+            index: 段落序号（用于日志）
+            section: 段落文本
+            position: 该景点在本条回复中的序号
+        
+        Returns:
+            dict: 景点信息，段落中没有有效地点时返回None
+        """
+        section = section.strip()
+        if len(section) < 5:  # 跳过太短的段落
+            return None
+        
+        app.logger.info(f'📝 处理段落 {index}: {section[:100]}...')
+        
+        # 提取地点名称 - 增加智能过滤
+        attraction_name = None
+        
+        # 方法1: 查找段落开头的地点名称
+        first_line = section.split('\n')[0].strip()
+        if len(first_line) > 0 and len(first_line) < 50:
+            # 清理可能的序号 - 更彻底的清理
+            clean_name = re.sub(r'^\d+[\.\。、]\s*', '', first_line)  # 数字+点/句号/顿号
+            clean_name = re.sub(r'^[•·\-\*]\s*', '', clean_name)     # 符号
+            clean_name = re.sub(r'^[一二三四五六七八九十]\s*[\.\。、]\s*', '', clean_name)  # 中文数字
+            clean_name = clean_name.strip()  # 确保去掉多余空格
+            
+            if len(clean_name) > 1:
+                # 过滤掉明显不是地点的内容
+                invalid_patterns = [
+                    # 行程规划类
+                    r'(行程|规划|总结|建议|推荐|注意|提醒|小贴士|攻略)',
+                    # 时间类
+                    r'(第\d+天|上午|下午|晚上|早上|中午|时间|安排)',
+                    # 交通类描述
+                    r'(交通|路线|导航|距离|车程|步行|地铁|公交)',
+                    # 费用类
+                    r'(费用|价格|门票|花费|预算|成本)',
+                    # 其他非地点内容
+                    r'(总体|整体|概述|介绍|说明|详情|特色|亮点)',
+                    r'^(如何|怎么|为什么|什么|哪里|当地)',
+                    # 问候语和结束语
+                    r'^(希望|祝您|欢迎|感谢|如果|需要)'
+                ]
+                
+                # 检查是否匹配无效模式
+                is_invalid = any(re.search(pattern, clean_name, re.IGNORECASE) for pattern in invalid_patterns)
+                
+                if not is_invalid:
+                    # 检查是否包含地点关键词
+                    location_keywords = [
+                        '景区', '景点', '公园', '广场', '寺庙', '教堂', '博物馆', '纪念馆',
+                        '古城', '古镇', '老街', '步行街', '商业街', '购物中心',
+                        '山', '湖', '河', '海', '岛', '峡', '谷', '洞', '泉',
+                        '长城', '故宫', '天安门', '颐和园', '天坛', '圆明园',
+                        '大厦', '中心', '塔', '桥', '门', '城', '府', '院',
+                        '村', '镇', '县', '区', '路', '街', '巷'
+                    ]
+                    
+                    has_location_keyword = any(keyword in clean_name for keyword in location_keywords)
+                    
+                    # 只有包含地点关键词的才被认为是有效地点
+                    if has_location_keyword:
+                        attraction_name = clean_name
+        
+        # 方法2: 查找包含景点关键词的名称
+        if not attraction_name:
+            attraction_patterns = [
+                r'(?<![^，,。.！!？?；;：:\n])([^，,。.！!？?；;：:\n]{2,}(?:长城|山|湖|河|海|岛|公园|寺|庙|塔|景区|风景区))',
+                r'(?<![^，,。.！!？?；;：:\n])([^，,。.！!？?；;：:\n]{2,}(?:博物馆|纪念馆|展览馆|文化宫|体育馆|图书馆))',
+                r'(?<![^，,。.！!？?；;：:\n])([^，,。.！!？?；;：:\n]{2,}(?:广场|中心|大厦|大楼|桥|古城|古镇))'
+            ]
+            
+            for pattern in attraction_patterns:
+                matches = re.findall(pattern, section)
+                if matches:
+                    attraction_name = matches[0].strip()
+                    break
+        
+        if not attraction_name or len(attraction_name) < 2:
+            app.logger.info(f'📝 段落 {index} 未找到有效地点名称或被过滤')
+            return None
+        
+        app.logger.info(f'📝 提取到地点名称: {attraction_name}')
+        
+        # 提取经纬度信息
+        coordinates = None
+        coord_patterns = [
+            r'经纬度[：:]\s*([0-9.]+)[,，]\s*([0-9.]+)',
+            r'坐标[：:]\s*([0-9.]+)[,，]\s*([0-9.]+)',
+            r'(?<![0-9])([0-9]+\.[0-9]+)[,，]\s*([0-9]+\.[0-9]+)'
+        ]
+        
+        for pattern in coord_patterns:
+            coord_match = re.search(pattern, section)
+            if coord_match:
+                try:
+                    lat = float(coord_match.group(1))
+                    lng = float(coord_match.group(2))
+                    # 验证经纬度范围
+                    if -90 <= lat <= 90 and -180 <= lng <= 180:
+                        coordinates = {'lat': lat, 'lng': lng}
+                        app.logger.info(f'📝 提取到经纬度: {lat}, {lng}')
+                        break
+                except ValueError:
+                    continue
+        
+        # 提取地址信息
+        address = f'{attraction_name}'  # 默认使用地点名称
+        address_patterns = [
+            r'地址[：:]\s*([^，,。.！!？?；;：:\n]+)',
+            r'位于\s*([^，,。.！!？?；;：:\n]+)',
+            r'坐落在\s*([^，,。.！!？?；;：:\n]+)',
+            r'(?<![^，,。.！!？?；;：:\n])([^，,。.！!？?；;：:\n]*(?:省|市|区|县|镇|街道|路|街|巷|号)[^，,。.！!？?；;：:\n]*)'
+        ]
+        
+        for pattern in address_patterns:
+            match = re.search(pattern, section)
+            if match:
+                found_address = match.group(1).strip()
+                if 5 <= len(found_address) <= 100:  # 合理长度的地址
+                    address = found_address
+                    app.logger.info(f'📝 提取到地址: {address}')
+                    break
+        
+        # 创建景点对象
+        attraction_data = {
+            'id': f'attraction_{int(datetime.now().timestamp())}_{position}',
+            'name': attraction_name,
+            'address': address,
+            'image': dify_config.DEFAULT_ATTRACTION_IMAGE,
+            'type': '景点'
+        }
+        
+        # 如果有经纬度信息，添加到景点数据中
+        if coordinates:
+            attraction_data['coordinates'] = coordinates
+        
+        return attraction_data
+    
+    def test_connection(self, timeout=None):
         """
-        测试Dify API连接 - 使用统一配置管理
+        测试Dify API连接 - 请求应用参数接口，不发送对话消息、不消耗额度
         
         Returns:
             dict: 测试结果
         """
-        try:
-            result = self.send_message('测试连接', user_id=dify_config.TEST_USER_ID)
-            if result['success']:
-                return {
-                    'success': True,
-                    'message': dify_config.SUCCESS_MESSAGES['CONNECTION_OK']
+        import requests
+        
+        if not self.api_key:
+            result = {
+                'success': False,
+                'message': dify_config.ERROR_MESSAGES['NO_API_KEY']
+            }
+        else:
+            timeout = timeout or dify_config.PROBE_TIMEOUT
+            try:
+                # 健康探测排在所有对话之前，排队时间计入探测超时
+                deadline = time.monotonic() + timeout
+                ticket = self.scheduler.acquire(UpstreamScheduler.PRIORITY_PROBE, deadline)
+                try:
+                    response = self.session.get(
+                        dify_config.PARAMETERS_ENDPOINT,
+                        headers=dify_config.get_headers(),
+                        timeout=self._request_timeout(deadline)
+                    )
+                finally:
+                    self.scheduler.release(ticket)
+                if response.status_code == 200:
+                    result = {
+                        'success': True,
+                        'message': dify_config.SUCCESS_MESSAGES['CONNECTION_OK']
+                    }
+                elif response.status_code == 401:
+                    result = {
+                        'success': False,
+                        'message': dify_config.ERROR_MESSAGES['API_KEY_INVALID']
+                    }
+                else:
+                    result = {
+                        'success': False,
+                        'message': f'Dify API连接失败 (状态码: {response.status_code})'
+                    }
+            except UpstreamDropped:
+                result = {
+                    'success': False,
+                    'message': f'连接测试排队超时（{timeout}秒内未获得上游名额）'
                 }
-            else:
-                return {
+            except requests.exceptions.RequestException as e:
+                result = {
                     'success': False,
-                    'message': f'Dify API连接失败: {result["error"]}'
+                    'message': f'连接测试异常: {str(e)}'
                 }
-        except Exception as e:
-            return {
-                'success': False,
-                'message': f'连接测试异常: {str(e)}'
-            }
+        
+        self.connection_status = {
+            'checked': True,
+            'success': result['success'],
+            'message': result['message'],
+            'checked_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        }
+        return result
+    
+    def start_connection_probe(self):
+        """在后台线程探测Dify连通性，不阻塞服务启动，同时预热连接池"""
+        def probe():
+            result = self.test_connection()
+            if result['success']:
+                app.logger.info(f'✅ {result["message"]}')
+            else:
+                app.logger.warning(f'⚠️ {result["message"]}')
+        
+        thread = threading.Thread(target=probe, name='dify-probe', daemon=True)
+        thread.start()
+        return thread
 
 # 初始化Dify服务
 dify_service = DifyService()
 
+class StreamingAttractionExtractor:
+    """
+    流式回复的增量景点提取 - 每个编号段落（按 NUMBERED_SECTION_SPLIT 分割）结束后立即解析并产出景点，
+    已结束的段落不再重复扫描，结果与对完整回复调用 extract_attractions 相同
+    """
+    
+    def __init__(self, service):
+        self.service = service
+        self.attractions = []
+        self._chunks = []        # 已接收的原文，回复没有编号分割时整段回退解析
+        self._length = 0
+        self._buffer = ''        # 尚未结束的段落
+        self._scan_from = 0      # _buffer中此位置之前不会再出现分割标记
+        self._pending_dot = False  # 末尾未完整的分割标记已包含编号后的点，此时数字也会使其结束
+        self._closed = []        # 确认按编号分割之前已结束的段落
+        self._sections = 0       # 已结束的段落数
+        self._parsed = 0         # 已解析的段落数，即下一个段落的序号
+        self._spent = 0.0        # 累计解析耗时，与 EXTRACTION_TIME_BUDGET 比较
+        self._stopped = False    # 达到数量上限或时间预算后不再解析
+    
+    def feed(self, chunk):
+        """追加一段回复文本，返回本段新提取的景点"""
+        chunk = chunk[:max(dify_config.EXTRACTION_MAX_CHARS - self._length, 0)]
+        if not chunk:
+            return []
+        self._chunks.append(chunk)
+        self._length += len(chunk)
+        self._buffer += chunk
+        # 纯空白只会延长末尾的分割标记，数字只有在编号的点之后才会使其结束
+        if chunk.isspace() or (chunk.isdecimal() and not self._pending_dot):
+            return []
+        return self._scan(final=False)
+    
+    def finish(self):
+        """回复结束，解析最后一个段落，返回本次新提取的景点"""
+        emitted = self._scan(final=True)
+        if self._sections < 2:
+            # 不足两个编号分割时extract_attractions改按空行分段，此前没有产出过景点
+            self.attractions = self.service.extract_attractions(''.join(self._chunks))
+            return list(self.attractions)
+        self._parse(self._buffer, emitted)
+        self._buffer = ''
+        app.logger.info(f'🏛️ 流式回复中提取到 {len(self.attractions)} 个景点信息')
+        return emitted
+    
+    def _scan(self, final):
+        """切出已结束的段落；末尾的匹配可能随后续文本延长（空白、更多数字），只在final时采用"""
+        emitted = []
+        while True:
+            match = NUMBERED_SECTION_SPLIT.search(self._buffer, self._scan_from)
+            if not match or (match.end() == len(self._buffer) and not final):
+                break
+            self._close(self._buffer[:match.start()], emitted)
+            self._buffer = self._buffer[match.end():]
+            self._scan_from = 0
+        
+        # 下次从末尾未完整的分割标记处继续扫描
+        prefix = NUMBERED_SECTION_PREFIX.search(self._buffer, self._scan_from)
+        self._scan_from = prefix.start()
+        self._pending_dot = '.' in prefix.group()
+        return emitted
+    
+    def _close(self, section, emitted):
+        self._sections += 1
+        if self._sections < 2:
+            self._closed.append(section)
+            return
+        for closed in self._closed:
+            self._parse(closed, emitted)
+        self._closed = []
+        self._parse(section, emitted)
+    
+    def _parse(self, section, emitted):
+        index = self._parsed
+        self._parsed += 1
+        if self._stopped:
+            return
+        if self._spent >= dify_config.EXTRACTION_TIME_BUDGET:
+            app.logger.warning(f'⚠️ 景点提取超出时间预算 {dify_config.EXTRACTION_TIME_BUDGET}s，返回已提取的景点')
+            self._stopped = True
+            return
+        
+        start = time.monotonic()
+        attraction = self.service.parse_section(index, section, len(self.attractions))
+        self._spent += time.monotonic() - start
+        if attraction:
+            self.attractions.append(attraction)
+            emitted.append(attraction)
+            if len(self.attractions) >= dify_config.MAX_ATTRACTIONS_PER_RESPONSE:
+                self._stopped = True
+
+def _extract_attractions_job(text):
+    """进程池任务入口 - 在子进程中执行景点提取"""
+    return dify_service.extract_attractions(text)
+
+class AttractionExtractionPool:
+    """景点提取后台进程池 - 有界排队，满载时由调用方回退为同步提取"""
+    
+    def __init__(self, max_workers, max_queue):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._slots = threading.BoundedSemaphore(max_queue) if max_queue > 0 else None
+        self._executor = None
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+    
+    def _get_executor(self):
+        # 延迟创建，保证进程池在gunicorn worker进程内生成
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+            return self._executor
+    
+    def reserve(self):
+        """预占一个排队位置，队列已满时返回False（背压）"""
+        return self._slots is not None and self._slots.acquire(blocking=False)
+    
+    def release(self):
+        """归还未使用的排队位置"""
+        self._slots.release()
+    
+    def submit(self, message_id, text, shard=None):
+        """提交已预占位置的提取任务，完成后在提交任务的应用中写回数据库（消息所在的分片）"""
+        flask_app = owning_app()
+        try:
+            future = self._get_executor().submit(_extract_attractions_job, text)
+        except Exception:
+            self.release()
+            raise
+        
+        with self._lock:
+            self._pending += 1
+        future.add_done_callback(lambda f: self._on_done(flask_app, message_id, shard, f))
+        return future
+    
+    def _on_done(self, flask_app, message_id, shard, future):
+        try:
+            with flask_app.app_context():
+                use_shard(shard)
+                try:
+                    extracted = future.result()
+                    rows = Attraction.build_rows(message_id, extracted)
+                    if rows:
+                        db.session.execute(insert(Attraction), rows)
+                    status = 'ready'
+                except Exception as e:
+                    flask_app.logger.error(f'💥 后台景点提取失败 (消息 {message_id}): {str(e)}')
+                    status = 'failed'
+                
+                Message.query.filter_by(id=message_id).update({'attractions_status': status})
+                conversation_id = db.session.query(Message.conversation_id).filter_by(id=message_id).scalar()
+                if conversation_id is not None:
+                    event_broker.record([(conversation_id, 'attractions', message_id)])
+                db.session.commit()
+                db.session.remove()
+                flask_app.logger.info(f'🏛️ 后台景点提取完成: 消息 {message_id}, 状态 {status}')
+        finally:
+            self.release()
+            with self._lock:
+                self._pending -= 1
+                self._idle.notify_all()
+    
+    def wait(self, timeout=None):
+        """等待当前所有后台任务完成并写回数据库"""
+        with self._lock:
+            return self._idle.wait_for(lambda: self._pending == 0, timeout=timeout)
+    
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+    
+    def reset(self):
+        """fork后在子进程内调用：父进程的进程池、排队计数和锁在子进程中均不可用"""
+        self._executor = None
+        self._pending = 0
+        self._slots = threading.BoundedSemaphore(self.max_queue) if self.max_queue > 0 else None
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+
+attraction_pool = AttractionExtractionPool(
+    dify_config.ATTRACTION_WORKER_PROCESSES,
+    dify_config.ATTRACTION_QUEUE_SIZE
+)
+
+def start_background_jobs(flask_app=None):
+    """启动进程内后台任务（直接运行或gunicorn worker启动后调用），任务使用flask_app（缺省为模块级应用）"""
+    flask_app = flask_app or owning_app()
+    if app_config.ARCHIVE_ENABLED:
+        worker = ArchiveWorker(
+            app_config.ARCHIVE_INTERVAL_SECONDS,
+            os.path.join('database', 'archive.lock'),
+            flask_app
+        )
+        worker.start()
+        app.logger.info('📦 后台归档任务已启动')
+    
+    if write_behind.enabled:
+        write_behind.start(flask_app)
+    
+    if conversation_locks.enabled:
+        turn_pipeline.resume_all(flask_app)
+    
+    if dify_config.STARTUP_CHECK == 'async':
+        dify_service.start_connection_probe()
+
 # API路由
-@app.route('/api/health', methods=['GET'])
+api = Blueprint('api', __name__, cli_group=None)
+
+@api.route('/api/health', methods=['GET'])
 def health_check():
     """健康检查"""
     return jsonify({
         'status': 'ok',
         'message': 'AI旅行助手API服务正常运行',
         'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-        'version': '1.0.0'
+        'version': '1.0.0',
+        'dify': dify_service.connection_status
+    })
+
+@api.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """当前worker进程的运行指标：上游调用排队深度、排队时间和丢弃次数"""
+    return jsonify({
+        'success': True,
+        'data': {
+            'pid': os.getpid(),
+            'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'upstream': dify_service.scheduler.metrics()
+        }
     })
 
-@app.route('/api/conversations', methods=['GET'])
+def _etag(*parts):
+    """由代表资源版本的聚合值生成ETag"""
+    return hashlib.sha1(json.dumps(parts, default=str).encode('utf-8')).hexdigest()[:24]
+
+def _conditional_response(etag, last_modified, build):
+    """
+    条件GET - 客户端带 If-None-Match 且ETag未变化时返回304，不再查询和序列化数据
+    
+    last_modified为数据库中的UTC时间（naive），可以为None；删除对话、异步景点提取完成不会改变它，
+    因此只作为响应头返回，是否304只按ETag判断
+    """
+    if last_modified is not None:
+        last_modified = last_modified.replace(tzinfo=pytz.UTC)
+    if is_resource_modified(request.environ, etag=etag):
+        response = make_response(build())
+    else:
+        response = Response(status=304)
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.headers['Cache-Control'] = 'no-cache'  # 浏览器每次重新验证，未变化时复用缓存
+    return response
+
+def list_conversations(user_id):
+    """按更新时间倒序列出用户的对话，走 (user_id, updated_at) 索引；
+    消息数由一条带相关子查询的SELECT取回，归档对话的消息数一次批量读取；
+    分片模式下每个分片各自有序，按updated_at归并"""
+    message_count = (select(func.count(Message.id))
+                     .where(Message.conversation_id == Conversation.id)
+                     .correlate(Conversation).scalar_subquery())
+    query = (select(Conversation.id, Conversation.title, Conversation.dify_conversation_id, Conversation.created_at,
+                    Conversation.updated_at, Conversation.archived_at, message_count.label('message_count'))
+             .where(Conversation.user_id == user_id)
+             .order_by(Conversation.updated_at.desc()))
+    rows = list(heapq.merge(*[db.session.execute(query).all() for _ in each_shard()],
+                            key=lambda row: row.updated_at, reverse=True))
+    
+    archived_ids = [row.id for row in rows if row.archived_at is not None]
+    archived_counts = dict(db.session.execute(
+        select(ConversationArchive.conversation_id, ConversationArchive.message_count)
+        .where(ConversationArchive.conversation_id.in_(archived_ids))
+    ).all()) if archived_ids else {}
+    
+    tz = display_timezone()
+    return [Conversation.serialize(row, archived_counts.get(row.id, 0) if row.archived_at is not None
+                                   else row.message_count, tz) for row in rows]
+
+@api.route('/api/conversations', methods=['GET'])
 def get_conversations():
-    """获取所有对话"""
+    """获取用户的对话（user_id查询参数），支持ETag条件请求"""
     try:
-        conversations = Conversation.query.order_by(Conversation.updated_at.desc()).all()
-        return jsonify({
-            'success': True,
-            'data': [conv.to_dict() for conv in conversations]
-        })
+        user_id = _request_user_id()
+        # 对话增删、归档恢复和新消息都会改变这几个聚合值，只统计该用户的对话，
+        # 每个对话的最大消息ID由 (conversation_id, id) 索引直接取得，不加载对话行
+        last_message_id = (select(func.max(Message.id))
+                           .where(Message.conversation_id == Conversation.id)
+                           .correlate(Conversation).scalar_subquery())
+        query = db.session.query(
+            func.count(Conversation.id),
+            func.max(Conversation.id),
+            func.max(Conversation.updated_at),
+            func.count(Conversation.archived_at),
+            func.max(last_message_id)
+        ).filter(Conversation.user_id == user_id)
+        # 分片模式下逐个分片统计，ETag由各分片的聚合值共同决定
+        versions = [tuple(query.one()) for _ in each_shard()]
+        last_updated = max((version[2] for version in versions if version[2] is not None), default=None)
+        etag = _etag('conversations', user_id, versions)
+        
+        def build():
+            return jsonify({
+                'success': True,
+                'data': list_conversations(user_id)
+            })
+        
+        return _conditional_response(etag, last_updated, build)
     except Exception as e:
         app.logger.error(f'获取对话列表失败: {str(e)}')
         return jsonify({
@@ -520,14 +1076,14 @@ def get_conversations():
             'error': str(e)
         }), 500
 
-@app.route('/api/conversations', methods=['POST'])
+@api.route('/api/conversations', methods=['POST'])
 def create_conversation():
     """创建新对话"""
     try:
         data = request.get_json() or {}
         title = data.get('title', f'对话 {datetime.now().strftime("%m-%d %H:%M")}')
         
-        conversation = Conversation(title=title)
+        conversation = new_conversation(title, _request_user_id())
         db.session.add(conversation)
         db.session.commit()
         
@@ -545,45 +1101,137 @@ def create_conversation():
             'error': str(e)
         }), 500
 
-@app.route('/api/conversations/<int:conversation_id>', methods=['DELETE'])
+@api.route('/api/conversations/<int:conversation_id>', methods=['DELETE'])
 def delete_conversation(conversation_id):
-    """删除对话"""
+    """删除对话，只能删除user_id查询参数对应用户的对话"""
     try:
-        conversation = Conversation.query.get_or_404(conversation_id)
-        title = conversation.title
-        
-        db.session.delete(conversation)
-        db.session.commit()
+        write_behind.ensure_visible(conversation_id)
+        if not delete_conversations([conversation_id], _request_user_id()):
+            return jsonify({
+                'success': False,
+                'error': '对话不存在'
+            }), 404
         
-        app.logger.info(f'🗑️ 删除对话: {title}')
+        app.logger.info(f'🗑️ 删除对话: {conversation_id}')
         
         return jsonify({
             'success': True,
             'message': '对话已删除'
         })
-        
+    
     except Exception as e:
+        db.session.rollback()
         app.logger.error(f'删除对话失败: {str(e)}')
         return jsonify({
             'success': False,
             'error': str(e)
         }), 500
 
-@app.route('/api/conversations/<int:conversation_id>/messages', methods=['GET'])
-def get_messages(conversation_id):
-    """获取对话消息"""
+@api.route('/api/conversations/batch-delete', methods=['POST'])
+def batch_delete_conversations():
+    """
+    批量删除对话
+    
+    请求体: {"ids": [对话ID, ...], "user_id": 用户标识}；返回已删除的ID和不存在（或不属于该用户）的ID
+    """
+    data = request.get_json(silent=True) or {}
     try:
-        conversation = Conversation.query.get_or_404(conversation_id)
-        messages = Message.query.filter_by(conversation_id=conversation_id).order_by(Message.created_at).all()
+        conversation_ids = sorted({int(conversation_id) for conversation_id in data.get('ids')})
+    except (TypeError, ValueError):
+        return jsonify({
+            'success': False,
+            'error': 'ids必须是对话ID数组'
+        }), 400
+    if len(conversation_ids) > app_config.CONVERSATIONS_BATCH_DELETE_MAX:
+        return jsonify({
+            'success': False,
+            'error': f'单次最多删除{app_config.CONVERSATIONS_BATCH_DELETE_MAX}个对话'
+        }), 400
+    
+    try:
+        for conversation_id in conversation_ids:
+            write_behind.ensure_visible(conversation_id)
+        deleted = delete_conversations(conversation_ids, _request_user_id()) if conversation_ids else []
+        
+        app.logger.info(f'🗑️ 批量删除对话: {len(deleted)} 个')
         
         return jsonify({
             'success': True,
             'data': {
-                'conversation': conversation.to_dict(),
-                'messages': [msg.to_dict() for msg in messages]
+                'deleted': deleted,
+                'missing': sorted(set(conversation_ids) - set(deleted))
             }
         })
+    
+    except Exception as e:
+        db.session.rollback()
+        app.logger.error(f'批量删除对话失败: {str(e)}')
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+def _message_page(conversation_id, limit, before_id=None, after_id=None):
+    """
+    按消息ID范围取一页消息，走 (conversation_id, id) 索引
+    
+    给出after_id时取比它新的最早一页（增量同步，has_more表示还有更新的消息），
+    否则取before_id之前（默认最新）的一页；返回 (按时间正序的消息数据列表, has_more)
+    """
+    query = select(*MESSAGE_LIST_COLUMNS).where(Message.conversation_id == conversation_id)
+    if before_id:
+        query = query.where(Message.id < before_id)
+    if after_id is not None:
+        rows = db.session.execute(query.where(Message.id > after_id).order_by(Message.id).limit(limit + 1)).all()
+        return serialize_message_rows(rows[:limit]), len(rows) > limit
+    rows = db.session.execute(query.order_by(Message.id.desc()).limit(limit + 1)).all()
+    return serialize_message_rows(rows[:limit][::-1]), len(rows) > limit
+
+@api.route('/api/conversations/<int:conversation_id>/messages', methods=['GET'])
+def get_messages(conversation_id):
+    """获取对话消息，支持before_id向前翻页、after_id增量同步和ETag条件请求；只能读取user_id查询参数对应用户的对话"""
+    try:
+        if _conversation_owner(conversation_id) != _request_user_id():
+            return _conversation_not_found()
+        # 写后模式下先等待该对话排队中的写入提交，保证读到刚发送的消息
+        write_behind.ensure_visible(conversation_id)
+        conversation = restore_conversation(db.session.get(Conversation, conversation_id))
         
+        # 默认只返回最近一页消息，通过before_id向前翻页
+        limit = min(max(request.args.get('limit', app_config.MESSAGES_PAGE_SIZE, type=int), 1),
+                    app_config.MESSAGES_MAX_PAGE_SIZE)
+        before_id = request.args.get('before_id', type=int)
+        after_id = request.args.get('after_id', type=int)  # 增量同步：只返回比它新的消息
+        
+        # 新消息、异步景点提取完成（pending变为ready/failed）和景点回填都会改变这几个聚合值；
+        # 增量同步时只统计after_id之后的范围，开销与新消息数成正比
+        scope = [Message.conversation_id == conversation_id]
+        if after_id is not None:
+            scope.append(Message.id > after_id)
+        count, max_id, with_status, pending = db.session.query(
+            func.count(Message.id),
+            func.max(Message.id),
+            func.count(Message.attractions_status),
+            func.coalesce(func.sum(case((Message.attractions_status == 'pending', 1), else_=0)), 0)
+        ).filter(*scope).one()
+        etag = _etag('messages', conversation_id, conversation.updated_at, conversation.archived_at,
+                     count, max_id, with_status, pending, limit, before_id, after_id)
+        
+        def build():
+            messages, has_more = _message_page(conversation_id, limit, before_id, after_id)
+            return jsonify({
+                'success': True,
+                'data': {
+                    'conversation': conversation.to_dict(),
+                    'messages': messages,
+                    'has_more': has_more,
+                    # 本页最早的消息ID，has_more为真时作为before_id取更早的历史
+                    'oldest_id': messages[0]['id'] if messages else None
+                }
+            })
+        
+        return _conditional_response(etag, conversation.updated_at, build)
+    
     except Exception as e:
         app.logger.error(f'获取消息失败: {str(e)}')
         return jsonify({
@@ -591,111 +1239,887 @@ def get_messages(conversation_id):
             'error': str(e)
         }), 500
 
-@app.route('/api/chat/send', methods=['POST'])
+@api.route('/api/messages/sync', methods=['POST'])
+def sync_messages():
+    """
+    批量增量同步 - 一次取回多个对话中比客户端已有消息更新的消息
+    
+    请求体: {"cursors": {"对话ID": 客户端已有的最大消息ID, ...}, "limit": 每个对话最多返回的消息数, "user_id": 用户标识}
+    只返回有新消息的对话；不存在（已删除）或不属于该用户的对话ID放在missing中
+    """
+    data = request.get_json(silent=True) or {}
+    cursors = data.get('cursors')
+    try:
+        cursors = {int(conversation_id): int(after_id or 0) for conversation_id, after_id in cursors.items()}
+        limit = min(max(int(data.get('limit', app_config.MESSAGES_PAGE_SIZE)), 1), app_config.MESSAGES_MAX_PAGE_SIZE)
+    except (AttributeError, TypeError, ValueError):
+        return jsonify({
+            'success': False,
+            'error': 'cursors必须是 {对话ID: 消息ID} 形式的对象'
+        }), 400
+    if len(cursors) > app_config.MESSAGES_SYNC_MAX_CONVERSATIONS:
+        return jsonify({
+            'success': False,
+            'error': f'单次最多同步{app_config.MESSAGES_SYNC_MAX_CONVERSATIONS}个对话'
+        }), 400
+    
+    try:
+        found = set()
+        results = {}
+        user_id = _request_user_id()
+        for shard, conversation_ids in group_by_shard(cursors).items():
+            use_shard(shard)
+            for conversation in Conversation.query.filter(Conversation.id.in_(conversation_ids),
+                                                          Conversation.user_id == user_id).all():
+                conversation_id = conversation.id
+                found.add(conversation_id)
+                write_behind.ensure_visible(conversation_id)
+                restore_conversation(conversation)
+                messages, has_more = _message_page(conversation_id, limit, after_id=cursors[conversation_id])
+                if messages:
+                    results[str(conversation_id)] = {
+                        'messages': messages,
+                        'has_more': has_more
+                    }
+        
+        return jsonify({
+            'success': True,
+            'data': {
+                'conversations': results,
+                'missing': sorted(set(cursors) - found)
+            }
+        })
+    except Exception as e:
+        app.logger.error(f'增量同步消息失败: {str(e)}')
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+@api.route('/api/conversations/<int:conversation_id>/events', methods=['GET'])
+def conversation_events(conversation_id):
+    """
+    订阅对话事件（Server-Sent Events）- 新消息提交后推送 message，后台景点提取完成后推送 attractions
+    
+    事件ID可用于断线重连：浏览器EventSource自动带 Last-Event-ID 头，补发之后保留期内的事件；
+    没有事件时每 EVENTS_HEARTBEAT_SECONDS 秒发送一次注释行心跳；只能订阅user_id查询参数对应用户的对话
+    """
+    if not event_broker.enabled:
+        return jsonify({
+            'success': False,
+            'error': '事件推送未启用'
+        }), 404
+    
+    if _conversation_owner(conversation_id) != _request_user_id():
+        return _conversation_not_found()
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    try:
+        last_event_id = int(last_event_id) if last_event_id else None
+    except ValueError:
+        last_event_id = None
+    
+    subscription = event_broker.subscribe(conversation_id, last_event_id)
+    db.session.remove()  # 长连接期间不占用数据库连接
+    if subscription is None:
+        return jsonify({
+            'success': False,
+            'error': dify_config.ERROR_MESSAGES['SERVER_BUSY'],
+            'code': 'SERVER_BUSY'
+        }), 503
+    
+    def generate():
+        try:
+            yield f'retry: {app_config.EVENTS_RETRY_MS}\n\n'
+            while True:
+                pending = subscription.get(event_broker.heartbeat_seconds)
+                if pending is None:
+                    return  # 积压溢出，客户端重连后按Last-Event-ID补发
+                yield ''.join(pending) if pending else ': keepalive\n\n'
+        finally:
+            event_broker.unsubscribe(subscription)
+    
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def _queued_message_dict(turn, index):
+    """写后队列中尚未提交的消息，以 轮次ID-序号 作为临时ID返回"""
+    record = turn['messages'][index]
+    message_id = f"{turn['turn_id']}-{index}"
+    message = Message(
+        content=record['content'],
+        display_content=record.get('display_content'),
+        sender_type=record['sender_type'],
+        turn_id=turn['turn_id'],
+        attractions_status=record['attractions_status'],
+        created_at=datetime.fromisoformat(record['created_at'])
+    )
+    data = message.to_dict()
+    data['id'] = message_id
+    if record['sender_type'] == 'ai':
+        data['attractions'] = [
+            Attraction(**{**row, 'message_id': message_id}).to_dict() for row in record['attractions']
+        ]
+        data['attractions_status'] = record['attractions_status']
+    return data
+
+def _resolve_conversation(message_content, conversation_id, user_id, commit=False):
+    """
+    获取要继续的对话（归档对话先恢复），不存在时以消息开头为标题为user_id创建新对话
+    
+    Returns:
+        tuple: (对话, Dify对话ID)；新对话默认只flush获取ID，与本轮消息在同一事务中提交
+    """
+    db_conversation = None
+    dify_conversation_id = None
+    
+    # 如果提供了conversation_id，尝试获取现有对话
+    if conversation_id:
+        use_shard(shard_for(conversation_id))
+        db_conversation = Conversation.query.get(conversation_id)
+        if db_conversation:
+            if write_behind.enabled:
+                # 上一轮可能仍在写后队列中（包括Dify对话ID），等待提交后重新读取
+                write_behind.ensure_visible(db_conversation.id)
+                db.session.refresh(db_conversation)
+            restore_conversation(db_conversation)
+            # 从数据库对话记录中获取Dify的conversation_id
+            dify_conversation_id = db_conversation.dify_conversation_id
+    
+    # 如果没有找到现有对话，创建新对话
+    if not db_conversation:
+        title = message_content[:30] + ('...' if len(message_content) > 30 else '')
+        db_conversation = new_conversation(title, user_id)
+        db.session.add(db_conversation)
+        if commit or write_behind.enabled:
+            db.session.commit()  # 消息稍后提交，对话需先落库以获得稳定ID
+        else:
+            db.session.flush()  # 获取ID但不提交
+    
+    return db_conversation, dify_conversation_id
+
+def _save_attractions(ai_message, ai_content, extracted=None):
+    """
+    为已提交的AI消息同步提取并保存景点，失败时标记为failed（消息保持已提交）
+    
+    Args:
+        extracted: 已提取的景点；为None时从ai_content提取
+    
+    Returns:
+        list: 景点字典列表
+    """
+    try:
+        if extracted is None:
+            extracted = dify_service.extract_attractions(ai_content)
+        attraction_rows = [Attraction(**row) for row in Attraction.build_rows(ai_message.id, extracted)]
+        db.session.add_all(attraction_rows)
+        ai_message.attractions_status = 'ready'
+        event_broker.record([(ai_message.conversation_id, 'attractions', ai_message.id)])
+        db.session.commit()
+        return [attraction.to_dict() for attraction in attraction_rows]
+    except Exception as e:
+        db.session.rollback()
+        app.logger.error(f'💥 景点提取失败 (消息 {ai_message.id}): {str(e)}')
+        ai_message.attractions_status = 'failed'
+        event_broker.record([(ai_message.conversation_id, 'attractions', ai_message.id)])
+        db.session.commit()
+        return []
+
+def _save_turn(db_conversation, message_content, ai_content, new_dify_conversation_id=None, extracted=None,
+               turn_id=None):
+    """
+    保存一轮对话（用户消息、AI回复和景点），写后模式下整轮入队
+    
+    Args:
+        new_dify_conversation_id: 新对话首次得到的Dify对话ID
+        extracted: 已提取的景点；为None时按 ATTRACTION_EXTRACTION_MODE 提取
+        turn_id: 排队轮次入队时返回给客户端的ID，写入两条消息，客户端据此认出本轮的回复
+    
+    Returns:
+        dict: 接口响应的data部分
+    """
+    if write_behind.enabled:
+        # 写后模式: 景点同步提取后整轮入队，由后台线程批量提交；提取失败时照常入队并标记为failed
+        status = 'ready'
+        if extracted is None:
+            try:
+                extracted = dify_service.extract_attractions(ai_content)
+            except Exception as e:
+                app.logger.error(f'💥 景点提取失败 (对话 {db_conversation.id}): {str(e)}')
+                extracted, status = [], 'failed'
+        conversation_id = db_conversation.id
+        turn = write_behind.build_turn(conversation_id, [
+            ('user', message_content, None, None),
+            ('ai', ai_content, status, extracted)
+        ], dify_conversation_id=new_dify_conversation_id, turn_id=turn_id)
+        write_behind.enqueue(turn)
+        db.session.rollback()  # 请求会话中的修改（如Dify对话ID）以队列写入为准
+        user_data, ai_data = (_queued_message_dict(turn, index) for index in range(2))
+        
+        app.logger.info(f'💬 对话已入队: 数据库ID={conversation_id}, 景点数={len(extracted)}')
+        
+        return {
+            'conversation_id': conversation_id,
+            'user_message': user_data,
+            'ai_message': ai_data,
+            'attractions': ai_data.pop('attractions'),
+            'attractions_status': ai_data.pop('attractions_status')
+        }
+    
+    if new_dify_conversation_id:
+        # 只在尚未绑定时写入，并发的首轮（对话锁未启用时）不会互相覆盖
+        bound = db.session.execute(update(Conversation)
+                                   .where(Conversation.id == db_conversation.id,
+                                          Conversation.dify_conversation_id.is_(None))
+                                   .values(dify_conversation_id=new_dify_conversation_id),
+                                   execution_options={'synchronize_session': False}).rowcount
+        if not bound:
+            app.logger.warning(f'⚠️ 对话 {db_conversation.id} 已绑定其他Dify对话，保留原绑定')
+    
+    user_message = Message(
+        conversation_id=db_conversation.id,
+        content=message_content,
+        sender_type='user',
+        turn_id=turn_id
+    )
+    db.session.add(user_message)
+    
+    # 保存AI回复
+    ai_message = Message(
+        conversation_id=db_conversation.id,
+        content=ai_content,
+        sender_type='ai',
+        turn_id=turn_id
+    )
+    db.session.add(ai_message)
+    db.session.flush()  # 获取AI消息ID用于关联景点
+    event_broker.record([(db_conversation.id, 'message', user_message.id),
+                         (db_conversation.id, 'message', ai_message.id)])
+    
+    # async模式下先预占后台队列位置；队列已满则回退为同步提取
+    deferred = (extracted is None and dify_config.ATTRACTION_EXTRACTION_MODE == 'async' and attraction_pool.reserve())
+    ai_message.attractions_status = 'pending'
+    
+    # 更新对话时间；先提交消息，景点提取失败不会连带回滚本轮对话
+    db_conversation.updated_at = datetime.utcnow()
+    try:
+        db.session.commit()
+    except Exception:
+        if deferred:
+            attraction_pool.release()
+        raise
+    
+    if deferred:
+        # 提交后再投递，保证后台写回时消息已落库
+        attraction_pool.submit(ai_message.id, ai_content, current_shard())
+        attractions = []
+    else:
+        attractions = _save_attractions(ai_message, ai_content, extracted)
+    
+    app.logger.info(f'💬 对话完成: 数据库ID={db_conversation.id}, 景点数={len(attractions)}')
+    
+    return {
+        'conversation_id': db_conversation.id,  # 返回数据库的对话ID
+        'user_message': user_message.to_dict(),
+        'ai_message': ai_message.to_dict(),
+        'attractions': attractions,
+        'attractions_status': ai_message.attractions_status
+    }
+
+def _request_user_id():
+    """当前请求的用户标识：JSON请求体或查询参数中的user_id，缺省为 DEFAULT_USER_ID"""
+    data = request.get_json(silent=True)
+    user_id = data.get('user_id') if isinstance(data, dict) else None
+    return str(user_id or request.args.get('user_id') or dify_config.DEFAULT_USER_ID)[:128]
+
+def _conversation_owner(conversation_id):
+    """对话所属的用户，对话不存在时为None；同时切换到对话所在的分片"""
+    use_shard(shard_for(conversation_id))
+    return db.session.query(Conversation.user_id).filter(Conversation.id == conversation_id).scalar()
+
+def _conversation_not_found():
+    # 属于其他用户的对话与不存在的对话返回相同的响应，不暴露对话是否存在
+    return jsonify({
+        'success': False,
+        'error': '对话不存在'
+    }), 404
+
+def _error_response(code, status_code, retry_after=None):
+    response = jsonify({
+        'success': False,
+        'error': dify_config.ERROR_MESSAGES[code],
+        'code': code
+    })
+    response.status_code = status_code
+    if retry_after is not None:
+        response.headers['Retry-After'] = str(retry_after)
+    return response
+
+def admission_controlled(view):
+    """聊天接口准入控制：超出限流或上游并发已满时立即返回429和Retry-After，不占用worker等待Dify
+    并发名额在响应结束时释放，流式响应持有到流结束"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not admission.enabled:
+            return view(*args, **kwargs)
+        
+        user_id = _request_user_id()
+        slot, rejection = admission.admit(user_id, request.remote_addr or 'unknown')
+        if rejection:
+            code, retry_after = rejection
+            retry_after = max(1, math.ceil(retry_after))
+            app.logger.warning(f'🚦 拒绝聊天请求({code}) - 用户: {user_id}, IP: {request.remote_addr}, {retry_after}秒后重试')
+            return _error_response(code, 429, retry_after)
+        
+        if slot is None:
+            return view(*args, **kwargs)
+        try:
+            response = make_response(view(*args, **kwargs))
+        except Exception:
+            admission.release_slot(slot)
+            raise
+        if response.is_streamed:
+            response.call_on_close(lambda: admission.release_slot(slot))
+        else:
+            admission.release_slot(slot)
+        return response
+    return wrapper
+
+def idempotent(view):
+    """聊天接口幂等：带 Idempotency-Key 头的请求按 (user_id, 幂等键) 只执行一次，重试返回首次请求的响应
+    首次请求仍在执行时立即返回409和Retry-After；服务端错误、限流拒绝和超时不保存，重试时重新执行"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if not idempotency.enabled or key is None:
+            return view(*args, **kwargs)
+        
+        key = key.strip()
+        if not key or len(key) > 255:
+            return _error_response('IDEMPOTENCY_KEY_INVALID', 400)
+        user_id = _request_user_id()
+        fingerprint = idempotency.fingerprint(request.get_json(silent=True))
+        owner, record = idempotency.acquire(user_id, key, fingerprint)
+        if owner is None:
+            if record.fingerprint != fingerprint:
+                return _error_response('IDEMPOTENCY_KEY_REUSED', 422)
+            if record.status_code is None:
+                app.logger.warning(f'⏳ 幂等请求仍在执行 - 用户: {user_id}, 幂等键: {key}')
+                return _error_response('IDEMPOTENCY_IN_PROGRESS', 409, idempotency.retry_after)
+            app.logger.info(f'🔁 返回幂等请求保存的响应 - 用户: {user_id}, 幂等键: {key}')
+            response = Response(record.response, status=record.status_code, mimetype='application/json')
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response
+        
+        try:
+            response = make_response(view(*args, **kwargs))
+        except Exception:
+            idempotency.release(user_id, key, owner)
+            raise
+        if response.status_code >= 500 or response.status_code == 429 or response.is_streamed:
+            idempotency.release(user_id, key, owner)
+        else:
+            idempotency.complete(user_id, key, owner, response.status_code, response.get_data(as_text=True))
+        return response
+    return wrapper
+
+def _chat_turn(message_content, conversation_id, user_id, deadline, queued=False, turn_id=None):
+    """
+    执行一轮对话：获取对话、调用Dify并保存（发送接口和排队轮次共用）
+    
+    Args:
+        queued: 排队轮次没有等待响应的客户端，排队超时也保存为失败回复，订阅者同样能收到
+        turn_id: 排队轮次的ID，写入本轮消息
+    
+    Returns:
+        dict: 接口响应；排队超时未调用Dify时为错误响应，本轮对话不保存
+    """
+    db_conversation, dify_conversation_id = _resolve_conversation(message_content, conversation_id, user_id)
+    
+    # 调用Dify API（传入Dify的conversation_id，不是数据库的ID）
+    app.logger.info(f'📤 调用Dify API - 消息: {message_content[:50]}...')
+    app.logger.info(f'📤 使用Dify对话ID: {dify_conversation_id}')
+    
+    result = dify_service.send_message(
+        message_content, 
+        conversation_id=dify_conversation_id,
+        user_id=user_id,
+        deadline=deadline
+    )
+    
+    if result.get('code') == 'DEADLINE_EXCEEDED' and not queued:
+        # 客户端已超时，不再保存本轮对话
+        db.session.rollback()
+        return {
+            'success': False,
+            'error': result['error'],
+            'code': result['code']
+        }
+    
+    new_dify_conversation_id = None
+    if result['success']:
+        dify_data = result['data']
+        ai_content = dify_data.get('answer', '抱歉，我暂时无法回答您的问题。')
+        
+        # 获取Dify返回的conversation_id
+        returned_conversation_id = dify_data.get('conversation_id', '')
+        
+        # 如果这是新对话，保存Dify的conversation_id
+        if not dify_conversation_id and returned_conversation_id:
+            new_dify_conversation_id = returned_conversation_id
+            app.logger.info(f'🆕 保存新Dify对话ID: {returned_conversation_id}')
+        
+        app.logger.info(f'✅ AI回复成功: {ai_content[:100]}...')
+    
+    else:
+        ai_content = f"抱歉，AI服务暂时不可用：{result.get('error', '未知错误')}"
+        app.logger.error(f'❌ AI回复失败: {result.get("error")}')
+    
+    return {
+        'success': True,
+        'data': _save_turn(db_conversation, message_content, ai_content, new_dify_conversation_id, turn_id=turn_id)
+    }
+
+# 排队轮次由后台线程通过同一个 _chat_turn 执行
+turn_pipeline = TurnPipeline(app_config.CHAT_PIPELINE_WORKERS, _chat_turn)
+
+@api.route('/api/chat/send', methods=['POST'])
+@idempotent
+@admission_controlled
 def send_message():
-    """发送消息并获取AI回复"""
+    """发送消息并获取AI回复；同一对话已有轮次在执行时排队并返回202，回复通过对话事件推送"""
+    deadline = _request_deadline()
+    conversation_id = None
+    lock = None
     try:
         data = request.get_json()
         message_content = data.get('message', '').strip()
-        conversation_id = data.get('conversation_id')
-        user_id = data.get('user_id', 'user')
+        user_id = _request_user_id()
         
         if not message_content:
             return jsonify({
                 'success': False,
                 'error': dify_config.ERROR_MESSAGES['EMPTY_MESSAGE']
             }), 400
+        try:
+            conversation_id = _request_conversation_id(data)
+        except ValueError:
+            return _error_response('INVALID_CONVERSATION_ID', 400)
+        if conversation_id and _conversation_owner(conversation_id) not in (None, user_id):
+            return _conversation_not_found()
         
-        # 数据库对话记录
-        db_conversation = None
-        dify_conversation_id = None
-        
-        # 如果提供了conversation_id，尝试获取现有对话
-        if conversation_id:
-            db_conversation = Conversation.query.get(conversation_id)
-            if db_conversation:
-                # 从数据库对话记录中获取Dify的conversation_id
-                dify_conversation_id = db_conversation.dify_conversation_id
-        
-        # 如果没有找到现有对话，创建新对话
-        if not db_conversation:
-            title = message_content[:30] + ('...' if len(message_content) > 30 else '')
-            db_conversation = Conversation(title=title)
-            db.session.add(db_conversation)
-            db.session.flush()  # 获取ID但不提交
-        
-        # 保存用户消息
-        user_message = Message(
-            conversation_id=db_conversation.id,
-            content=message_content,
-            sender_type='user'
-        )
-        db.session.add(user_message)
-        
-        # 调用Dify API（传入Dify的conversation_id，不是数据库的ID）
-        app.logger.info(f'📤 调用Dify API - 消息: {message_content[:50]}...')
-        app.logger.info(f'📤 使用Dify对话ID: {dify_conversation_id}')
+        # 同一对话的轮次串行执行，保证每轮都在上一轮绑定的Dify对话中继续
+        if conversation_id and conversation_locks.enabled:
+            lock = conversation_locks.try_acquire(conversation_id)
+            if lock is None:
+                queued = turn_pipeline.enqueue(conversation_id, message_content, user_id)
+                if queued is not None:
+                    return jsonify({
+                        'success': True,
+                        'data': queued
+                    }), 202
         
-        result = dify_service.send_message(
-            message_content, 
-            conversation_id=dify_conversation_id,
-            user_id=user_id
-        )
+        result = _chat_turn(message_content, conversation_id, user_id, deadline)
+        return jsonify(result), (200 if result['success'] else 503)
+    
+    except Exception as e:
+        db.session.rollback()
+        app.logger.error(f'💥 发送消息失败: {str(e)}')
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+    finally:
+        if lock is not None:
+            conversation_locks.release(lock)
+            turn_pipeline.resume(conversation_id)
+
+def _request_conversation_id(data):
+    """请求体中要继续的对话ID，缺省（新对话）时为None；不是正整数时抛出ValueError"""
+    value = data.get('conversation_id')
+    if not value:
+        return None
+    if isinstance(value, str) and value.isascii() and value.isdigit():
+        return int(value)
+    if isinstance(value, int) and not isinstance(value, bool) and value > 0:
+        return value
+    raise ValueError(f'无效的对话ID: {value!r}')
+
+def _request_deadline():
+    """本次请求调用Dify的截止时间：默认 DIFY_REQUEST_DEADLINE 秒，客户端可用 X-Request-Timeout 头缩短"""
+    budget = dify_config.REQUEST_DEADLINE
+    try:
+        budget = min(budget, float(request.headers.get('X-Request-Timeout', budget)))
+    except ValueError:
+        pass
+    return time.monotonic() + budget
+
+def _sse(event, data):
+    """格式化一条Server-Sent Events消息"""
+    return f'event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n'
+
+@api.route('/api/chat/stream', methods=['POST'])
+@admission_controlled
+def stream_message():
+    """
+    流式发送消息 - 以Server-Sent Events逐段返回AI回复
+    
+    事件: message（回复片段）、attraction（段落结束后立即提取出的景点，ID为临时ID）、
+    done（与 /api/chat/send 相同的data，包含持久化后的景点）、error；
+    排队等待上游名额期间发送SSE注释行作为心跳，客户端断开后不再调用Dify。
+    同一对话已有轮次在执行时与 /api/chat/send 一样排队并返回202，回复通过对话事件推送
+    """
+    deadline = _request_deadline()
+    data = request.get_json()
+    message_content = data.get('message', '').strip()
+    user_id = _request_user_id()
+    
+    if not message_content:
+        return jsonify({
+            'success': False,
+            'error': dify_config.ERROR_MESSAGES['EMPTY_MESSAGE']
+        }), 400
+    try:
+        conversation_id = _request_conversation_id(data)
+    except ValueError:
+        return _error_response('INVALID_CONVERSATION_ID', 400)
+    if conversation_id and _conversation_owner(conversation_id) not in (None, user_id):
+        return _conversation_not_found()
+    
+    lock = None
+    try:
+        # 同一对话的轮次串行执行；持锁后才读取上一轮绑定的Dify对话ID
+        if conversation_id and conversation_locks.enabled:
+            lock = conversation_locks.try_acquire(conversation_id)
+            if lock is None:
+                queued = turn_pipeline.enqueue(conversation_id, message_content, user_id)
+                if queued is not None:
+                    return jsonify({
+                        'success': True,
+                        'data': queued
+                    }), 202
         
-        if result['success']:
-            dify_data = result['data']
-            ai_content = dify_data.get('answer', '抱歉，我暂时无法回答您的问题。')
-            
-            # 获取Dify返回的conversation_id
-            returned_conversation_id = dify_data.get('conversation_id', '')
-            
-            # 如果这是新对话，保存Dify的conversation_id
-            if not dify_conversation_id and returned_conversation_id:
-                db_conversation.dify_conversation_id = returned_conversation_id
-                app.logger.info(f'🆕 保存新Dify对话ID: {returned_conversation_id}')
+        # 流式响应期间不持有数据库事务，新对话先提交
+        db_conversation, dify_conversation_id = _resolve_conversation(message_content, conversation_id, user_id, commit=True)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        if lock is not None:
+            conversation_locks.release(lock)
+            turn_pipeline.resume(conversation_id)
+        app.logger.error(f'💥 流式发送消息失败: {str(e)}')
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+    
+    def generate():
+        extractor = StreamingAttractionExtractor(dify_service)
+        chunks = []
+        returned_conversation_id = ''
+        error = None
+        try:
+            for event in dify_service.stream_message(message_content, conversation_id=dify_conversation_id,
+                                                     user_id=user_id, deadline=deadline):
+                if event['event'] == 'queued':
+                    yield ': queued\n\n'
+                    continue
+                if event.get('code') == 'DEADLINE_EXCEEDED':
+                    # 排队超时未调用Dify，不保存本轮对话
+                    yield _sse('error', {'error': event['error'], 'code': event['code']})
+                    return
+                if event['event'] == 'error':
+                    error = event['error']
+                    break
+                returned_conversation_id = event.get('conversation_id') or returned_conversation_id
+                if event['event'] == 'message' and event['answer']:
+                    chunks.append(event['answer'])
+                    yield _sse('message', {'answer': event['answer']})
+                    for attraction in extractor.feed(event['answer']):
+                        yield _sse('attraction', attraction)
             
-            app.logger.info(f'✅ AI回复成功: {ai_content[:100]}...')
+            if error is None:
+                ai_content = ''.join(chunks) or '抱歉，我暂时无法回答您的问题。'
+                for attraction in extractor.finish():
+                    yield _sse('attraction', attraction)
+                extracted = extractor.attractions
+            else:
+                ai_content = f'抱歉，AI服务暂时不可用：{error}'
+                extracted = None
+                app.logger.error(f'❌ AI流式回复失败: {error}')
+                yield _sse('error', {'error': error})
             
+            new_dify_conversation_id = returned_conversation_id if not dify_conversation_id else None
+            yield _sse('done', _save_turn(db_conversation, message_content, ai_content,
+                                          new_dify_conversation_id, extracted))
+        except Exception as e:
+            db.session.rollback()
+            app.logger.error(f'💥 流式发送消息失败: {str(e)}')
+            yield _sse('error', {'error': str(e)})
+    
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    if lock is not None:
+        # 响应关闭时释放对话锁：客户端在流开始前断开时生成器不会执行，在这里释放才不会遗留锁
+        flask_app = current_app._get_current_object()
+        def release_lock():
+            conversation_locks.release(lock)
+            with flask_app.app_context():
+                turn_pipeline.resume(conversation_id)
+                db.session.remove()
+        response.call_on_close(release_lock)
+    return response
+
+# 搜索片段高亮使用控制字符占位，转义HTML后再替换为<mark>标签
+_SNIPPET_OPEN = '\x02'
+_SNIPPET_CLOSE = '\x03'
+
+def _render_snippet(snippet, short_terms):
+    # 短词不经过FTS5的snippet/highlight，在这里补上高亮标记
+    snippet = snippet or ''
+    for term in short_terms:
+        snippet = snippet.replace(term, f'{_SNIPPET_OPEN}{term}{_SNIPPET_CLOSE}')
+    escaped = html.escape(snippet)
+    return escaped.replace(_SNIPPET_OPEN, '<mark>').replace(_SNIPPET_CLOSE, '</mark>')
+
+def _search_index_available():
+    if db.engine.dialect.name != 'sqlite':
+        return False  # FTS5只在SQLite上建立，其他数据库使用LIKE查询
+    return db.session.execute(text(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'")).first() is not None
+
+def _build_search_query(terms, fts_table, column, snippet_tokens, scope=None):
+    """构建检索SQL：3字及以上的词走trigram索引MATCH，更短的词回退为LIKE子串匹配
+    全部命中按 bm25() 相关度排序（同分时新的在前），排序与翻页位置无关；scope为附加的过滤条件（如限定用户）"""
+    clauses = [scope] if scope else []
+    params = {'open': _SNIPPET_OPEN, 'close': _SNIPPET_CLOSE}
+    match_terms = [term for term in terms if len(term) >= 3]
+    short_terms = [term for term in terms if len(term) < 3]
+    
+    if match_terms:
+        clauses.append(f'{fts_table} MATCH :match')
+        params['match'] = ' '.join('"' + term.replace('"', '""') + '"' for term in match_terms)
+    for i, term in enumerate(short_terms):
+        escaped = term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        clauses.append(f"{fts_table}.{column} LIKE :like_{i} ESCAPE '\\'")
+        params[f'like_{i}'] = f'%{escaped}%'
+    
+    if match_terms:
+        # bm25为负数，越小越相关
+        score = f'bm25({fts_table})'
+        if snippet_tokens:
+            snippet = f"snippet({fts_table}, 0, :open, :close, '…', {snippet_tokens})"
         else:
-            ai_content = f"抱歉，AI服务暂时不可用：{result.get('error', '未知错误')}"
-            app.logger.error(f'❌ AI回复失败: {result.get("error")}')
-        
-        # 保存AI回复
-        ai_message = Message(
-            conversation_id=db_conversation.id,
-            content=ai_content,
-            sender_type='ai'
-        )
-        db.session.add(ai_message)
+            snippet = f'highlight({fts_table}, 0, :open, :close)'
+    else:
+        # 只有短词时没有MATCH，bm25()不可用，按时间倒序
+        params['term_0'] = terms[0]
+        score = '0'
+        if snippet_tokens:
+            # snippet()无法定位，截取首个命中附近的文本
+            snippet = (f"CASE WHEN instr({column}, :term_0) > {snippet_tokens} "
+                       f"THEN '…' || substr({column}, instr({column}, :term_0) - {snippet_tokens // 2}, {snippet_tokens * 2}) "
+                       f"ELSE substr({column}, 1, {snippet_tokens * 2}) END")
+        else:
+            snippet = column
+    
+    sql = (f'SELECT {fts_table}.rowid AS id, {snippet} AS snippet, {score} AS score '
+           f'FROM {fts_table} WHERE {" AND ".join(clauses)} '
+           f'ORDER BY score, {fts_table}.rowid DESC LIMIT :fetch')
+    return sql, params, short_terms
+
+def _search_shard(terms, fetch, user_id):
+    """在当前分片中检索用户的对话标题和消息内容，返回 (命中列表, 由LIKE匹配的短词)"""
+    hits = []
+    if _search_index_available():
+        # 逐条按主键核对命中所属的用户
+        scope = ('EXISTS (SELECT 1 FROM conversations WHERE conversations.id = conversations_fts.rowid '
+                 'AND conversations.user_id = :user_id)')
+        sql, params, short_terms = _build_search_query(terms, 'conversations_fts', 'title', 0, scope)
+        for row in db.session.execute(text(sql), {**params, 'fetch': fetch, 'user_id': user_id}):
+            hits.append({'type': 'conversation', 'conversation_id': row.id, 'message_id': None,
+                         'snippet': row.snippet, 'score': row.score})
         
-        # 更新对话时间
-        db_conversation.updated_at = datetime.utcnow()
-        db.session.commit()
+        scope = ('EXISTS (SELECT 1 FROM messages JOIN conversations ON conversations.id = messages.conversation_id '
+                 'WHERE messages.id = messages_fts.rowid AND conversations.user_id = :user_id)')
+        sql, params, short_terms = _build_search_query(terms, 'messages_fts', 'content', 24, scope)
+        for row in db.session.execute(text(sql), {**params, 'fetch': fetch, 'user_id': user_id}):
+            hits.append({'type': 'message', 'conversation_id': None, 'message_id': row.id,
+                         'snippet': row.snippet, 'score': row.score})
+    else:
+        # 无FTS5时的兜底实现：逐词LIKE匹配
+        short_terms = terms
+        conversation_query = Conversation.query.filter(Conversation.user_id == user_id)
+        message_query = (db.session.query(Message.id, Message.conversation_id, Message.content)
+                         .join(Conversation).filter(Conversation.user_id == user_id))
+        content = Message.content
+        if db.engine.dialect.name == 'sqlite':
+            content = func.content_text(Message.content, type_=Text)
+        for term in terms:
+            conversation_query = conversation_query.filter(Conversation.title.contains(term, autoescape=True))
+            message_query = message_query.filter(content.contains(term, autoescape=True))
+        for conv in conversation_query.order_by(Conversation.id.desc()).limit(fetch):
+            hits.append({'type': 'conversation', 'conversation_id': conv.id, 'message_id': None,
+                         'snippet': conv.title, 'score': 0})
+        for msg in message_query.order_by(Message.id.desc()).limit(fetch):
+            hits.append({'type': 'message', 'conversation_id': msg.conversation_id, 'message_id': msg.id,
+                         'snippet': msg.content[:100], 'score': 0})
+    return hits, short_terms
+
+def search_history(terms, limit, offset, user_id):
+    """在用户的对话标题和消息内容中检索，返回按相关度排序的结果；分片模式下逐个分片检索后合并
+    每张表的命中按 (相关度, ID倒序) 全序排列，各取前 offset+limit+1 条合并，任意一页都是同一全序中的一段，翻页不会重复或遗漏"""
+    fetch = limit + offset + 1  # 多取一条判断是否还有下一页
+    hits = []
+    for index, shard in enumerate(each_shard()):
+        shard_hits, short_terms = _search_shard(terms, fetch, user_id)
+        for hit in shard_hits:
+            hit['shard'] = shard
+            hit['shard_index'] = index
+        hits.extend(shard_hits)
+    
+    # 按相关度合并标题和消息命中，同分时标题优先，再按ID倒序（与SQL中的排序一致）
+    hits.sort(key=lambda hit: (hit['score'], hit['type'] != 'conversation',
+                               -(hit['conversation_id'] if hit['type'] == 'conversation' else hit['message_id']),
+                               hit['shard_index']))
+    page_hits = hits[offset:offset + limit]
+    has_more = len(hits) > offset + limit
+    
+    # 只为当前页补齐消息和对话信息；各分片的消息ID独立分配，按 (分片, 消息ID) 区分
+    messages, conversations = {}, {}
+    for shard in each_shard({hit['shard'] for hit in page_hits}):
+        shard_hits = [hit for hit in page_hits if hit['shard'] == shard]
+        message_ids = [hit['message_id'] for hit in shard_hits if hit['message_id']]
+        if message_ids:
+            for msg in db.session.execute(select(Message.id, Message.conversation_id, Message.sender_type,
+                                                 Message.created_at).where(Message.id.in_(message_ids))):
+                messages[(shard, msg.id)] = msg
+        for hit in shard_hits:
+            if (shard, hit['message_id']) in messages:
+                hit['conversation_id'] = messages[(shard, hit['message_id'])].conversation_id
+        conversation_ids = {hit['conversation_id'] for hit in shard_hits}
+        for conv in db.session.execute(select(Conversation.id, Conversation.title, Conversation.updated_at)
+                                       .where(Conversation.id.in_(conversation_ids))):
+            conversations[conv.id] = conv
+    
+    beijing_tz = pytz.timezone(os.getenv('TIMEZONE', 'Asia/Shanghai'))
+    results = []
+    for hit in page_hits:
+        conv = conversations.get(hit['conversation_id'])
+        msg = messages.get((hit['shard'], hit['message_id']))
+        if conv is None:
+            continue
+        created_at = (msg.created_at if msg else conv.updated_at)
+        results.append({
+            'type': hit['type'],
+            'conversation_id': conv.id,
+            'conversation_title': conv.title,
+            'message_id': hit['message_id'],
+            'sender_type': msg.sender_type if msg else None,
+            'snippet': _render_snippet(hit['snippet'], short_terms),
+            'timestamp': created_at.replace(tzinfo=pytz.UTC).astimezone(beijing_tz).isoformat() if created_at else None
+        })
+    return results, has_more
+
+@api.route('/api/search', methods=['GET'])
+def search():
+    """全文检索对话历史，只检索user_id查询参数对应用户的对话"""
+    try:
+        query = request.args.get('q', '').strip()
+        if not query:
+            return jsonify({
+                'success': False,
+                'error': '搜索关键词不能为空'
+            }), 400
         
-        # 提取景点信息
-        attractions = dify_service.extract_attractions(ai_content)
+        page = max(request.args.get('page', 1, type=int), 1)
+        per_page = min(max(request.args.get('per_page', 20, type=int), 1), 50)
+        terms = query.split()[:8]
         
-        app.logger.info(f'💬 对话完成: 数据库ID={db_conversation.id}, 景点数={len(attractions)}')
+        results, has_more = search_history(terms, per_page, (page - 1) * per_page, _request_user_id())
         
         return jsonify({
             'success': True,
             'data': {
-                'conversation_id': db_conversation.id,  # 返回数据库的对话ID
-                'user_message': user_message.to_dict(),
-                'ai_message': ai_message.to_dict(),
-                'attractions': attractions
+                'query': query,
+                'page': page,
+                'per_page': per_page,
+                'has_more': has_more,
+                'results': results
             }
         })
         
     except Exception as e:
-        db.session.rollback()
-        app.logger.error(f'💥 发送消息失败: {str(e)}')
+        app.logger.error(f'搜索失败: {str(e)}')
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+@api.route('/api/messages/<int:message_id>/attractions', methods=['GET'])
+def get_message_attractions(message_id):
+    """获取AI消息的景点提取结果（async模式下用于轮询后台结果）
+    分片模式下各分片的消息ID独立分配，应同时给出conversation_id查询参数；未给出时依次查找各分片
+    只能读取user_id查询参数对应用户的对话中的消息"""
+    try:
+        conversation_id = request.args.get('conversation_id', type=int)
+        user_id = _request_user_id()
+        shards = [shard_for(conversation_id)] if conversation_id else shard_keys()
+        for shard in shards:
+            use_shard(shard)
+            message = db.session.get(Message, message_id)
+            if (message is not None and conversation_id in (None, message.conversation_id)
+                    and message.conversation.user_id == user_id):
+                break
+        else:
+            return jsonify({
+                'success': False,
+                'error': '消息不存在'
+            }), 404
+        
+        return jsonify({
+            'success': True,
+            'data': {
+                'message_id': message.id,
+                'status': message.attractions_status,
+                'attractions': [attraction.to_dict() for attraction in message.attractions]
+            }
+        })
+        
+    except Exception as e:
+        app.logger.error(f'获取景点失败: {str(e)}')
         return jsonify({
             'success': False,
             'error': str(e)
         }), 500
 
-@app.route('/api/locations/navigation', methods=['POST'])
+@api.route('/api/text/clean', methods=['POST'])
+def clean_text():
+    """移除文本中的坐标信息，返回用于展示的文本（与消息的display_content相同的清理规则）"""
+    try:
+        data = request.get_json()
+        content = data.get('text')
+        
+        if not isinstance(content, str):
+            return jsonify({
+                'success': False,
+                'error': 'text必须是字符串'
+            }), 400
+        
+        return jsonify({
+            'success': True,
+            'data': {
+                'display_content': clean_ai_text(content)
+            }
+        })
+    
+    except Exception as e:
+        app.logger.error(f'清理文本失败: {str(e)}')
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+@api.route('/api/locations/navigation', methods=['POST'])
 def get_navigation():
     """获取导航链接"""
     try:
@@ -731,7 +2155,7 @@ def get_navigation():
         }), 500
 
 # 错误处理
-@app.errorhandler(404)
+@api.app_errorhandler(404)
 def not_found_error(error):
     return jsonify({
         'success': False,
@@ -739,7 +2163,7 @@ def not_found_error(error):
         'code': 404
     }), 404
 
-@app.errorhandler(500)
+@api.app_errorhandler(500)
 def internal_error(error):
     db.session.rollback()
     return jsonify({
@@ -749,12 +2173,402 @@ def internal_error(error):
     }), 500
 
 # 初始化数据库
+def upgrade_schema():
+    """为已有数据库（分片模式下为当前分片）补齐新增的列和索引（create_all不会修改已存在的表）"""
+    engine = db.session.get_bind()
+    inspector = inspect(engine)
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        
+        existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing_columns:
+                continue
+            column_type = column.type.compile(dialect=engine.dialect)
+            db.session.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+            app.logger.info(f'📊 新增列: {table.name}.{column.name}')
+        
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+    
+    db.session.commit()
+
+def backfill_conversation_users(batch_size=1000):
+    """为新增user_id列之前创建的对话补齐所属用户，按批提交；返回回填的对话数
+    此前前端从不传user_id，聊天接口全部使用默认用户，历史对话都归属 DEFAULT_USER_ID"""
+    filled = 0
+    while True:
+        ids = [conversation_id for (conversation_id,) in
+               db.session.query(Conversation.id).filter(Conversation.user_id.is_(None)).limit(batch_size)]
+        if not ids:
+            return filled
+        # 显式保留updated_at，避免onupdate改变对话列表的排序
+        db.session.execute(update(Conversation)
+                           .where(Conversation.id.in_(ids))
+                           .values(user_id=dify_config.DEFAULT_USER_ID, updated_at=Conversation.updated_at),
+                           execution_options={'synchronize_session': False})
+        db.session.commit()
+        filled += len(ids)
+
+def create_schema():
+    """在当前应用的数据库中建表并补齐新增列；分片模式下主库只有对话ID序列表，对话数据的表建在每个分片库中"""
+    if shard_count() > 1:
+        db.create_all(bind_key='archive')
+        shard_catalog.create_all(db.engine)
+        IdempotencyKey.__table__.create(db.engine, checkfirst=True)
+        shard_tables = [table for table in db.metadata.sorted_tables if table is not IdempotencyKey.__table__]
+        for shard in shard_keys():
+            db.metadata.create_all(db.engines[shard], tables=shard_tables)
+        seed_conversation_ids()
+    else:
+        db.create_all()
+    for _ in each_shard():
+        upgrade_schema()
+        filled = backfill_conversation_users()
+        if filled:
+            app.logger.info(f'📊 已为 {filled} 个历史对话补齐user_id')
+
 def init_db():
     """初始化数据库"""
     with app.app_context():
-        db.create_all()
+        create_schema()
         app.logger.info('📊 数据库初始化完成')
 
+def _conversation_stores():
+    """存放对话数据的全部数据库，返回 [(分片, engine, 是否为临时engine)]：已配置的分片（未分片时为主库），
+    分片模式下仍有对话的主库（启用分片前的数据），以及分片目录中编号超出 SHARD_COUNT 的旧分片文件"""
+    stores = [(shard, db.engines[shard], False) for shard in shard_keys()]
+    if shard_count() > 1 and inspect(db.engine).has_table(Conversation.__tablename__):
+        stores.append((None, db.engine, False))
+    
+    index = shard_count() if shard_count() > 1 else 0
+    while os.path.exists(shard_database_path(current_app.config['SHARD_DIRECTORY'], index)):
+        path = shard_database_path(current_app.config['SHARD_DIRECTORY'], index)
+        stores.append((f'shard-{index}', create_engine(f'sqlite:///{path}'), True))
+        index += 1
+    return stores
+
+def seed_conversation_ids():
+    """分片模式下对话ID序列不低于各库中已有的最大对话ID，新对话的ID不会与尚未迁移的对话冲突"""
+    conversations = Conversation.__table__
+    max_id = 0
+    for _, engine, disposable in _conversation_stores():
+        if inspect(engine).has_table(conversations.name):
+            with engine.connect() as connection:
+                max_id = max(max_id, connection.execute(select(func.max(conversations.c.id))).scalar() or 0)
+        if disposable:
+            engine.dispose()
+    with db.engine.begin() as connection:
+        current = connection.execute(select(func.max(conversation_id_sequence.c.id))).scalar() or 0
+        if max_id > current:
+            connection.execute(insert(conversation_id_sequence).values(id=max_id))
+
+def move_conversation(conversation_id, source, target):
+    """
+    把一个对话连同消息和景点从source库移动到target库，先写入target再从source删除
+    
+    各分片的消息ID独立分配：原ID在target中已被占用时重新分配（与恢复归档对话相同），景点随之改写消息ID；
+    事件只用于短期推送，不迁移。中途失败后重新执行时，target中已有该对话则只删除source中的副本
+    
+    Returns:
+        int: 移动的消息数
+    """
+    conversations, messages, attractions = Conversation.__table__, Message.__table__, Attraction.__table__
+    message_ids = select(messages.c.id).where(messages.c.conversation_id == conversation_id)
+    with source.connect() as connection:
+        conversation = connection.execute(select(conversations).where(conversations.c.id == conversation_id)).mappings().first()
+        message_rows = [dict(row) for row in connection.execute(
+            select(messages).where(messages.c.conversation_id == conversation_id).order_by(messages.c.id)).mappings()]
+        attraction_rows = [dict(row) for row in connection.execute(
+            select(attractions).where(attractions.c.message_id.in_(message_ids)).order_by(attractions.c.id)).mappings()]
+    if conversation is None:
+        return 0
+    
+    with target.begin() as connection:
+        if connection.execute(select(conversations.c.id).where(conversations.c.id == conversation_id)).first() is None:
+            connection.execute(insert(conversations), [dict(conversation)])
+            original_ids = [row['id'] for row in message_rows]
+            if original_ids and connection.execute(select(messages.c.id).where(messages.c.id.in_(original_ids))).first():
+                for row in message_rows:
+                    del row['id']
+                new_ids = connection.execute(insert(messages).returning(messages.c.id, sort_by_parameter_order=True),
+                                             message_rows).scalars().all()
+            else:
+                if message_rows:
+                    connection.execute(insert(messages), message_rows)
+                new_ids = original_ids
+            id_map = dict(zip(original_ids, new_ids))
+            for row in attraction_rows:
+                del row['id']
+                row['message_id'] = id_map[row['message_id']]
+            if attraction_rows:
+                connection.execute(insert(attractions), attraction_rows)
+    
+    with source.begin() as connection:
+        connection.execute(delete(attractions).where(attractions.c.message_id.in_(message_ids)))
+        connection.execute(delete(messages).where(messages.c.conversation_id == conversation_id))
+        connection.execute(delete(ConversationEvent.__table__).where(ConversationEvent.conversation_id == conversation_id))
+        connection.execute(delete(conversations).where(conversations.c.id == conversation_id))
+    return len(message_rows)
+
+def rebalance_shards(dry_run=False, throttle_seconds=0):
+    """
+    把不在所属分片中的对话移动到所属分片：调整 SHARD_COUNT、首次启用分片（主库中的对话）或停用分片（合并回主库）后执行
+    
+    Returns:
+        dict: {(来源, 目标): 移动的对话数}，分片为None表示主库
+    """
+    moved = {}
+    for source_shard, engine, disposable in _conversation_stores():
+        try:
+            if not inspect(engine).has_table(Conversation.__tablename__):
+                continue
+            with engine.connect() as connection:
+                conversation_ids = connection.execute(select(Conversation.__table__.c.id)).scalars().all()
+            for conversation_id in conversation_ids:
+                target_shard = shard_for(conversation_id)
+                if target_shard == source_shard:
+                    continue
+                if not dry_run:
+                    count = move_conversation(conversation_id, engine, db.engines[target_shard])
+                    app.logger.info(f'🔀 移动对话: {conversation_id}, {source_shard or "主库"} -> '
+                                    f'{target_shard or "主库"}, 消息 {count} 条')
+                    if throttle_seconds:
+                        time.sleep(throttle_seconds)
+                moved[(source_shard, target_shard)] = moved.get((source_shard, target_shard), 0) + 1
+        finally:
+            if disposable:
+                engine.dispose()
+    return moved
+
+@api.cli.command('archive-conversations')
+@click.option('--days', default=app_config.ARCHIVE_AFTER_DAYS, show_default=True, help='归档超过N天未更新的对话')
+@click.option('--batch-size', default=app_config.ARCHIVE_BATCH_SIZE, show_default=True, help='本次最多归档的对话数')
+@click.option('--throttle', default=app_config.ARCHIVE_THROTTLE_SECONDS, show_default=True, help='每个对话之间的休眠秒数')
+def archive_conversations_command(days, batch_size, throttle):
+    """将冷对话归档到压缩存储"""
+    archived = archive_cold_conversations(days, batch_size, throttle)
+    click.echo(f'✅ 归档完成: {archived} 个对话')
+
+@api.cli.command('train-content-dictionary')
+@click.option('--samples', default=5000, show_default=True, help='用于训练的最近AI回复数量')
+@click.option('--size', default=32768, show_default=True, help='字典大小（字节）')
+def train_content_dictionary(samples, size):
+    """基于历史AI回复训练消息压缩字典，之后写入的长消息使用新字典"""
+    # 分片模式下从每个分片取等量的最近回复
+    per_shard = math.ceil(samples / len(shard_keys()))
+    corpus = []
+    for _ in each_shard():
+        rows = (db.session.query(Message.content)
+                .filter(Message.sender_type == 'ai')
+                .order_by(Message.id.desc())
+                .limit(per_shard)
+                .all())
+        corpus.extend(content for (content,) in rows)
+    if not corpus:
+        click.echo('⚠️ 没有可用于训练的AI回复')
+        return
+    
+    codec, data = train_dictionary(corpus, size)
+    dict_id = content_codec.save_dictionary(codec, data)
+    click.echo(f'✅ 字典训练完成: {len(corpus)} 条样本, {len(data)} 字节, ID {dict_id:08x}')
+
+@api.cli.command('compress-messages')
+@click.option('--batch-size', default=500, show_default=True, help='每批处理的消息数量')
+@click.option('--recompress', is_flag=True, help='同时用当前字典重新压缩已压缩的消息')
+def compress_messages(batch_size, recompress):
+    """按当前压缩配置重写历史长消息"""
+    if db.engine.dialect.name != 'sqlite':
+        click.echo('⚠️ 只有SQLite上的消息压缩存储，PostgreSQL由TOAST自动压缩长文本')
+        return
+    condition = "typeof(content) = 'text' AND length(CAST(content AS BLOB)) >= :threshold"
+    if recompress:
+        condition = f"({condition}) OR typeof(content) = 'blob'"
+    
+    rewritten = 0
+    for _ in each_shard():
+        last_id = 0
+        while True:
+            ids = [row.id for row in db.session.execute(
+                text(f'SELECT id FROM messages WHERE id > :last_id AND ({condition}) ORDER BY id LIMIT :limit'),
+                {'last_id': last_id, 'threshold': content_codec.threshold, 'limit': batch_size})]
+            if not ids:
+                break
+            
+            rows = db.session.query(Message.id, Message.content).filter(Message.id.in_(ids)).all()
+            # 按主键批量更新，写入时经CompressedText重新编码
+            db.session.execute(update(Message), [{'id': message_id, 'content': content} for message_id, content in rows])
+            db.session.commit()
+            
+            last_id = ids[-1]
+            rewritten += len(ids)
+            click.echo(f'已重写 {rewritten} 条消息')
+    
+    click.echo(f'✅ 消息压缩完成: {rewritten} 条')
+
+@api.cli.command('backfill-display-content')
+@click.option('--batch-size', default=500, show_default=True, help='每批处理的消息数量')
+def backfill_display_content(batch_size):
+    """为历史AI消息生成展示文本"""
+    # 回填后的消息不再满足查询条件，每次取下一批即可
+    processed = 0
+    for _ in each_shard():
+        while True:
+            batch = (db.session.query(Message.id, Message.content)
+                     .filter(Message.sender_type == 'ai', Message.display_content.is_(None))
+                     .order_by(Message.id)
+                     .limit(batch_size)
+                     .all())
+            if not batch:
+                break
+            
+            db.session.execute(update(Message), [
+                {'id': message_id, 'display_content': clean_ai_text(content)} for message_id, content in batch
+            ])
+            db.session.commit()
+            processed += len(batch)
+            click.echo(f'已处理 {processed} 条消息')
+    
+    click.echo(f'✅ 展示文本回填完成: {processed} 条消息')
+
+@api.cli.command('backfill-attractions')
+@click.option('--batch-size', default=500, show_default=True, help='每批处理的消息数量')
+def backfill_attractions(batch_size):
+    """为历史AI消息批量提取并持久化景点信息"""
+    # 只处理尚未完成提取的AI消息，按ID游标分批，避免一次性加载全部历史
+    processed = 0
+    inserted = 0
+    
+    # 批量回填时关闭逐段调试日志
+    previous_level = app.logger.level
+    app.logger.setLevel(logging.WARNING)
+    try:
+        for _ in each_shard():
+            last_id = 0
+            while True:
+                batch = (db.session.query(Message.id, Message.content)
+                         .filter(Message.sender_type == 'ai',
+                                 Message.id > last_id,
+                                 or_(Message.attractions_status.is_(None),
+                                     Message.attractions_status != 'ready'))
+                         .order_by(Message.id)
+                         .limit(batch_size)
+                         .all())
+                if not batch:
+                    break
+                
+                rows = []
+                for message_id, content in batch:
+                    rows.extend(Attraction.build_rows(message_id, dify_service.extract_attractions(content)))
+                bulk_insert(Attraction, rows)
+                (Message.query
+                 .filter(Message.id.in_([message_id for message_id, _ in batch]))
+                 .update({'attractions_status': 'ready'}, synchronize_session=False))
+                db.session.commit()
+                
+                last_id = batch[-1].id
+                processed += len(batch)
+                inserted += len(rows)
+                click.echo(f'已处理 {processed} 条消息，写入 {inserted} 个景点')
+    finally:
+        app.logger.setLevel(previous_level)
+    
+    click.echo(f'✅ 景点回填完成: 消息 {processed} 条，景点 {inserted} 个')
+
+@api.cli.command('rebalance-shards')
+@click.option('--dry-run', is_flag=True, help='只统计需要移动的对话，不修改数据')
+@click.option('--throttle', default=0.0, show_default=True, help='每个对话之间的休眠秒数')
+def rebalance_shards_command(dry_run, throttle):
+    """按当前 SHARD_COUNT 把对话移动到所属分片（应在停止服务后执行）"""
+    create_schema()
+    moved = rebalance_shards(dry_run, throttle)
+    for (source, target), count in sorted(moved.items(), key=lambda item: (str(item[0][0]), str(item[0][1]))):
+        click.echo(f'{source or "主库"} -> {target or "主库"}: {count} 个对话')
+    click.echo(f'✅ {"需要移动" if dry_run else "已移动"} {sum(moved.values())} 个对话')
+
+# 应用工厂
+# 预热时解析的示例回复，覆盖景点提取的各个分支
+_WARMUP_REPLY = '为您推荐：\n1. 八达岭长城\n地址：北京市延庆区八达岭镇\n经纬度：40.3587,116.0154\n2. 颐和园\n位于北京市海淀区'
+
+def create_app(config_overrides=None):
+    """应用工厂 - 创建Flask应用并绑定数据库、CORS、路由和命令"""
+    app = Flask(__name__)
+    
+    # 应用配置 - 使用统一配置管理
+    app.config['SECRET_KEY'] = app_config.SECRET_KEY
+    app.config['SQLALCHEMY_DATABASE_URI'] = app_config.SQLALCHEMY_DATABASE_URI
+    app.config['SQLALCHEMY_BINDS'] = app_config.SQLALCHEMY_BINDS
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = app_config.SQLALCHEMY_TRACK_MODIFICATIONS
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = app_config.SQLALCHEMY_ENGINE_OPTIONS
+    app.config['SHARD_COUNT'] = app_config.SHARD_COUNT
+    app.config['SHARD_DIRECTORY'] = app_config.SHARD_DIRECTORY
+    if config_overrides:
+        app.config.update(config_overrides)
+    
+    # 分片库作为额外的bind，由ShardRoutingSession按对话选择
+    shards = shard_binds(app.config['SHARD_COUNT'], app.config['SHARD_DIRECTORY'], app.config['SQLALCHEMY_ENGINE_OPTIONS'])
+    app.config['SQLALCHEMY_BINDS'] = {**app.config['SQLALCHEMY_BINDS'], **shards}
+    
+    # 配置CORS - 使用统一配置管理
+    CORS(app, origins=app_config.CORS_ORIGINS)
+    
+    # 创建目录
+    os.makedirs('database', exist_ok=True)
+    os.makedirs(app_config.LOG_DIRECTORY, exist_ok=True)
+    if app.config['SHARD_COUNT'] > 1:
+        os.makedirs(os.path.dirname(shard_database_path(app.config['SHARD_DIRECTORY'], 0)), exist_ok=True)
+    
+    db.init_app(app)
+    # init_app为每个bind创建的metadata是所有应用共用的；分片库的表来自默认metadata，
+    # 移除这些空metadata，其他应用的create_all/drop_all不会去找分片bind
+    for shard in shards:
+        db.metadatas.pop(shard, None)
+    with app.app_context():
+        for engine in db.engines.values():
+            if engine.dialect.name == 'postgresql':
+                watch_idle_connections(engine)
+    app.register_blueprint(api)
+    return app
+
+def warm_shared_state():
+    """在master进程预加载只读数据（gunicorn preload_app），fork后各worker以写时复制方式共享"""
+    content_codec.preload()
+    
+    # 景点提取用到的正则编译后保存在re模块缓存中
+    previous_level = app.logger.level
+    app.logger.setLevel(logging.WARNING)
+    try:
+        dify_service.extract_attractions(_WARMUP_REPLY)
+    finally:
+        app.logger.setLevel(previous_level)
+    
+    # 预加载的对象移出GC跟踪，避免worker内的垃圾回收写入这些页面触发复制
+    gc.freeze()
+    app.logger.info('🧊 只读数据已预加载，worker共享')
+
+def init_worker():
+    """fork后在worker进程内重建不能跨进程共享的资源（gunicorn post_fork调用）"""
+    # 丢弃从master继承的数据库连接；close=False不关闭master持有的socket
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+    
+    attraction_pool.reset()
+    turn_pipeline.reset()
+    dify_service.scheduler.reset()
+    event_broker.reset()
+    
+    # 文件日志句柄在worker内首次写入时重新打开，避免多个进程共用同一文件偏移
+    for handler in app.logger.handlers:
+        if isinstance(handler, logging.FileHandler):
+            handler.close()
+    
+    # Dify连接池、写后队列和限流状态连接按进程ID检测fork，在worker内首次使用时重建
+
+# 模块级应用实例，供gunicorn（app:app）、flask命令和后台任务使用
+app = create_app()
+
 if __name__ == '__main__':
     # 设置日志
     setup_logging()
@@ -762,13 +2576,8 @@ if __name__ == '__main__':
     # 初始化数据库
     init_db()
     
-    # 测试Dify连接（可选）
-    app.logger.info('🔍 测试Dify API连接...')
-    connection_test = dify_service.test_connection()
-    if connection_test['success']:
-        app.logger.info(f'✅ {connection_test["message"]}')
-    else:
-        app.logger.warning(f'⚠️ {connection_test["message"]}')
+    # 启动后台任务（包括后台探测Dify连接）
+    start_background_jobs()
     
     # 使用统一配置启动应用
     app.logger.info('🚀 AI旅行助手API服务启动成功')
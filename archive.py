@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+AI旅行助手 - 冷数据归档模块
+冷对话的消息和景点压缩移入归档库，访问时恢复；对话的批量写入和删除
+"""
+
+import fcntl
+import io
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import delete, insert, inspect, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
+
+from config import app_config
+from conversation_locks import conversation_locks
+from models import Attraction, Conversation, ConversationArchive, ConversationEvent, Message, db
+from sharding import each_shard, group_by_shard, use_shard
+from text_cleaning import clean_ai_text
+
+logger = logging.getLogger(f'app.{__name__}')
+
+def _serialize_attraction(attraction):
+    return {
+        'position': attraction.position,
+        'name': attraction.name,
+        'address': attraction.address,
+        'latitude': attraction.latitude,
+        'longitude': attraction.longitude,
+        'image': attraction.image,
+        'type': attraction.type,
+        'created_at': attraction.created_at.isoformat() if attraction.created_at else None
+    }
+
+# COPY文本格式的转义：反斜杠、制表符和换行
+_COPY_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+def _copy_field(value):
+    if value is None:
+        return '\\N'
+    if isinstance(value, datetime):
+        return value.isoformat(' ')
+    return str(value).translate(_COPY_ESCAPES)
+
+def _column_default(column):
+    """列的Python默认值（COPY不会执行ORM和Core的默认值）"""
+    default = column.default
+    if default is None or default.is_sequence:
+        return None
+    return default.arg(None) if default.is_callable else default.arg
+
+def bulk_insert(model, rows):
+    """
+    批量写入同一张表的多行数据（回填、归档恢复等），不构造ORM对象，与当前会话在同一事务中执行
+    
+    PostgreSQL（psycopg2）上达到 DB_BULK_COPY_THRESHOLD 行时使用COPY，否则为一次executemany
+    """
+    if not rows:
+        return
+    mapper = inspect(model)
+    dialect = db.session.get_bind(mapper=mapper).dialect
+    if dialect.driver != 'psycopg2' or len(rows) < app_config.DB_BULK_COPY_THRESHOLD:
+        db.session.execute(insert(model), rows)
+        return
+    
+    names = set().union(*rows)
+    columns = [column for column in model.__table__.columns
+               if column.name in names or (column.default is not None and not column.primary_key)]
+    processors = [column.type.bind_processor(dialect) for column in columns]
+    buffer = io.StringIO()
+    for row in rows:
+        fields = []
+        for column, process in zip(columns, processors):
+            value = row[column.name] if column.name in row else _column_default(column)
+            fields.append(_copy_field(process(value) if process else value))
+        buffer.write('\t'.join(fields) + '\n')
+    buffer.seek(0)
+    
+    preparer = dialect.identifier_preparer
+    column_list = ', '.join(preparer.quote(column.name) for column in columns)
+    cursor = db.session.connection(bind_arguments={'mapper': mapper}).connection.cursor()
+    try:
+        cursor.copy_expert(f'COPY {preparer.format_table(model.__table__)} ({column_list}) FROM STDIN', buffer)
+    finally:
+        cursor.close()
+
+def _delete_hot_messages(conversation_ids):
+    """按集合删除对话的景点和消息，不把行加载进会话"""
+    message_ids = select(Message.id).where(Message.conversation_id.in_(conversation_ids)).scalar_subquery()
+    db.session.execute(delete(Attraction).where(Attraction.message_id.in_(message_ids)),
+                       execution_options={'synchronize_session': False})
+    db.session.execute(delete(Message).where(Message.conversation_id.in_(conversation_ids)),
+                       execution_options={'synchronize_session': False})
+
+def delete_conversations(conversation_ids, user_id=None):
+    """
+    按集合删除对话及其消息、景点、归档和事件，内存占用与消息数无关
+    
+    Args:
+        user_id: 给出时只删除属于该用户的对话
+    
+    Returns:
+        list: 实际删除的对话ID
+    """
+    deleted = []
+    # 分片模式下每个分片一个事务
+    for shard, shard_ids in group_by_shard(conversation_ids).items():
+        use_shard(shard)
+        query = db.session.query(Conversation.id).filter(Conversation.id.in_(shard_ids))
+        if user_id is not None:
+            query = query.filter(Conversation.user_id == user_id)
+        existing = [conversation_id for (conversation_id,) in query]
+        if not existing:
+            continue
+        
+        _delete_hot_messages(existing)
+        for statement in (delete(ConversationEvent).where(ConversationEvent.conversation_id.in_(existing)),
+                          delete(ConversationArchive).where(ConversationArchive.conversation_id.in_(existing)),
+                          delete(Conversation).where(Conversation.id.in_(existing))):
+            db.session.execute(statement, execution_options={'synchronize_session': False})
+        db.session.commit()
+        conversation_locks.discard(existing)
+        deleted.extend(existing)
+    return deleted
+
+def archive_conversation(conversation):
+    """将对话的消息和景点压缩写入归档库，并从热库删除"""
+    messages = (Message.query
+                .options(joinedload(Message.attractions))
+                .filter_by(conversation_id=conversation.id)
+                .order_by(Message.id)
+                .all())
+    records = [{
+        'id': msg.id,
+        'content': msg.content,
+        'display_content': msg.display_content,
+        'sender_type': msg.sender_type,
+        'attractions_status': msg.attractions_status,
+        'created_at': msg.created_at.isoformat() if msg.created_at else None,
+        'attractions': [_serialize_attraction(a) for a in msg.attractions]
+    } for msg in messages]
+    codec, payload = ConversationArchive.pack(records)
+    
+    # 先写归档库再删热库；中途失败时下次归档会覆盖同一条归档记录
+    db.session.merge(ConversationArchive(
+        conversation_id=conversation.id,
+        message_count=len(records),
+        codec=codec,
+        payload=payload,
+        archived_at=datetime.utcnow()
+    ))
+    db.session.commit()
+    
+    _delete_hot_messages([conversation.id])
+    # 直接更新，避免onupdate刷新updated_at
+    (Conversation.query.filter_by(id=conversation.id)
+     .update({'archived_at': datetime.utcnow(), 'updated_at': Conversation.updated_at}, synchronize_session=False))
+    db.session.commit()
+    return len(records), len(payload)
+
+def restore_conversation(conversation):
+    """访问归档对话时将其消息恢复到热库"""
+    if conversation.archived_at is None:
+        return conversation
+    
+    archive = db.session.get(ConversationArchive, conversation.id)
+    records = archive.unpack() if archive else []
+    
+    # 原消息ID若已被新消息占用（SQLite会复用最大rowid），则重新分配ID
+    original_ids = [record['id'] for record in records]
+    keep_ids = not original_ids or not db.session.query(Message.id).filter(Message.id.in_(original_ids)).first()
+    
+    try:
+        message_rows = []
+        for record in records:
+            content = record['content']
+            display_content = record.get('display_content')
+            if display_content is None and record['sender_type'] == 'ai':
+                display_content = clean_ai_text(content)  # 与写入时的fill_display_content一致
+            message_rows.append({
+                'conversation_id': conversation.id,
+                'content': content,
+                'display_content': display_content,
+                'sender_type': record['sender_type'],
+                'attractions_status': record.get('attractions_status'),
+                'turn_id': None,
+                'created_at': datetime.fromisoformat(record['created_at']) if record.get('created_at') else datetime.utcnow()
+            })
+        # 消息和景点按批写入，长对话恢复不再逐条flush
+        if keep_ids:
+            for row, message_id in zip(message_rows, original_ids):
+                row['id'] = message_id
+            bulk_insert(Message, message_rows)
+            message_ids = original_ids
+        else:
+            message_ids = db.session.execute(
+                insert(Message).returning(Message.id, sort_by_parameter_order=True), message_rows
+            ).scalars().all() if message_rows else []
+        bulk_insert(Attraction, [
+            {**item, 'message_id': message_id,
+             'created_at': datetime.fromisoformat(item['created_at']) if item.get('created_at') else datetime.utcnow()}
+            for message_id, record in zip(message_ids, records) for item in record.get('attractions', [])
+        ])
+        (Conversation.query.filter_by(id=conversation.id)
+         .update({'archived_at': None, 'updated_at': Conversation.updated_at}, synchronize_session=False))
+        db.session.commit()
+    except IntegrityError:
+        # 并发请求已完成恢复
+        db.session.rollback()
+        db.session.refresh(conversation)
+        return conversation
+    
+    if archive is not None:
+        db.session.delete(archive)
+        db.session.commit()
+    
+    db.session.refresh(conversation)
+    logger.info(f'📦 恢复归档对话: {conversation.id}, 消息 {len(records)} 条')
+    return conversation
+
+def archive_cold_conversations(days, limit, throttle_seconds=0):
+    """归档超过N天未更新的对话，每个对话之间休眠以限制对在线请求的影响"""
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    archived = 0
+    for _ in each_shard():
+        if archived >= limit:
+            break
+        candidates = (db.session.query(Conversation.id)
+                      .filter(Conversation.archived_at.is_(None), Conversation.updated_at < cutoff)
+                      .order_by(Conversation.updated_at)
+                      .limit(limit - archived)
+                      .all())
+        
+        for (conversation_id,) in candidates:
+            conversation = db.session.get(Conversation, conversation_id)
+            if conversation is None or conversation.archived_at is not None or conversation.updated_at >= cutoff:
+                continue
+            count, size = archive_conversation(conversation)
+            archived += 1
+            logger.info(f'📦 归档对话: {conversation_id}, 消息 {count} 条, 压缩后 {size} 字节')
+            if throttle_seconds:
+                time.sleep(throttle_seconds)
+    return archived
+
+class ArchiveWorker(threading.Thread):
+    """后台归档线程 - 通过文件锁保证多个worker进程中同一时间只有一个在归档"""
+    
+    def __init__(self, interval, lock_path, flask_app=None):
+        super().__init__(name='archive-worker', daemon=True)
+        self.interval = interval
+        self.lock_path = lock_path
+        self.flask_app = flask_app or current_app._get_current_object()
+        self._stop_event = threading.Event()
+    
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                with open(self.lock_path, 'w') as lock_file:
+                    try:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        continue
+                    with self.flask_app.app_context():
+                        archived = archive_cold_conversations(
+                            app_config.ARCHIVE_AFTER_DAYS,
+                            app_config.ARCHIVE_BATCH_SIZE,
+                            app_config.ARCHIVE_THROTTLE_SECONDS
+                        )
+                        db.session.remove()
+                    if archived:
+                        logger.info(f'📦 本轮归档 {archived} 个对话')
+            except Exception as e:
+                logger.error(f'💥 后台归档失败: {str(e)}')
+    
+    def stop(self):
+        self._stop_event.set()
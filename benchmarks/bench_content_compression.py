@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+AI旅行助手 - 消息内容压缩基准
+对比不同压缩方式的存储大小、编解码吞吐，以及经SQLite读写消息的吞吐
+
+用法:
+    python benchmarks/bench_content_compression.py --messages 5000
+    python benchmarks/bench_content_compression.py --from-db database/travel.db
+"""
+
+import argparse
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from content_codec import CODEC_ZLIB, CODEC_ZSTD, ContentCodec, train_dictionary, train_zlib_dictionary, zstandard
+
+CITIES = ['成都', '北京', '上海', '杭州', '西安', '重庆', '厦门', '桂林']
+PLACES = ['宽窄巷子', '大熊猫繁育研究基地', '故宫博物院', '八达岭长城', '外滩', '西湖', '兵马俑', '洪崖洞', '鼓浪屿', '漓江']
+BOILERPLATE = [
+    '以下是为您精心规划的行程安排，您可以根据实际情况灵活调整：',
+    '温馨提示：节假日景区人流量较大，建议提前在官方渠道预约门票。',
+    '交通建议：市区景点之间推荐乘坐地铁或打车，避开早晚高峰。',
+    '如果您需要更详细的住宿或美食推荐，欢迎随时告诉我！祝您旅途愉快！',
+]
+
+def synthetic_reply(rng):
+    """生成与线上AI行程回复结构相近的多段文本"""
+    city = rng.choice(CITIES)
+    lines = [BOILERPLATE[0]]
+    for day in range(1, rng.randint(3, 6)):
+        lines.append(f'\n第{day}天：')
+        for n in range(1, 4):
+            place = rng.choice(PLACES)
+            lines.append(f'{n}. {place}\n地址：{city}市某某区{place}路{rng.randint(1, 300)}号\n'
+                         f'经纬度：{rng.uniform(20, 40):.6f},{rng.uniform(100, 120):.6f}\n'
+                         f'推荐理由：{place}是{city}最具代表性的景点之一，建议游玩{rng.randint(1, 4)}小时。')
+    lines.extend(BOILERPLATE[1:])
+    return '\n'.join(lines)
+
+def load_corpus(args):
+    if args.from_db:
+        conn = sqlite3.connect(args.from_db)
+        from content_codec import sqlite_content_text
+        conn.create_function('content_text', 1, sqlite_content_text)
+        rows = conn.execute(
+            "SELECT content_text(content) FROM messages WHERE sender_type = 'ai' ORDER BY id DESC LIMIT ?",
+            (args.messages,)).fetchall()
+        return [row[0] for row in rows]
+    rng = random.Random(42)
+    return [synthetic_reply(rng) for _ in range(args.messages)]
+
+def measure_codec(name, codec, corpus):
+    raw_bytes = sum(len(text.encode('utf-8')) for text in corpus)
+    
+    started = time.perf_counter()
+    encoded = [codec.encode(text) for text in corpus]
+    encode_seconds = time.perf_counter() - started
+    
+    started = time.perf_counter()
+    for value in encoded:
+        codec.decode(value)
+    decode_seconds = time.perf_counter() - started
+    
+    stored_bytes = sum(len(value) if isinstance(value, bytes) else len(value.encode('utf-8')) for value in encoded)
+    return {
+        'name': name,
+        'ratio': stored_bytes / raw_bytes,
+        'stored_mb': stored_bytes / 1024 / 1024,
+        'encode_mbps': raw_bytes / 1024 / 1024 / encode_seconds,
+        'decode_mbps': raw_bytes / 1024 / 1024 / decode_seconds,
+    }
+
+def measure_sqlite(codec, corpus, workdir):
+    """模拟messages表写入和按主键读取的吞吐"""
+    db_path = os.path.join(workdir, f'bench_{time.time_ns()}.db')
+    conn = sqlite3.connect(db_path)
+    conn.execute('CREATE TABLE messages (id INTEGER PRIMARY KEY, content TEXT NOT NULL)')
+    
+    started = time.perf_counter()
+    for i, text in enumerate(corpus):
+        conn.execute('INSERT INTO messages (id, content) VALUES (?, ?)', (i + 1, codec.encode(text)))
+        if i % 100 == 99:
+            conn.commit()
+    conn.commit()
+    write_rate = len(corpus) / (time.perf_counter() - started)
+    
+    ids = list(range(1, len(corpus) + 1))
+    random.Random(1).shuffle(ids)
+    started = time.perf_counter()
+    for message_id in ids:
+        codec.decode(conn.execute('SELECT content FROM messages WHERE id = ?', (message_id,)).fetchone()[0])
+    read_rate = len(corpus) / (time.perf_counter() - started)
+    conn.close()
+    
+    return write_rate, read_rate, os.path.getsize(db_path) / 1024 / 1024
+
+def main():
+    parser = argparse.ArgumentParser(description='消息内容压缩基准')
+    parser.add_argument('--messages', type=int, default=5000, help='消息数量')
+    parser.add_argument('--from-db', help='从已有数据库读取AI回复作为语料')
+    parser.add_argument('--threshold', type=int, default=1024, help='压缩阈值（字节）')
+    args = parser.parse_args()
+    
+    corpus = load_corpus(args)
+    if not corpus:
+        print('没有可用语料')
+        return 1
+    
+    # 训练集与测试集分开，避免字典直接“记住”测试样本
+    split = max(len(corpus) // 5, 1)
+    training, testing = corpus[:split], corpus[split:] or corpus
+    workdir = tempfile.mkdtemp(prefix='bench_codec_')
+    
+    try:
+        variants = [('不压缩', ContentCodec(args.threshold, workdir, enabled=False))]
+        
+        zlib_codec = ContentCodec(args.threshold, os.path.join(workdir, 'zlib'))
+        zlib_codec._active = (CODEC_ZLIB, 0)
+        variants.append(('zlib', zlib_codec))
+        
+        zlib_dict_codec = ContentCodec(args.threshold, os.path.join(workdir, 'zlib_dict'))
+        zlib_dict_codec.save_dictionary(CODEC_ZLIB, train_zlib_dictionary(training))
+        variants.append(('zlib+字典', zlib_dict_codec))
+        
+        if zstandard is not None:
+            zstd_codec = ContentCodec(args.threshold, os.path.join(workdir, 'zstd'))
+            zstd_codec._active = (CODEC_ZSTD, 0)
+            variants.append(('zstd', zstd_codec))
+            
+            codec_type, data = train_dictionary(training)
+            if codec_type == CODEC_ZSTD:
+                zstd_dict_codec = ContentCodec(args.threshold, os.path.join(workdir, 'zstd_dict'))
+                zstd_dict_codec.save_dictionary(CODEC_ZSTD, data)
+                variants.append(('zstd+字典', zstd_dict_codec))
+        
+        raw_mb = sum(len(text.encode('utf-8')) for text in testing) / 1024 / 1024
+        print(f'语料: {len(testing)} 条回复, 原始 {raw_mb:.2f}MB, 平均 {raw_mb * 1024 * 1024 / len(testing):.0f} 字节')
+        print(f'{"方式":<10}{"压缩率":>8}{"存储MB":>9}{"编码MB/s":>10}{"解码MB/s":>10}{"写入条/s":>10}{"读取条/s":>10}{"库文件MB":>10}')
+        for name, codec in variants:
+            result = measure_codec(name, codec, testing)
+            write_rate, read_rate, file_mb = measure_sqlite(codec, testing, workdir)
+            print(f'{name:<10}{result["ratio"]:>8.1%}{result["stored_mb"]:>9.2f}{result["encode_mbps"]:>10.1f}'
+                  f'{result["decode_mbps"]:>10.1f}{write_rate:>10.0f}{read_rate:>10.0f}{file_mb:>10.2f}')
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+AI旅行助手 - 景点提取与文本清理微基准
+在多KB的合成行程回复和会触发正则回溯的对抗输入上测量 extract_attractions 和 clean_ai_text 的吞吐，
+与基线文件对比，任一用例吞吐下降超过阈值时以非零状态退出，可直接用于CI
+每轮交替测量固定参照负载和被测函数，取各轮相对吞吐的中位数比较，以降低机器速度差异和共享机器噪声的影响
+
+用法:
+    python benchmarks/bench_extraction.py                      # 与基线对比（默认允许下降25%）
+    python benchmarks/bench_extraction.py --threshold 0.15
+    python benchmarks/bench_extraction.py --update-baseline    # 在CI机器上重新记录基线
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import time
+
+os.environ.setdefault('DIFY_API_KEY', 'app-bench')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from corpus import adversarial_replies, reply_corpus, synthetic_reply
+from app import app, dify_service
+from text_cleaning import clean_ai_text
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines', 'extraction.json')
+
+def build_cases(adversarial_size):
+    rng = random.Random(7)
+    cases = {
+        'replies': reply_corpus(200),
+        'long_replies': [synthetic_reply(rng, days=12) for _ in range(50)],
+    }
+    for name, text in adversarial_replies(adversarial_size).items():
+        cases[f'adversarial/{name}'] = [text]
+    return cases
+
+def run_round(func, texts, min_seconds):
+    """至少运行min_seconds，返回 (每秒调用次数, 单次最长耗时)"""
+    calls = 0
+    slowest_call = 0.0
+    start = time.perf_counter()
+    while True:
+        for text in texts:
+            call_start = time.perf_counter()
+            func(text)
+            slowest_call = max(slowest_call, time.perf_counter() - call_start)
+        calls += len(texts)
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_seconds:
+            return calls / elapsed, slowest_call
+
+def measure(func, texts, reference, rounds, min_round_seconds=0.2):
+    """每轮先后测量参照负载和被测函数，返回 (最快一轮的吞吐, 各轮相对吞吐的中位数, 单次最长耗时)"""
+    best = 0.0
+    ratios = []
+    slowest_call = 0.0
+    for _ in range(rounds):
+        reference_ops, _ = run_round(calibration, reference, min_round_seconds / 4)
+        ops, slowest = run_round(func, texts, min_round_seconds)
+        best = max(best, ops)
+        ratios.append(ops / reference_ops)
+        slowest_call = max(slowest_call, slowest)
+    return best, statistics.median(ratios), slowest_call
+
+def calibration(text):
+    """固定的参照负载，用于抵消机器速度和负载波动"""
+    return sum(len(line.strip()) for line in text.split('\n')) + text.count('。')
+
+def main():
+    parser = argparse.ArgumentParser(description='景点提取与文本清理微基准')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--threshold', type=float, default=0.25, help='允许的吞吐下降比例')
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--adversarial-size', type=int, default=4000, help='对抗输入的字符数')
+    parser.add_argument('--max-call-seconds', type=float, default=None, help='单次调用耗时上限，超出即失败')
+    parser.add_argument('--update-baseline', action='store_true')
+    args = parser.parse_args()
+
+    # 只测量解析本身，逐段调试日志不输出
+    app.logger.setLevel(logging.WARNING)
+
+    functions = {'extract': dify_service.extract_attractions, 'clean': clean_ai_text}
+    reference = reply_corpus(20)
+    results = {}
+    for case, texts in build_cases(args.adversarial_size).items():
+        for func_name, func in functions.items():
+            ops, relative, slowest = measure(func, texts, reference, args.rounds)
+            results[f'{func_name}:{case}'] = {
+                'ops_per_sec': round(ops, 2),
+                'relative': round(relative, 6),
+                'max_call_ms': round(slowest * 1000, 2)
+            }
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f).get('results', {})
+
+    failures = []
+    print(f'{"用例":<44}{"ops/s":>12}{"基线":>12}{"变化":>9}{"最长(ms)":>11}')
+    for name, row in results.items():
+        base = baseline.get(name, {}).get('ops_per_sec')
+        base_relative = baseline.get(name, {}).get('relative')
+        change = (row['relative'] - base_relative) / base_relative if base_relative else None
+        print(f'{name:<44}{row["ops_per_sec"]:>12.1f}{base or 0:>12.1f}'
+              f'{"" if change is None else f"{change:+.1%}":>9}{row["max_call_ms"]:>11.1f}')
+        if change is not None and change < -args.threshold:
+            failures.append(f'{name} 吞吐下降 {-change:.1%}')
+        if args.max_call_seconds is not None and row['max_call_ms'] > args.max_call_seconds * 1000:
+            failures.append(f'{name} 单次耗时 {row["max_call_ms"]:.0f}ms 超出上限')
+
+    if args.update_baseline:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump({'adversarial_size': args.adversarial_size, 'results': results}, f, ensure_ascii=False, indent=2)
+        print(f'✅ 基线已更新: {args.baseline}')
+        return
+
+    if failures:
+        print('\n❌ 性能回退:')
+        for failure in failures:
+            print(f'   - {failure}')
+        sys.exit(1)
+    print('\n✅ 未发现性能回退')
+
+if __name__ == '__main__':
+    main()
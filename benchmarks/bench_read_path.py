@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+AI旅行助手 - 列表接口读取路径基准
+在包含数千条消息（每条AI回复带景点）的合成对话上，对比原ORM读取路径（加载对象后to_dict）
+与列元组读取路径（serialize_message_rows / list_conversations）的吞吐和单次调用的内存峰值
+
+用法:
+    python benchmarks/bench_read_path.py --messages 5000 --conversations 500
+    python benchmarks/bench_read_path.py --min-speedup 1.5    # 提速不足时以非零状态退出
+"""
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from corpus import synthetic_question, synthetic_reply
+
+def build_corpus(app_module, messages, conversations, attractions_per_reply=3, seed=42):
+    """第一个对话放入全部消息，其余为只有一问一答的短对话；经ORM的列类型写入，长回复按线上方式压缩"""
+    from sqlalchemy import insert
+    from text_cleaning import clean_ai_text
+
+    db = app_module.db
+    rng = random.Random(seed)
+    now = datetime.utcnow()
+    db.session.execute(insert(app_module.Conversation), [
+        {'id': i + 1, 'title': f'对话{i + 1}', 'created_at': now, 'updated_at': now} for i in range(conversations)
+    ])
+
+    message_rows, attraction_rows = [], []
+    def add_message(conversation_id, sender_type):
+        message_id = len(message_rows) + 1
+        if sender_type == 'ai':
+            content = synthetic_reply(rng)
+            message_rows.append({'id': message_id, 'conversation_id': conversation_id, 'content': content,
+                                 'display_content': clean_ai_text(content), 'sender_type': 'ai',
+                                 'attractions_status': 'ready', 'created_at': now})
+            for position in range(attractions_per_reply):
+                attraction_rows.append({'message_id': message_id, 'position': position, 'name': f'景点{position}',
+                                        'address': '某某区某某路1号', 'latitude': 30.0 + position,
+                                        'longitude': 104.0 + position, 'type': '景点', 'created_at': now})
+        else:
+            message_rows.append({'id': message_id, 'conversation_id': conversation_id,
+                                 'content': synthetic_question(rng), 'sender_type': 'user', 'created_at': now})
+
+    for i in range(messages):
+        add_message(1, 'ai' if i % 2 else 'user')
+    for conversation_id in range(2, conversations + 1):
+        add_message(conversation_id, 'user')
+        add_message(conversation_id, 'ai')
+    db.session.execute(insert(app_module.Message), message_rows)
+    db.session.execute(insert(app_module.Attraction), attraction_rows)
+    db.session.commit()
+
+def orm_messages(app_module, conversation_id, limit):
+    """原读取路径：消息与景点经joinedload构造为ORM对象后逐个to_dict"""
+    from sqlalchemy.orm import joinedload
+
+    Message = app_module.Message
+    messages = (Message.query.options(joinedload(Message.attractions))
+                .filter(Message.conversation_id == conversation_id)
+                .order_by(Message.id.desc()).limit(limit + 1).all())
+    return [message.to_dict(with_attractions=True) for message in reversed(messages[:limit])]
+
+def orm_conversations(app_module):
+    """原读取路径：加载用户的全部对话对象，逐个统计消息数"""
+    Conversation = app_module.Conversation
+    conversations = (Conversation.query.filter_by(user_id=app_module.dify_config.DEFAULT_USER_ID)
+                     .order_by(Conversation.updated_at.desc()).all())
+    return [conversation.to_dict() for conversation in conversations]
+
+def measure(func, min_seconds):
+    """返回 (每秒调用次数, 单次调用的内存峰值KB)；每次调用后清空session，与请求结束时一致"""
+    db = sys.modules['app'].db
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1] / 1024
+    tracemalloc.stop()
+    db.session.remove()
+
+    calls = 0
+    started = time.perf_counter()
+    while True:
+        func()
+        db.session.remove()
+        calls += 1
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_seconds:
+            return calls / elapsed, peak
+
+def main():
+    parser = argparse.ArgumentParser(description='列表接口读取路径基准')
+    parser.add_argument('--messages', type=int, default=5000, help='大对话中的消息数量')
+    parser.add_argument('--conversations', type=int, default=500, help='对话数量')
+    parser.add_argument('--seconds', type=float, default=2.0, help='每个用例的测量时长')
+    parser.add_argument('--min-speedup', type=float, default=None, help='要求的最低吞吐提升倍数，不足时失败')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench_read_path_')
+    os.environ['DATABASE_URL'] = f'sqlite:///{os.path.join(workdir, "travel.db")}'
+    os.environ['ARCHIVE_DATABASE_URL'] = f'sqlite:///{os.path.join(workdir, "archive.db")}'
+    os.environ.setdefault('DIFY_API_KEY', 'app-benchmark')
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    import app as app_module
+    app_module.init_db()
+
+    failures = []
+    try:
+        with app_module.app.app_context():
+            started = time.perf_counter()
+            build_corpus(app_module, args.messages, args.conversations)
+            print(f'语料生成: {args.conversations} 个对话, 大对话 {args.messages} 条消息, '
+                  f'耗时 {time.perf_counter() - started:.1f}s')
+
+            page_size = app_module.app_config.MESSAGES_PAGE_SIZE
+            cases = {
+                f'messages/limit={page_size}': (
+                    lambda: orm_messages(app_module, 1, page_size),
+                    lambda: app_module._message_page(1, page_size)[0]),
+                f'messages/limit={args.messages}': (
+                    lambda: orm_messages(app_module, 1, args.messages),
+                    lambda: app_module._message_page(1, args.messages)[0]),
+                'conversations': (
+                    lambda: orm_conversations(app_module),
+                    lambda: app_module.list_conversations(app_module.dify_config.DEFAULT_USER_ID)),
+            }
+
+            print(f'{"用例":<24}{"ORM ops/s":>12}{"列元组 ops/s":>14}{"提速":>8}{"ORM峰值KB":>12}{"列元组峰值KB":>14}')
+            for name, (orm_func, row_func) in cases.items():
+                assert orm_func() == row_func(), f'{name} 两条路径输出不一致'
+                app_module.db.session.remove()
+                orm_ops, orm_peak = measure(orm_func, args.seconds)
+                row_ops, row_peak = measure(row_func, args.seconds)
+                speedup = row_ops / orm_ops
+                print(f'{name:<24}{orm_ops:>12.1f}{row_ops:>14.1f}{speedup:>7.2f}x{orm_peak:>12.0f}{row_peak:>14.0f}')
+                if args.min_speedup is not None and speedup < args.min_speedup:
+                    failures.append(f'{name} 提速 {speedup:.2f}x 低于要求的 {args.min_speedup}x')
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if failures:
+        print('\n❌ 未达到要求:')
+        for failure in failures:
+            print(f'   - {failure}')
+        return 1
+    print('\n✅ 两条读取路径输出一致')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+AI旅行助手 - 全文检索性能基准
+生成合成对话语料后测量 /api/search 的查询延迟
+
+用法:
+    python benchmarks/bench_search.py --messages 1000000 --budget-ms 50
+"""
+
+import argparse
+import os
+import random
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+CITIES = ['成都', '北京', '上海', '杭州', '西安', '重庆', '厦门', '桂林', '丽江', '大理', '三亚', '青岛']
+PLACES = ['宽窄巷子', '大熊猫繁育研究基地', '故宫博物院', '八达岭长城', '外滩', '西湖', '兵马俑',
+          '洪崖洞', '鼓浪屿', '漓江', '玉龙雪山', '洱海', '亚龙湾', '栈桥']
+FILLER = ['推荐您安排半天时间游览', '建议提前在官方渠道预约门票', '周边有很多特色小吃',
+          '交通方便，地铁可直达', '适合亲子出行', '傍晚时分景色最美', '节假日人流较多']
+
+QUERIES = ['大熊猫繁育', '成都', '玉龙雪山 门票', '鼓浪屿', '三亚 亚龙湾', '不存在的地名']
+
+def build_corpus(db_path, messages, per_conversation=20, seed=42):
+    """直接用sqlite3批量写入，触发器同步维护FTS5索引"""
+    from content_codec import sqlite_content_text
+    
+    rng = random.Random(seed)
+    conn = sqlite3.connect(db_path)
+    conn.create_function('content_text', 1, sqlite_content_text, deterministic=True)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=OFF')
+    
+    conversations = max(messages // per_conversation, 1)
+    conn.executemany(
+        "INSERT INTO conversations (id, title, user_id, created_at, updated_at) VALUES (?, ?, 'user', datetime(), datetime())",
+        ((i + 1, f'{rng.choice(CITIES)}{rng.randint(2, 7)}日游') for i in range(conversations))
+    )
+    
+    def rows():
+        for i in range(messages):
+            city = rng.choice(CITIES)
+            parts = [f'{n + 1}. {rng.choice(PLACES)}\n{rng.choice(FILLER)}，{city}{rng.choice(FILLER)}。' for n in range(4)]
+            yield (i + 1, i // per_conversation + 1, '\n'.join(parts), 'ai' if i % 2 else 'user')
+    
+    conn.executemany(
+        "INSERT INTO messages (id, conversation_id, content, sender_type, created_at) VALUES (?, ?, ?, ?, datetime())",
+        rows()
+    )
+    conn.commit()
+    conn.close()
+
+def main():
+    parser = argparse.ArgumentParser(description='全文检索性能基准')
+    parser.add_argument('--messages', type=int, default=200000, help='合成消息数量')
+    parser.add_argument('--runs', type=int, default=20, help='每个查询的重复次数')
+    parser.add_argument('--budget-ms', type=float, default=50.0, help='p95延迟预算（毫秒）')
+    args = parser.parse_args()
+    
+    workdir = tempfile.mkdtemp(prefix='bench_search_')
+    db_path = os.path.join(workdir, 'travel.db')
+    os.environ['DATABASE_URL'] = f'sqlite:///{db_path}'
+    os.environ.setdefault('DIFY_API_KEY', 'app-benchmark')
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    
+    import app as app_module
+    app_module.init_db()
+    
+    try:
+        started = time.perf_counter()
+        build_corpus(db_path, args.messages)
+        print(f'语料生成: {args.messages} 条消息, 耗时 {time.perf_counter() - started:.1f}s')
+        
+        client = app_module.app.test_client()
+        worst_p95 = 0.0
+        for query in QUERIES:
+            latencies = []
+            for _ in range(args.runs):
+                started = time.perf_counter()
+                response = client.get('/api/search', query_string={'q': query, 'per_page': 20})
+                latencies.append((time.perf_counter() - started) * 1000)
+                assert response.status_code == 200, response.data
+            latencies.sort()
+            p50 = statistics.median(latencies)
+            p95 = latencies[int(len(latencies) * 0.95) - 1]
+            worst_p95 = max(worst_p95, p95)
+            print(f'{query:<12} p50={p50:7.2f}ms  p95={p95:7.2f}ms  results={len(response.get_json()["data"]["results"])}')
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    
+    status = '通过' if worst_p95 <= args.budget_ms else '超出预算'
+    print(f'最差p95: {worst_p95:.2f}ms (预算 {args.budget_ms}ms) - {status}')
+    return 0 if worst_p95 <= args.budget_ms else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
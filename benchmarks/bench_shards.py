@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+AI旅行助手 - SQLite分片写入基准
+多个进程（相当于gunicorn worker）同时保存对话轮次（用户消息 + AI回复 + 事件 + 更新对话时间，与 /api/chat/send 相同的写入），
+对比单个数据库文件与按对话ID分片到多个文件时的总写入吞吐和 database is locked 重试次数
+
+用法:
+    python benchmarks/bench_shards.py --workers 8 --turns 200 --shards 4
+    python benchmarks/bench_shards.py --min-speedup 1.5    # 提速不足时以非零状态退出
+"""
+
+import argparse
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from corpus import synthetic_question, synthetic_reply
+
+def make_app(app_module, workdir, shard_count):
+    return app_module.create_app({
+        'SQLALCHEMY_DATABASE_URI': f'sqlite:///{os.path.join(workdir, "travel.db")}',
+        'SQLALCHEMY_BINDS': {'archive': {'url': f'sqlite:///{os.path.join(workdir, "archive.db")}'}},
+        'SHARD_COUNT': shard_count,
+        'SHARD_DIRECTORY': os.path.join(workdir, 'shards')
+    })
+
+def worker(workdir, shard_count, conversations, turns, seed, start, results):
+    """在自己的若干对话中保存turns轮对话，返回 (写入轮数, 锁冲突重试次数)"""
+    from sqlalchemy.exc import OperationalError
+    import app as app_module
+
+    flask_app = make_app(app_module, workdir, shard_count)
+    rng = random.Random(seed)
+    replies = [synthetic_reply(rng) for _ in range(20)]
+    retries = 0
+    with flask_app.app_context():
+        conversation_ids = []
+        for _ in range(conversations):
+            conversation, _ = app_module._resolve_conversation(synthetic_question(rng), None, 'bench', commit=True)
+            conversation_ids.append(conversation.id)
+        app_module.db.session.remove()
+        start.wait()
+
+        for _ in range(turns):
+            while True:
+                try:
+                    conversation_id = rng.choice(conversation_ids)
+                    conversation, _ = app_module._resolve_conversation('', conversation_id, 'bench')
+                    app_module._save_turn(conversation, synthetic_question(rng), rng.choice(replies), extracted=[])
+                    break
+                except OperationalError:
+                    app_module.db.session.rollback()
+                    retries += 1
+                finally:
+                    app_module.db.session.remove()
+    results.put((turns, retries))
+
+def run(workdir, shard_count, workers, conversations, turns):
+    import app as app_module
+
+    flask_app = make_app(app_module, workdir, shard_count)
+    with flask_app.app_context():
+        app_module.create_schema()
+        for engine in app_module.db.engines.values():
+            engine.dispose()
+
+    context = multiprocessing.get_context('fork')
+    start = context.Barrier(workers + 1)
+    results = context.Queue()
+    processes = [context.Process(target=worker, args=(workdir, shard_count, conversations, turns, seed, start, results))
+                 for seed in range(workers)]
+    for process in processes:
+        process.start()
+    start.wait()
+    started = time.perf_counter()
+    totals = [results.get() for _ in processes]
+    elapsed = time.perf_counter() - started
+    for process in processes:
+        process.join()
+    return sum(written for written, _ in totals) / elapsed, sum(retries for _, retries in totals)
+
+def main():
+    parser = argparse.ArgumentParser(description='SQLite分片写入基准')
+    parser.add_argument('--workers', type=int, default=8, help='并发写入的进程数')
+    parser.add_argument('--turns', type=int, default=200, help='每个进程保存的对话轮数')
+    parser.add_argument('--conversations', type=int, default=20, help='每个进程使用的对话数')
+    parser.add_argument('--shards', type=int, default=4, help='分片数')
+    parser.add_argument('--min-speedup', type=float, default=None, help='要求的最低吞吐提升倍数，不足时失败')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench_shards_')
+    os.environ['DATABASE_URL'] = f'sqlite:///{os.path.join(workdir, "travel.db")}'
+    os.environ['ARCHIVE_DATABASE_URL'] = f'sqlite:///{os.path.join(workdir, "archive.db")}'
+    os.environ.setdefault('DIFY_API_KEY', 'app-benchmark')
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    results = {}
+    try:
+        print(f'{"分片数":<8}{"轮/秒":>10}{"锁冲突重试":>12}')
+        for shard_count in (1, args.shards):
+            directory = os.path.join(workdir, f'run-{shard_count}')
+            os.makedirs(directory)
+            throughput, retries = run(directory, shard_count, args.workers, args.conversations, args.turns)
+            results[shard_count] = throughput
+            print(f'{shard_count:<8}{throughput:>10.1f}{retries:>12}')
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    speedup = results[args.shards] / results[1]
+    print(f'\n{args.workers} 个进程并发写入，{args.shards} 个分片相对单库提速 {speedup:.2f}x')
+    if args.min_speedup is not None and speedup < args.min_speedup:
+        print(f'❌ 提速 {speedup:.2f}x 低于要求的 {args.min_speedup}x')
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
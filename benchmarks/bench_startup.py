@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+AI旅行助手 - 冷启动耗时基准
+在全新的子进程中测量导入应用、首个请求和首次景点提取的耗时，
+可用 --budget 设定冷启动预算（毫秒），超出时以非零状态退出，便于在CI或扩容前检查
+
+用法:
+    python benchmarks/bench_startup.py --runs 10
+    python benchmarks/bench_startup.py --runs 10 --budget 1500
+"""
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 子进程内执行：按阶段记录从进程启动开始的耗时
+CHILD = r'''
+import json, time
+start = time.perf_counter()
+import app as travel_app
+imported = time.perf_counter()
+with travel_app.app.app_context():
+    travel_app.db.create_all()
+client = travel_app.app.test_client()
+client.get('/api/health')
+first_request = time.perf_counter()
+client.get('/api/conversations')
+first_query = time.perf_counter()
+travel_app.dify_service.extract_attractions('推荐：\n1. 八达岭长城\n地址：北京市延庆区八达岭镇\n2. 颐和园\n皇家园林')
+first_extract = time.perf_counter()
+print(json.dumps({
+    'import': imported - start,
+    'first_request': first_request - imported,
+    'first_query': first_query - first_request,
+    'first_extract': first_extract - first_query,
+    'total': first_extract - start,
+}))
+'''
+
+PHASES = ['import', 'first_request', 'first_query', 'first_extract', 'total']
+
+def run_once(work_dir):
+    env = dict(os.environ)
+    env.setdefault('DIFY_API_KEY', 'app-bench')
+    env['DATABASE_URL'] = f'sqlite:///{work_dir}/travel.db'
+    env['ARCHIVE_DATABASE_URL'] = f'sqlite:///{work_dir}/archive.db'
+    env['LOG_LEVEL'] = 'WARNING'
+    output = subprocess.run([sys.executable, '-c', CHILD], cwd=ROOT, env=env,
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description='冷启动耗时基准')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--budget', type=float, default=None, help='total阶段p50的预算（毫秒）')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='bench_startup_')
+    try:
+        results = [run_once(work_dir) for _ in range(args.runs)]
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print(f'{"阶段":<16}{"p50(ms)":>10}{"max(ms)":>10}')
+    for phase in PHASES:
+        values = [result[phase] * 1000 for result in results]
+        print(f'{phase:<16}{statistics.median(values):>10.1f}{max(values):>10.1f}')
+
+    if args.budget is not None:
+        total = statistics.median(result['total'] * 1000 for result in results)
+        if total > args.budget:
+            print(f'❌ 冷启动 {total:.1f}ms 超出预算 {args.budget:.0f}ms')
+            sys.exit(1)
+        print(f'✅ 冷启动 {total:.1f}ms 在预算 {args.budget:.0f}ms 内')
+
+if __name__ == '__main__':
+    main()
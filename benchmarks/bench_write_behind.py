@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+AI旅行助手 - 消息写后持久化基准
+模拟Dify回复，对比每次请求单独提交与写后队列（不同fsync策略）下 /api/chat/send 的吞吐
+
+用法:
+    python benchmarks/bench_write_behind.py --chats 2000 --threads 8
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+WORK_DIR = tempfile.mkdtemp(prefix='bench_write_behind_')
+os.environ.setdefault('DIFY_API_KEY', 'app-bench')
+os.environ['DATABASE_URL'] = f'sqlite:///{WORK_DIR}/travel.db'
+os.environ['ARCHIVE_DATABASE_URL'] = f'sqlite:///{WORK_DIR}/archive.db'
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as travel_app
+from app import Conversation, Message, app, db
+from write_behind import WriteBehindQueue
+
+ANSWER = '为您推荐：\n1. 八达岭长城\n地址：北京市延庆区八达岭镇\n2. 颐和园\n地址：北京市海淀区新建宫门路19号'
+
+def fake_send_message(message, conversation_id=None, user_id=None, **options):
+    return {'success': True, 'data': {'answer': ANSWER, 'conversation_id': conversation_id or 'bench-conv'}}
+
+def run(label, chats, threads):
+    # 预先创建对话，计时部分只包含已有对话的后续轮次（对话首轮需同步提交对话本身）
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        conversations = [Conversation(title='基准', dify_conversation_id='bench-conv') for _ in range(chats)]
+        db.session.add_all(conversations)
+        db.session.commit()
+        conversation_ids = [conversation.id for conversation in conversations]
+    client = app.test_client()
+    per_thread = chats // threads
+
+    def worker(ids):
+        for conversation_id in ids:
+            client.post('/api/chat/send', json={'message': '北京去哪玩', 'conversation_id': conversation_id})
+
+    workers = [threading.Thread(target=worker, args=(conversation_ids[i * per_thread:(i + 1) * per_thread],))
+               for i in range(threads)]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    travel_app.write_behind.flush(timeout=60)
+    with app.app_context():
+        stored = db.session.query(Message).count()
+    print(f'{label:<24} {per_thread * threads / elapsed:>10.0f} 次/秒  已落库消息 {stored}')
+
+def main():
+    parser = argparse.ArgumentParser(description='消息写后持久化基准')
+    parser.add_argument('--chats', type=int, default=2000)
+    parser.add_argument('--threads', type=int, default=8)
+    args = parser.parse_args()
+
+    travel_app.dify_service.send_message = fake_send_message
+    app.logger.disabled = True
+    try:
+        travel_app.write_behind = WriteBehindQueue(os.path.join(WORK_DIR, 'journal'), 100, 0.05, 'off', 2, enabled=False)
+        run('逐请求提交', args.chats, args.threads)
+        for policy in WriteBehindQueue.FSYNC_POLICIES:
+            travel_app.write_behind.stop()
+            travel_app.write_behind = WriteBehindQueue(os.path.join(WORK_DIR, 'journal'), 100, 0.05, policy, 2)
+            run(f'写后队列 fsync={policy}', args.chats, args.threads)
+        travel_app.write_behind.stop()
+    finally:
+        shutil.rmtree(WORK_DIR, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
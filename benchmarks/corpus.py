@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+AI旅行助手 - 基准测试语料
+生成与线上AI行程回复结构相近的合成文本，供假Dify服务、负载测试和微基准共用
+"""
+
+import random
+
+CITIES = ['成都', '北京', '上海', '杭州', '西安', '重庆', '厦门', '桂林']
+PLACES = ['宽窄巷子', '大熊猫繁育研究基地', '故宫博物院', '八达岭长城', '外滩', '西湖', '兵马俑', '洪崖洞', '鼓浪屿', '漓江']
+QUESTIONS = ['推荐{city}的几个著名旅游景点', '{city}三日游怎么安排', '去{city}玩需要注意什么', '{city}有什么好吃的', '帮我规划{city}亲子游']
+BOILERPLATE = [
+    '以下是为您精心规划的行程安排，您可以根据实际情况灵活调整：',
+    '温馨提示：节假日景区人流量较大，建议提前在官方渠道预约门票。',
+    '交通建议：市区景点之间推荐乘坐地铁或打车，避开早晚高峰。',
+    '如果您需要更详细的住宿或美食推荐，欢迎随时告诉我！祝您旅途愉快！',
+]
+
+def synthetic_question(rng):
+    return rng.choice(QUESTIONS).format(city=rng.choice(CITIES))
+
+def synthetic_reply(rng, days=None):
+    """生成多段行程回复：编号景点、地址、经纬度和推荐理由，长度约1~4KB"""
+    city = rng.choice(CITIES)
+    lines = [BOILERPLATE[0]]
+    for day in range(1, (days or rng.randint(3, 6)) + 1):
+        lines.append(f'\n第{day}天：')
+        for n in range(1, 4):
+            place = rng.choice(PLACES)
+            lines.append(f'{n}. {place}\n地址：{city}市某某区{place}路{rng.randint(1, 300)}号\n'
+                         f'经纬度：{rng.uniform(20, 40):.6f},{rng.uniform(100, 120):.6f}\n'
+                         f'推荐理由：{place}是{city}最具代表性的景点之一，建议游玩{rng.randint(1, 4)}小时。')
+    lines.extend(BOILERPLATE[1:])
+    return '\n'.join(lines)
+
+def adversarial_replies(size=20000):
+    """触发正则回溯的输入：无标点长串、大量数字和分隔符、只有前缀没有后缀的关键词等"""
+    return {
+        'no_punctuation': '推荐' + '好玩的地方' * (size // 5),
+        'keyword_suffix_tail': '景' * size + '公园',
+        'keyword_missing_suffix': '北京市海淀区' * (size // 6),
+        'digits_and_dots': '1.' * (size // 2),
+        'coordinate_like': '经纬度：' + '1' * size + ',',
+        'numbered_blank_lines': '\n' + '\n'.join(f'{i}.   ' for i in range(size // 6)),
+        'address_markers': '路街巷号' * (size // 4),
+        'parentheses_unclosed': '(经度' + '数' * size,
+        'many_open_parens': '(' * size,
+        'whitespace_runs': '\n' + ' ' * size + '好',
+    }
+
+def reply_corpus(count=200, seed=42):
+    rng = random.Random(seed)
+    return [synthetic_reply(rng) for _ in range(count)]
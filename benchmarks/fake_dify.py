@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+AI旅行助手 - 本地假Dify服务
+实现 POST /v1/chat-messages（blocking和streaming两种响应模式）和 GET /v1/parameters，
+可配置延迟分布和错误率，供负载测试替代真实Dify
+
+用法:
+    python benchmarks/fake_dify.py --port 5901 --latency-ms 800 --latency-sigma 0.5 --error-rate 0.02
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from corpus import synthetic_reply
+
+class FakeDifyConfig:
+    """延迟取对数正态分布：中位数latency_ms，sigma越大长尾越重；streaming时延迟均摊到各个分块"""
+
+    def __init__(self, latency_ms=800, latency_sigma=0.5, error_rate=0.0, mode=None, chunk_chars=40, seed=None):
+        self.latency_ms = latency_ms
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.mode = mode  # None表示按请求中的response_mode响应
+        self.chunk_chars = chunk_chars
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def sample_latency(self):
+        with self._lock:
+            if self.latency_ms <= 0:
+                return 0.0
+            return self._rng.lognormvariate(math.log(self.latency_ms / 1000), self.latency_sigma)
+
+    def should_fail(self):
+        with self._lock:
+            return self._rng.random() < self.error_rate
+
+    def reply(self):
+        with self._lock:
+            return synthetic_reply(self._rng)
+
+class FakeDifyHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    config = FakeDifyConfig()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip('/').endswith('/parameters'):
+            self._send_json(200, {'opening_statement': '', 'suggested_questions': []})
+        else:
+            self._send_json(404, {'code': 'not_found'})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        request = json.loads(self.rfile.read(length) or b'{}')
+        if not self.path.rstrip('/').endswith('/chat-messages'):
+            self._send_json(404, {'code': 'not_found'})
+            return
+
+        config = self.config
+        latency = config.sample_latency()
+        if config.should_fail():
+            time.sleep(latency)
+            self._send_json(500, {'code': 'internal_server_error', 'message': 'fake dify error'})
+            return
+
+        answer = config.reply()
+        conversation_id = request.get('conversation_id') or str(uuid.uuid4())
+        message_id = str(uuid.uuid4())
+        mode = config.mode or request.get('response_mode', 'blocking')
+        if mode == 'streaming':
+            self._stream(answer, conversation_id, message_id, latency)
+        else:
+            time.sleep(latency)
+            self._send_json(200, {
+                'event': 'message',
+                'message_id': message_id,
+                'conversation_id': conversation_id,
+                'mode': 'chat',
+                'answer': answer,
+                'metadata': {},
+                'created_at': int(time.time())
+            })
+
+    def _stream(self, answer, conversation_id, message_id, latency):
+        chunks = [answer[i:i + self.config.chunk_chars] for i in range(0, len(answer), self.config.chunk_chars)]
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        def write_event(payload):
+            data = f'data: {json.dumps(payload, ensure_ascii=False)}\n\n'.encode('utf-8')
+            self.wfile.write(f'{len(data):x}\r\n'.encode() + data + b'\r\n')
+            self.wfile.flush()
+
+        delay = latency / max(len(chunks), 1)
+        for chunk in chunks:
+            time.sleep(delay)
+            write_event({'event': 'message', 'message_id': message_id,
+                         'conversation_id': conversation_id, 'answer': chunk})
+        write_event({'event': 'message_end', 'message_id': message_id,
+                     'conversation_id': conversation_id, 'metadata': {}})
+        self.wfile.write(b'0\r\n\r\n')
+
+def start_fake_dify(port=0, **options):
+    """在后台线程启动假Dify服务，返回(server, base_url)"""
+    handler = type('ConfiguredFakeDifyHandler', (FakeDifyHandler,), {'config': FakeDifyConfig(**options)})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='fake-dify', daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}/v1'
+
+def main():
+    parser = argparse.ArgumentParser(description='本地假Dify服务')
+    parser.add_argument('--port', type=int, default=5901)
+    parser.add_argument('--latency-ms', type=float, default=800, help='响应延迟中位数（毫秒）')
+    parser.add_argument('--latency-sigma', type=float, default=0.5, help='对数正态分布的sigma，控制长尾')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='返回500的比例')
+    parser.add_argument('--mode', choices=['blocking', 'streaming'], default=None, help='强制响应模式，默认按请求')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    server, base_url = start_fake_dify(args.port, latency_ms=args.latency_ms, latency_sigma=args.latency_sigma,
+                                       error_rate=args.error_rate, mode=args.mode, seed=args.seed)
+    print(f'🤖 假Dify服务已启动: {base_url}')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == '__main__':
+    main()
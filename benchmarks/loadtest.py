@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+AI旅行助手 - 负载测试
+启动本地假Dify和应用服务，按目标RPS以开环方式回放合成或录制的流量，
+统计各接口的吞吐、p50/p95/p99延迟和错误率；--json输出可跨提交对比（--compare）
+
+用法:
+    python benchmarks/loadtest.py --rps 20 --duration 30
+    python benchmarks/loadtest.py --rps 50 --duration 60 --server gunicorn --workers 4 --json results.json
+    python benchmarks/loadtest.py --traffic recorded.jsonl --compare baseline.json
+    python benchmarks/loadtest.py --record traffic.jsonl --rps 20 --duration 30   # 导出合成流量供回放
+
+流量文件每行一个请求: {"at": 秒偏移, "name": 统计名, "method": "GET", "path": "/api/...", "json": {...}}
+路径和请求体中的 {conversation_id} 在发送时替换为一个已存在的对话ID。
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from corpus import synthetic_question
+from fake_dify import start_fake_dify
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULT_VERSION = 1
+DEFAULT_MIX = 'chat=0.4,chat_continue=0.2,list=0.2,messages=0.2'
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# 流量生成
+def synthetic_traffic(rps, duration, mix, seed):
+    """按泊松到达生成请求计划"""
+    rng = random.Random(seed)
+    names, weights = zip(*mix.items())
+    schedule = []
+    at = 0.0
+    while True:
+        at += rng.expovariate(rps)
+        if at >= duration:
+            break
+        name = rng.choices(names, weights)[0]
+        if name == 'chat':
+            request = {'method': 'POST', 'path': '/api/chat/send', 'json': {'message': synthetic_question(rng)}}
+        elif name == 'chat_continue':
+            request = {'method': 'POST', 'path': '/api/chat/send',
+                       'json': {'message': synthetic_question(rng), 'conversation_id': '{conversation_id}'}}
+        elif name == 'list':
+            request = {'method': 'GET', 'path': '/api/conversations'}
+        elif name == 'messages':
+            request = {'method': 'GET', 'path': '/api/conversations/{conversation_id}/messages'}
+        else:
+            raise ValueError(f'未知的请求类型: {name}')
+        schedule.append({'at': round(at, 4), 'name': name, **request})
+    return schedule
+
+def load_traffic(path):
+    with open(path, encoding='utf-8') as f:
+        return sorted((json.loads(line) for line in f if line.strip()), key=lambda item: item['at'])
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        mix[name.strip()] = float(weight)
+    return mix
+
+# 被测服务
+def start_app_server(args, dify_url, work_dir):
+    port = free_port()
+    env = dict(os.environ)
+    env.update({
+        'DIFY_API_URL': dify_url,
+        'DIFY_API_KEY': 'app-loadtest',
+        'DIFY_STARTUP_CHECK': 'off',
+        'DATABASE_URL': f'sqlite:///{work_dir}/travel.db',
+        'ARCHIVE_DATABASE_URL': f'sqlite:///{work_dir}/archive.db',
+        'LOG_DIRECTORY': os.path.join(work_dir, 'logs'),
+        'LOG_LEVEL': 'WARNING',
+        'HOST': '127.0.0.1',
+        'PORT': str(port),
+    })
+    subprocess.run([sys.executable, '-c', 'from app import init_db; init_db()'], cwd=ROOT, env=env,
+                   check=True, capture_output=True)
+
+    if args.server == 'gunicorn':
+        env.update({
+            'GUNICORN_WORKERS': str(args.workers),
+            'GUNICORN_ACCESS_LOG': os.path.join(work_dir, 'access.log'),
+            'GUNICORN_ERROR_LOG': os.path.join(work_dir, 'error.log'),
+            'GUNICORN_PIDFILE': os.path.join(work_dir, 'gunicorn.pid'),
+        })
+        command = [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'app:app']
+    else:
+        command = [sys.executable, '-c',
+                   'from werkzeug.serving import run_simple\n'
+                   'from app import app\n'
+                   f'run_simple("127.0.0.1", {port}, app, threaded=True)']
+    process = subprocess.Popen(command, cwd=ROOT, env=env,
+                               stdout=subprocess.DEVNULL, stderr=open(os.path.join(work_dir, 'server.log'), 'w'))
+
+    base_url = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            if requests.get(f'{base_url}/api/health', timeout=1).status_code == 200:
+                return process, base_url
+        except requests.RequestException:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f'应用服务启动失败，日志见 {work_dir}/server.log')
+
+# 压测执行
+class LoadRunner:
+    def __init__(self, base_url, schedule, concurrency, timeout, seed):
+        self.base_url = base_url
+        self.schedule = schedule
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.samples = {}  # name -> [(latency, ok)]
+        self.conversation_ids = []
+        self.rng = random.Random(seed)
+
+    def session(self):
+        if not hasattr(self.local, 'session'):
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def seed_conversations(self, count):
+        for i in range(count):
+            response = self.session().post(f'{self.base_url}/api/conversations', json={'title': f'压测对话{i}'})
+            self.conversation_ids.append(response.json()['data']['id'])
+
+    def _fill(self, value, conversation_id):
+        text = json.dumps(value, ensure_ascii=False).replace('"{conversation_id}"', str(conversation_id))
+        return json.loads(text.replace('{conversation_id}', str(conversation_id)))
+
+    def _send(self, item, scheduled):
+        with self.lock:
+            conversation_id = self.rng.choice(self.conversation_ids)
+        path = item['path'].replace('{conversation_id}', str(conversation_id))
+        body = self._fill(item['json'], conversation_id) if 'json' in item else None
+        ok = False
+        try:
+            response = self.session().request(item['method'], f'{self.base_url}{path}', json=body, timeout=self.timeout)
+            payload = response.json()
+            ok = response.status_code < 400 and payload.get('success', True)
+            # AI服务失败时接口仍返回成功，以回复内容区分
+            if ok and item['path'] == '/api/chat/send':
+                ok = not payload['data']['ai_message']['content'].startswith('抱歉，AI服务暂时不可用')
+                with self.lock:
+                    self.conversation_ids.append(payload['data']['conversation_id'])
+        except (requests.RequestException, ValueError, KeyError):
+            ok = False
+        # 延迟从计划发送时间算起，避免服务变慢时少发请求掩盖排队（coordinated omission）
+        latency = time.perf_counter() - scheduled
+        with self.lock:
+            self.samples.setdefault(item.get('name', item['path']), []).append((latency, ok))
+
+    def run(self):
+        start = time.perf_counter()
+        futures = []
+        for item in self.schedule:
+            scheduled = start + item['at']
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            futures.append(self.executor.submit(self._send, item, scheduled))
+        for future in futures:
+            future.result()
+        elapsed = time.perf_counter() - start
+        self.executor.shutdown()
+        return elapsed
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, int(round(p / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+def summarize(samples, elapsed):
+    def stats(items):
+        latencies = sorted(latency * 1000 for latency, _ in items)
+        errors = sum(1 for _, ok in items if not ok)
+        return {
+            'count': len(items),
+            'errors': errors,
+            'error_rate': round(errors / len(items), 4) if items else 0,
+            'throughput_rps': round(len(items) / elapsed, 2),
+            'p50_ms': round(percentile(latencies, 50), 1),
+            'p95_ms': round(percentile(latencies, 95), 1),
+            'p99_ms': round(percentile(latencies, 99), 1),
+        }
+    endpoints = {name: stats(items) for name, items in sorted(samples.items())}
+    overall = stats([sample for items in samples.values() for sample in items])
+    return endpoints, overall
+
+def print_table(endpoints, overall):
+    header = f'{"接口":<16}{"请求数":>8}{"错误率":>8}{"吞吐(rps)":>11}{"p50(ms)":>10}{"p95(ms)":>10}{"p99(ms)":>10}'
+    print(header)
+    for name, row in list(endpoints.items()) + [('overall', overall)]:
+        print(f'{name:<16}{row["count"]:>8}{row["error_rate"]:>8.2%}{row["throughput_rps"]:>11.1f}'
+              f'{row["p50_ms"]:>10.1f}{row["p95_ms"]:>10.1f}{row["p99_ms"]:>10.1f}')
+
+def print_comparison(result, baseline_path):
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = json.load(f)
+    print(f'\n对比基线 {baseline.get("commit")} → 当前 {result.get("commit")}')
+    rows = dict(result['endpoints'], overall=result['overall'])
+    base_rows = dict(baseline['endpoints'], overall=baseline['overall'])
+    for name, row in rows.items():
+        base = base_rows.get(name)
+        if not base:
+            continue
+        deltas = []
+        for key in ('throughput_rps', 'p50_ms', 'p95_ms', 'p99_ms'):
+            if base[key]:
+                deltas.append(f'{key} {(row[key] - base[key]) / base[key]:+.1%}')
+        deltas.append(f'error_rate {row["error_rate"] - base["error_rate"]:+.2%}')
+        print(f'  {name:<16}' + ', '.join(deltas))
+
+def main():
+    parser = argparse.ArgumentParser(description='AI旅行助手负载测试')
+    parser.add_argument('--rps', type=float, default=20, help='目标请求速率')
+    parser.add_argument('--duration', type=float, default=30, help='合成流量持续秒数')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='合成流量各类请求的比例')
+    parser.add_argument('--traffic', help='回放录制的流量文件（JSONL）')
+    parser.add_argument('--record', help='将合成流量写入JSONL文件后退出')
+    parser.add_argument('--concurrency', type=int, default=64, help='客户端最大并发连接数')
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--target', help='压测已运行的服务（如 http://127.0.0.1:5000），不启动本地服务')
+    parser.add_argument('--server', choices=['werkzeug', 'gunicorn'], default='werkzeug')
+    parser.add_argument('--workers', type=int, default=4, help='gunicorn worker数')
+    parser.add_argument('--dify-latency-ms', type=float, default=800)
+    parser.add_argument('--dify-latency-sigma', type=float, default=0.5)
+    parser.add_argument('--dify-error-rate', type=float, default=0.0)
+    parser.add_argument('--dify-mode', choices=['blocking', 'streaming'], default=None)
+    parser.add_argument('--seed-conversations', type=int, default=20)
+    parser.add_argument('--json', help='将结果写入JSON文件')
+    parser.add_argument('--compare', help='与之前的JSON结果对比')
+    args = parser.parse_args()
+
+    schedule = load_traffic(args.traffic) if args.traffic else \
+        synthetic_traffic(args.rps, args.duration, parse_mix(args.mix), args.seed)
+    if args.record:
+        with open(args.record, 'w', encoding='utf-8') as f:
+            for item in schedule:
+                f.write(json.dumps(item, ensure_ascii=False) + '\n')
+        print(f'✅ 已写入 {len(schedule)} 个请求: {args.record}')
+        return
+
+    work_dir = tempfile.mkdtemp(prefix='loadtest_')
+    fake_dify = process = None
+    try:
+        if args.target:
+            base_url = args.target.rstrip('/')
+        else:
+            fake_dify, dify_url = start_fake_dify(
+                latency_ms=args.dify_latency_ms, latency_sigma=args.dify_latency_sigma,
+                error_rate=args.dify_error_rate, mode=args.dify_mode, seed=args.seed)
+            process, base_url = start_app_server(args, dify_url, work_dir)
+
+        runner = LoadRunner(base_url, schedule, args.concurrency, args.timeout, args.seed)
+        runner.seed_conversations(args.seed_conversations)
+        print(f'🚀 开始压测: {len(schedule)} 个请求, 目标 {args.rps} rps, 服务 {args.target or args.server}')
+        elapsed = runner.run()
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=10)
+        if fake_dify is not None:
+            fake_dify.shutdown()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    endpoints, overall = summarize(runner.samples, elapsed)
+    print_table(endpoints, overall)
+
+    result = {
+        'version': RESULT_VERSION,
+        'commit': git_commit(),
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'config': {
+            'rps': args.rps, 'duration': args.duration, 'mix': args.mix, 'traffic': args.traffic,
+            'server': args.target or args.server, 'workers': args.workers, 'concurrency': args.concurrency,
+            'seed': args.seed, 'dify_latency_ms': args.dify_latency_ms, 'dify_latency_sigma': args.dify_latency_sigma,
+            'dify_error_rate': args.dify_error_rate, 'dify_mode': args.dify_mode, 'requests': len(schedule),
+        },
+        'elapsed_seconds': round(elapsed, 2),
+        'endpoints': endpoints,
+        'overall': overall,
+    }
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        print_comparison(result, args.compare)
+
+if __name__ == '__main__':
+    main()
@@ -11,6 +11,52 @@ from dotenv import load_dotenv
 # 加载环境变量
 load_dotenv()
 
+def normalize_database_url(url):
+    """未指定驱动的PostgreSQL地址（包括部分托管平台使用的 postgres:// 写法）固定使用psycopg2，
+    新版SQLAlchemy的默认驱动已改为psycopg 3"""
+    for prefix in ('postgres://', 'postgresql://'):
+        if url.startswith(prefix):
+            return 'postgresql+psycopg2://' + url[len(prefix):]
+    return url
+
+def postgresql_engine_options(pool_size, pool_timeout, pool_recycle, statement_timeout_ms, idle_in_transaction_timeout_ms):
+    """PostgreSQL（psycopg2）连接池参数"""
+    return {
+        'pool_size': pool_size,
+        'max_overflow': 0,  # 连接数硬上限，借满时排队等待而不是挤占服务端连接
+        'pool_timeout': pool_timeout,
+        'pool_recycle': pool_recycle,
+        'pool_use_lifo': True,  # 优先复用刚归还的连接，低峰时多余的连接保持空闲直到被回收
+        'pool_pre_ping': False,  # 存活检测见app.py的check_idle_connection，只针对空闲较久的连接
+        'connect_args': {
+            'connect_timeout': 5,
+            'application_name': 'ai-travel',
+            'client_encoding': 'utf8',
+            # TCP keepalive让服务端或网络断开的空闲连接尽快暴露，而不是在下次查询时挂起
+            'keepalives': 1,
+            'keepalives_idle': 30,
+            'keepalives_interval': 10,
+            'keepalives_count': 3,
+            'options': f'-c statement_timeout={statement_timeout_ms} '
+                       f'-c idle_in_transaction_session_timeout={idle_in_transaction_timeout_ms}'
+        }
+    }
+
+def shard_database_path(directory, index):
+    """第index个分片的SQLite文件路径，相对路径相对于项目目录"""
+    if not os.path.isabs(directory):
+        directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), directory)
+    return os.path.join(directory, f'shard-{index}.db')
+
+def shard_binds(count, directory, engine_options):
+    """分片模式下每个分片一个SQLite文件，以 shard-0 ... shard-{count-1} 为bind key；count不大于1时不分片"""
+    if count <= 1:
+        return {}
+    return {
+        f'shard-{index}': {'url': f'sqlite:///{shard_database_path(directory, index).replace(os.sep, "/")}', **engine_options}
+        for index in range(count)
+    }
+
 class Config:
     """应用配置类 - 集中管理所有配置变量"""
     
@@ -23,7 +69,7 @@ class Config:
     PORT = int(os.getenv('PORT', 5000))
     
     # 数据库配置  
-    DATABASE_URL = os.getenv('DATABASE_URL', 'sqlite:///database/travel.db')
+    DATABASE_URL = normalize_database_url(os.getenv('DATABASE_URL', 'sqlite:///database/travel.db'))
     if DATABASE_URL.startswith('sqlite://') and not DATABASE_URL.startswith('sqlite:////'):
         # 转换为绝对路径
         db_path = DATABASE_URL.replace('sqlite:///', '')
@@ -31,12 +77,100 @@ class Config:
             current_dir = os.path.dirname(os.path.abspath(__file__))
             DATABASE_URL = f'sqlite:///{os.path.join(current_dir, db_path).replace(os.sep, "/")}'
     SQLALCHEMY_DATABASE_URI = DATABASE_URL
+    
+    # 冷数据归档库配置（独立SQLite文件，存放压缩后的历史对话）
+    ARCHIVE_DATABASE_URL = normalize_database_url(os.getenv('ARCHIVE_DATABASE_URL', 'sqlite:///database/archive.db'))
+    if ARCHIVE_DATABASE_URL.startswith('sqlite://') and not ARCHIVE_DATABASE_URL.startswith('sqlite:////'):
+        archive_path = ARCHIVE_DATABASE_URL.replace('sqlite:///', '')
+        if not os.path.isabs(archive_path):
+            current_dir = os.path.dirname(os.path.abspath(__file__))
+            ARCHIVE_DATABASE_URL = f'sqlite:///{os.path.join(current_dir, archive_path).replace(os.sep, "/")}'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
-    SQLALCHEMY_ENGINE_OPTIONS = {
-        'pool_size': 20,
-        'pool_recycle': 3600,
-        'pool_pre_ping': True
-    }
+    
+    # 数据库连接池配置: SQLite是本地文件，连接不会被服务端断开，不做存活检测；
+    # PostgreSQL按gunicorn worker数均分连接预算，所有worker合计不超过 DB_MAX_CONNECTIONS
+    DATABASE_BACKEND = 'postgresql' if DATABASE_URL.startswith('postgresql') else 'sqlite'
+    DB_MAX_CONNECTIONS = int(os.getenv('DB_MAX_CONNECTIONS', 40))  # 应小于服务端max_connections减去运维预留
+    DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 0)) or max(DB_MAX_CONNECTIONS // max(int(os.getenv('GUNICORN_WORKERS', 4)), 1), 2)
+    DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 10))  # 连接全部借出时等待的秒数
+    DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', 1800))  # 连接最长使用秒数，应小于服务端和中间代理的空闲超时
+    DB_LIVENESS_IDLE_SECONDS = float(os.getenv('DB_LIVENESS_IDLE_SECONDS', 30))  # 连接空闲超过N秒后再借出时才检测存活
+    DB_STATEMENT_TIMEOUT_MS = int(os.getenv('DB_STATEMENT_TIMEOUT_MS', 15000))  # 服务端单条语句超时
+    DB_IDLE_IN_TRANSACTION_TIMEOUT_MS = int(os.getenv('DB_IDLE_IN_TRANSACTION_TIMEOUT_MS', 60000))  # 事务内空闲超时
+    DB_BULK_COPY_THRESHOLD = int(os.getenv('DB_BULK_COPY_THRESHOLD', 500))  # 批量写入达到N行时PostgreSQL改用COPY
+    if DATABASE_BACKEND == 'postgresql':
+        SQLALCHEMY_ENGINE_OPTIONS = postgresql_engine_options(
+            DB_POOL_SIZE, DB_POOL_TIMEOUT, DB_POOL_RECYCLE, DB_STATEMENT_TIMEOUT_MS, DB_IDLE_IN_TRANSACTION_TIMEOUT_MS)
+    else:
+        SQLALCHEMY_ENGINE_OPTIONS = {
+            'pool_size': 20,
+            'pool_recycle': 3600
+        }
+    # 归档库访问很少，PostgreSQL上只保留少量连接
+    ARCHIVE_ENGINE_OPTIONS = postgresql_engine_options(
+        2, DB_POOL_TIMEOUT, DB_POOL_RECYCLE, DB_STATEMENT_TIMEOUT_MS, DB_IDLE_IN_TRANSACTION_TIMEOUT_MS
+    ) if ARCHIVE_DATABASE_URL.startswith('postgresql') else {}
+    SQLALCHEMY_BINDS = {'archive': {'url': ARCHIVE_DATABASE_URL, **ARCHIVE_ENGINE_OPTIONS}}
+    
+    # SQLite分片存储配置: 对话及其消息、景点和事件按对话ID的一致性哈希分布到多个SQLite文件，
+    # 不同分片的写入由各自的文件锁串行，互不阻塞；主库只负责分配全局唯一的对话ID。SHARD_COUNT不大于1时不分片
+    SHARD_COUNT = int(os.getenv('SHARD_COUNT', 1)) if DATABASE_BACKEND == 'sqlite' else 1
+    SHARD_DIRECTORY = os.getenv('SHARD_DIRECTORY', 'database/shards')
+    
+    # 消息内容压缩配置: 超过阈值（字节）的消息压缩存储，字典目录存放基于历史回复训练的压缩字典
+    CONTENT_COMPRESSION_ENABLED = os.getenv('CONTENT_COMPRESSION_ENABLED', 'True').lower() == 'true'
+    CONTENT_COMPRESSION_THRESHOLD = int(os.getenv('CONTENT_COMPRESSION_THRESHOLD', 1024))
+    CONTENT_DICT_DIRECTORY = os.getenv('CONTENT_DICT_DIRECTORY', 'database/dicts')
+    
+    # 消息分页配置: 单次获取消息的默认数量和上限
+    MESSAGES_PAGE_SIZE = int(os.getenv('MESSAGES_PAGE_SIZE', 200))
+    MESSAGES_MAX_PAGE_SIZE = int(os.getenv('MESSAGES_MAX_PAGE_SIZE', 1000))
+    MESSAGES_SYNC_MAX_CONVERSATIONS = int(os.getenv('MESSAGES_SYNC_MAX_CONVERSATIONS', 100))  # 批量增量同步单次最多的对话数
+    CONVERSATIONS_BATCH_DELETE_MAX = int(os.getenv('CONVERSATIONS_BATCH_DELETE_MAX', 500))  # 批量删除单次最多的对话数
+    
+    # 冷数据归档配置
+    ARCHIVE_ENABLED = os.getenv('ARCHIVE_ENABLED', 'False').lower() == 'true'  # 是否在服务进程内运行后台归档
+    ARCHIVE_AFTER_DAYS = int(os.getenv('ARCHIVE_AFTER_DAYS', 90))  # 超过N天未更新的对话归档
+    ARCHIVE_BATCH_SIZE = int(os.getenv('ARCHIVE_BATCH_SIZE', 50))  # 每轮最多归档的对话数
+    ARCHIVE_THROTTLE_SECONDS = float(os.getenv('ARCHIVE_THROTTLE_SECONDS', 0.2))  # 每个对话之间的间隔
+    ARCHIVE_INTERVAL_SECONDS = int(os.getenv('ARCHIVE_INTERVAL_SECONDS', 3600))  # 后台归档轮询间隔
+    
+    # 消息写后持久化配置: 聊天记录先追加到恢复日志，再由后台线程按批次合并提交
+    WRITE_BEHIND_ENABLED = os.getenv('WRITE_BEHIND_ENABLED', 'False').lower() == 'true'
+    WRITE_BEHIND_BATCH_SIZE = int(os.getenv('WRITE_BEHIND_BATCH_SIZE', 100))  # 累积N轮对话立即提交
+    WRITE_BEHIND_FLUSH_INTERVAL = float(os.getenv('WRITE_BEHIND_FLUSH_INTERVAL', 0.05))  # 最长等待秒数后提交
+    WRITE_BEHIND_FSYNC = os.getenv('WRITE_BEHIND_FSYNC', 'interval').lower()  # always: 每次写日志fsync, interval: 每个提交周期fsync一次, off: 交给操作系统
+    WRITE_BEHIND_JOURNAL_DIRECTORY = os.getenv('WRITE_BEHIND_JOURNAL_DIRECTORY', 'database/journal')
+    WRITE_BEHIND_READ_TIMEOUT = float(os.getenv('WRITE_BEHIND_READ_TIMEOUT', 2))  # 读取前等待未提交写入的最长秒数
+    
+    # 聊天接口准入控制: 按user_id和IP的令牌桶限流，以及所有worker合计的上游并发上限，状态保存在本机目录中供各worker共享
+    RATE_LIMIT_ENABLED = os.getenv('RATE_LIMIT_ENABLED', 'False').lower() == 'true'
+    RATE_LIMIT_USER_BURST = int(os.getenv('RATE_LIMIT_USER_BURST', 10))  # 每个user_id可连续发送的消息数，0表示不限制
+    RATE_LIMIT_USER_PER_MINUTE = float(os.getenv('RATE_LIMIT_USER_PER_MINUTE', 20))  # 每个user_id每分钟补充的令牌数
+    RATE_LIMIT_IP_BURST = int(os.getenv('RATE_LIMIT_IP_BURST', 30))  # 每个IP可连续发送的消息数，0表示不限制
+    RATE_LIMIT_IP_PER_MINUTE = float(os.getenv('RATE_LIMIT_IP_PER_MINUTE', 60))  # 每个IP每分钟补充的令牌数
+    CHAT_MAX_CONCURRENT = int(os.getenv('CHAT_MAX_CONCURRENT', 3))  # 同时等待Dify回复的请求数上限，应小于worker总数
+    CHAT_BUSY_RETRY_AFTER = int(os.getenv('CHAT_BUSY_RETRY_AFTER', 5))  # 并发已满时建议客户端重试的秒数
+    RATE_LIMIT_DIRECTORY = os.getenv('RATE_LIMIT_DIRECTORY', 'database/ratelimit')
+    
+    # 聊天请求幂等配置: 带 Idempotency-Key 头的 /api/chat/send 只执行一次，客户端重试时返回保存的响应
+    IDEMPOTENCY_ENABLED = os.getenv('IDEMPOTENCY_ENABLED', 'True').lower() == 'true'
+    IDEMPOTENCY_TTL_SECONDS = int(os.getenv('IDEMPOTENCY_TTL_SECONDS', 86400))  # 保存响应的时长，应覆盖客户端的重试窗口
+    IDEMPOTENCY_LEASE_SECONDS = int(os.getenv('IDEMPOTENCY_LEASE_SECONDS', 180))  # 首次请求执行超过N秒视为已中断，重试可重新执行，应大于 DIFY_REQUEST_DEADLINE
+    IDEMPOTENCY_RETRY_AFTER = int(os.getenv('IDEMPOTENCY_RETRY_AFTER', 2))  # 首次请求仍在执行时返回409，建议客户端N秒后重试
+    
+    # 对话轮次串行配置: 同一对话的消息在所有worker之间依次执行，已有轮次在执行时新消息排队，由后台线程执行
+    CONVERSATION_LOCK_ENABLED = os.getenv('CONVERSATION_LOCK_ENABLED', 'True').lower() == 'true'
+    CONVERSATION_LOCK_DIRECTORY = os.getenv('CONVERSATION_LOCK_DIRECTORY', 'database/locks')
+    CHAT_PIPELINE_WORKERS = int(os.getenv('CHAT_PIPELINE_WORKERS', 4))  # 每个worker执行排队轮次的后台线程数
+    
+    # 对话事件推送配置: 新消息和景点提取结果写入事件表，各worker的轮询线程读取后推送给SSE订阅者
+    EVENTS_ENABLED = os.getenv('EVENTS_ENABLED', 'True').lower() == 'true'
+    EVENTS_POLL_INTERVAL = float(os.getenv('EVENTS_POLL_INTERVAL', 0.5))  # 有订阅者时轮询事件表的间隔
+    EVENTS_HEARTBEAT_SECONDS = float(os.getenv('EVENTS_HEARTBEAT_SECONDS', 15))  # 无事件时发送心跳的间隔
+    EVENTS_RETENTION_SECONDS = int(os.getenv('EVENTS_RETENTION_SECONDS', 600))  # 事件保留时长，断线重连在此时间内可补发
+    EVENTS_MAX_SUBSCRIBERS = int(os.getenv('EVENTS_MAX_SUBSCRIBERS', 5000))  # 每个worker的订阅连接上限
+    EVENTS_RETRY_MS = int(os.getenv('EVENTS_RETRY_MS', 3000))  # 建议浏览器断线后重连的间隔
     
     # 日志配置
     LOG_DIRECTORY = os.getenv('LOG_DIRECTORY', 'logs')
@@ -72,10 +206,21 @@ class DifyConfig:
     # API端点配置
     CHAT_MESSAGES_ENDPOINT = f"{API_BASE_URL}/chat-messages"
     CONVERSATIONS_ENDPOINT = f"{API_BASE_URL}/conversations"
+    PARAMETERS_ENDPOINT = f"{API_BASE_URL}/parameters"  # 应用参数，用于连通性探测
     
     # 请求配置
     TIMEOUT = int(os.getenv('DIFY_TIMEOUT', 60))  # 60秒超时
     MAX_RETRIES = int(os.getenv('DIFY_MAX_RETRIES', 3))  # 最大重试次数
+    HTTP_POOL_SIZE = int(os.getenv('DIFY_HTTP_POOL_SIZE', 10))  # 每个进程到Dify的最大保持连接数
+    
+    # 启动检查配置: async-启动后在后台线程探测连通性, off-不探测
+    STARTUP_CHECK = os.getenv('DIFY_STARTUP_CHECK', 'async').lower()
+    PROBE_TIMEOUT = float(os.getenv('DIFY_PROBE_TIMEOUT', 5))
+    
+    # 上游调用调度: 每个进程同时调用Dify的上限，超出时按优先级排队（健康探测 > 继续对话 > 新对话）
+    MAX_CONCURRENT = int(os.getenv('DIFY_MAX_CONCURRENT', 4))
+    REQUEST_DEADLINE = float(os.getenv('DIFY_REQUEST_DEADLINE', 90))  # 从收到请求起的总时限（含排队），客户端可用X-Request-Timeout缩短
+    SCHEDULER_POLL_INTERVAL = float(os.getenv('DIFY_SCHEDULER_POLL_INTERVAL', 1))  # 排队期间检查客户端是否断开的间隔
     
     # 响应模式配置
     RESPONSE_MODE_BLOCKING = 'blocking'  # 阻塞模式，等待完整响应
@@ -100,7 +245,14 @@ class DifyConfig:
         'CONNECTION_ERROR': '无法连接到AI服务，请检查网络连接',
         'NETWORK_ERROR': '网络请求异常',
         'UNKNOWN_ERROR': '服务异常',
-        'EMPTY_MESSAGE': '消息内容不能为空'
+        'EMPTY_MESSAGE': '消息内容不能为空',
+        'INVALID_CONVERSATION_ID': '对话ID无效',
+        'TOO_MANY_REQUESTS': '发送消息过于频繁，请稍后重试',
+        'SERVER_BUSY': '当前咨询人数较多，请稍后重试',
+        'DEADLINE_EXCEEDED': 'AI服务繁忙，请求排队超时，请稍后重试',
+        'IDEMPOTENCY_KEY_INVALID': 'Idempotency-Key 不能为空且不能超过255个字符',
+        'IDEMPOTENCY_KEY_REUSED': '该 Idempotency-Key 已用于内容不同的请求',
+        'IDEMPOTENCY_IN_PROGRESS': '相同的请求仍在处理中，请稍后重试'
     }
     
     # 成功消息配置
@@ -124,8 +276,15 @@ class DifyConfig:
     ]
     
     MAX_ATTRACTIONS_PER_RESPONSE = 5  # 每次最多返回的景点数量
+    EXTRACTION_MAX_CHARS = int(os.getenv('ATTRACTION_EXTRACTION_MAX_CHARS', 20000))  # 单条回复最多解析的字符数
+    EXTRACTION_TIME_BUDGET = float(os.getenv('ATTRACTION_EXTRACTION_TIME_BUDGET', 0.5))  # 单条回复的解析时间预算（秒）
     DEFAULT_ATTRACTION_IMAGE = 'https://images.pexels.com/photos/1591373/pexels-photo-1591373.jpeg?auto=compress&cs=tinysrgb&w=400'
     
+    # 景点提取执行方式: sync-请求线程内同步提取, async-交给后台进程池提取
+    ATTRACTION_EXTRACTION_MODE = os.getenv('ATTRACTION_EXTRACTION_MODE', 'sync').lower()
+    ATTRACTION_WORKER_PROCESSES = int(os.getenv('ATTRACTION_WORKER_PROCESSES', 2))
+    ATTRACTION_QUEUE_SIZE = int(os.getenv('ATTRACTION_QUEUE_SIZE', 32))  # 排队上限，超出时回退为同步提取
+    
     @classmethod
     def validate_config(cls):
         """验证Dify配置是否正确"""
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+AI旅行助手 - 消息内容压缩模块
+超过阈值的长文本以压缩二进制存储，读取时透明解压，兼容历史未压缩数据
+"""
+
+import os
+import re
+import struct
+import threading
+import zlib
+from collections import Counter
+
+from sqlalchemy.types import Text, TypeDecorator
+
+from config import app_config
+
+try:
+    import zstandard
+except ImportError:  # 可选依赖，未安装时使用zlib
+    zstandard = None
+
+# 压缩数据头: 魔数(3字节) + 压缩算法(1字节) + 字典ID(4字节，0表示未使用字典)
+MAGIC = b'\x00TC'
+HEADER = struct.Struct('>3scI')
+CODEC_ZLIB = b'z'
+CODEC_ZSTD = b's'
+DICT_EXTENSIONS = {CODEC_ZLIB: 'zlib', CODEC_ZSTD: 'zstd'}
+ACTIVE_DICT_FILE = 'ACTIVE'
+
+class ContentCodec:
+    """消息内容编解码器 - 按阈值压缩，支持基于历史回复训练的预置字典"""
+    
+    def __init__(self, threshold, dict_dir, enabled=True, level=6):
+        self.threshold = threshold
+        self.dict_dir = dict_dir
+        self.enabled = enabled
+        self.level = level
+        self._dictionaries = {}
+        self._active = None  # (codec, dict_id)，None表示尚未加载
+        self._lock = threading.Lock()
+        self._local = threading.local()
+    
+    # 字典管理
+    def _dict_path(self, codec, dict_id):
+        return os.path.join(self.dict_dir, f'{dict_id:08x}.{DICT_EXTENSIONS[codec]}')
+    
+    def _load_dictionary(self, codec, dict_id):
+        key = (codec, dict_id)
+        if key not in self._dictionaries:
+            with open(self._dict_path(codec, dict_id), 'rb') as f:
+                data = f.read()
+            with self._lock:
+                self._dictionaries[key] = data
+        return self._dictionaries[key]
+    
+    def active_dictionary(self):
+        """当前用于写入的字典 (codec, dict_id)，dict_id为0表示不使用字典"""
+        if self._active is None:
+            active = (CODEC_ZSTD if zstandard is not None else CODEC_ZLIB, 0)
+            try:
+                with open(os.path.join(self.dict_dir, ACTIVE_DICT_FILE)) as f:
+                    name = f.read().strip()
+                dict_id, extension = name.split('.')
+                codec = {v: k for k, v in DICT_EXTENSIONS.items()}[extension]
+                if codec == CODEC_ZLIB or zstandard is not None:
+                    active = (codec, int(dict_id, 16))
+            except (OSError, ValueError, KeyError):
+                pass
+            self._active = active
+        return self._active
+    
+    def preload(self):
+        """加载字典目录下的全部字典（gunicorn preload_app时在master进程调用，worker共享）"""
+        extensions = {v: k for k, v in DICT_EXTENSIONS.items()}
+        try:
+            names = os.listdir(self.dict_dir)
+        except FileNotFoundError:
+            names = []
+        for name in names:
+            dict_id, _, extension = name.partition('.')
+            if extension in extensions:
+                try:
+                    self._load_dictionary(extensions[extension], int(dict_id, 16))
+                except ValueError:
+                    continue
+        return self.active_dictionary()
+    
+    def save_dictionary(self, codec, data):
+        """保存字典并设为写入时使用的字典，已写入的数据仍按各自的字典ID解压"""
+        os.makedirs(self.dict_dir, exist_ok=True)
+        dict_id = zlib.crc32(data) or 1
+        with open(self._dict_path(codec, dict_id), 'wb') as f:
+            f.write(data)
+        with open(os.path.join(self.dict_dir, ACTIVE_DICT_FILE), 'w') as f:
+            f.write(os.path.basename(self._dict_path(codec, dict_id)))
+        self._active = None
+        return dict_id
+    
+    # 压缩与解压
+    def _zstd(self, kind, dict_id):
+        # zstd压缩/解压对象不能跨线程共享，按线程缓存
+        cache = self._local.__dict__.setdefault('zstd', {})
+        key = (kind, dict_id)
+        if key not in cache:
+            dict_data = None
+            if dict_id:
+                dict_data = zstandard.ZstdCompressionDict(self._load_dictionary(CODEC_ZSTD, dict_id))
+            if kind == 'c':
+                cache[key] = zstandard.ZstdCompressor(level=self.level, dict_data=dict_data)
+            else:
+                cache[key] = zstandard.ZstdDecompressor(dict_data=dict_data)
+        return cache[key]
+    
+    def compress(self, raw, codec=None, dict_id=None):
+        if codec is None:
+            codec, dict_id = self.active_dictionary()
+        if codec == CODEC_ZSTD:
+            payload = self._zstd('c', dict_id).compress(raw)
+        else:
+            if dict_id:
+                compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15,
+                                              zdict=self._load_dictionary(CODEC_ZLIB, dict_id))
+            else:
+                compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+            payload = compressor.compress(raw) + compressor.flush()
+        return HEADER.pack(MAGIC, codec, dict_id or 0) + payload
+    
+    def decompress(self, blob):
+        _, codec, dict_id = HEADER.unpack_from(blob)
+        payload = bytes(blob[HEADER.size:])
+        if codec == CODEC_ZSTD:
+            if zstandard is None:
+                raise RuntimeError('消息内容使用zstd压缩，但未安装zstandard')
+            return self._zstd('d', dict_id).decompress(payload)
+        if dict_id:
+            decompressor = zlib.decompressobj(-15, zdict=self._load_dictionary(CODEC_ZLIB, dict_id))
+        else:
+            decompressor = zlib.decompressobj(-15)
+        return decompressor.decompress(payload) + decompressor.flush()
+    
+    def encode(self, text):
+        """写入前编码：短文本原样保存，长文本压缩后若更小则保存为二进制"""
+        if text is None or not self.enabled:
+            return text
+        raw = text.encode('utf-8')
+        if len(raw) < self.threshold:
+            return text
+        blob = self.compress(raw)
+        return blob if len(blob) < len(raw) else text
+    
+    def decode(self, value):
+        """读取后解码：兼容未压缩的历史文本"""
+        if isinstance(value, (bytes, memoryview)):
+            if bytes(value[:len(MAGIC)]) == MAGIC:
+                return self.decompress(value).decode('utf-8')
+            return bytes(value).decode('utf-8')
+        return value
+
+def _segments(text):
+    # 按句子和分句切分，长度过短的片段压缩收益低
+    for segment in re.split(r'[\n。！？!?]', text):
+        segment = segment.strip()
+        if len(segment) >= 4:
+            yield segment
+        for clause in re.split(r'[，,；;]', segment):
+            clause = clause.strip()
+            if 4 <= len(clause) < len(segment):
+                yield clause
+
+def train_zlib_dictionary(samples, size=32768):
+    """从历史回复中统计高频片段构建zlib预置字典
+    
+    按 出现文档数 × 字节长度 评分，收益越高的片段越靠近字典末尾（deflate对近距离引用编码更短）
+    """
+    counter = Counter()
+    for text in samples:
+        counter.update(set(_segments(text)))
+    
+    scored = sorted(
+        ((count * len(segment.encode('utf-8')), segment) for segment, count in counter.items() if count >= 2),
+        reverse=True
+    )
+    chosen = []
+    total = 0
+    for _, segment in scored:
+        encoded = segment.encode('utf-8')
+        if total + len(encoded) > size:
+            continue
+        chosen.append(encoded)
+        total += len(encoded)
+    return b''.join(reversed(chosen))
+
+def train_dictionary(samples, size=32768):
+    """训练字典，优先使用zstd，样本不足以训练时退回zlib字典"""
+    if zstandard is not None:
+        try:
+            trained = zstandard.train_dictionary(size, [text.encode('utf-8') for text in samples])
+            return CODEC_ZSTD, trained.as_bytes()
+        except zstandard.ZstdError:
+            pass
+    return CODEC_ZLIB, train_zlib_dictionary(samples, size)
+
+content_codec = ContentCodec(
+    threshold=app_config.CONTENT_COMPRESSION_THRESHOLD,
+    dict_dir=app_config.CONTENT_DICT_DIRECTORY,
+    enabled=app_config.CONTENT_COMPRESSION_ENABLED
+)
+
+def sqlite_content_text(value):
+    """注册为SQLite函数content_text()，供全文检索触发器和视图读取明文"""
+    return content_codec.decode(value)
+
+class CompressedText(TypeDecorator):
+    """透明压缩的文本列 - 仅在SQLite上压缩（PostgreSQL的TOAST已自带压缩）"""
+    
+    impl = Text
+    cache_ok = True
+    
+    def process_bind_param(self, value, dialect):
+        if dialect.name != 'sqlite':
+            return value
+        return content_codec.encode(value)
+    
+    def process_result_value(self, value, dialect):
+        return content_codec.decode(value)
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+AI旅行助手 - 对话事件推送模块
+新消息和景点提取结果通过共享的事件日志推送给各worker的SSE订阅者
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import delete, func, insert, select
+
+from config import app_config
+from models import MESSAGE_LIST_COLUMNS, ConversationEvent, Message, db, serialize_message_rows
+from sharding import shard_for, use_shard
+
+logger = logging.getLogger(f'app.{__name__}')
+
+class EventSubscription:
+    """一个SSE连接的待发送队列，不占用线程；积压超过上限时关闭，由客户端按Last-Event-ID重连补发"""
+    
+    MAX_PENDING = 1000
+    
+    def __init__(self, conversation_id, last_id=0):
+        self.conversation_id = conversation_id
+        self.last_id = last_id
+        self.overflowed = False
+        self._lock = threading.Lock()
+        self._pending = []
+        self._ready = threading.Event()
+    
+    def put(self, event_id, text):
+        with self._lock:
+            self._append(event_id, text)
+    
+    def replay(self, load):
+        """补发load()返回的历史事件；期间轮询线程推送的事件等待补发完成，再按ID去重"""
+        with self._lock:
+            for event_id, _, text in load():
+                self._append(event_id, text)
+    
+    def _append(self, event_id, text):
+        # 重连补发和轮询推送可能重叠，按事件ID去重
+        if event_id <= self.last_id or self.overflowed:
+            return
+        self.last_id = event_id
+        if len(self._pending) >= self.MAX_PENDING:
+            self.overflowed = True
+        else:
+            self._pending.append(text)
+        self._ready.set()
+    
+    def get(self, timeout):
+        """等待最多timeout秒，返回待发送的事件文本列表；积压溢出时返回None"""
+        self._ready.wait(timeout)
+        with self._lock:
+            if self.overflowed:
+                return None
+            pending, self._pending = self._pending, []
+            self._ready.clear()
+            return pending
+
+class ConversationEventBroker:
+    """
+    对话事件推送 - conversation_events 表作为各worker共享的事件日志
+    
+    每个worker只有一个轮询线程：读取新事件，每个事件只加载和序列化一次，再分发给本进程内订阅该对话的连接。
+    没有订阅者时轮询线程休眠；订阅者只是待发送队列，配合gevent worker每个worker可以保持数千个空闲连接。
+    """
+    
+    POLL_BATCH = 500
+    PRUNE_EVERY = 500  # 每记录N个事件清理一次过期事件
+    
+    def __init__(self, poll_interval, heartbeat_seconds, retention_seconds, max_subscribers, enabled=True):
+        self.poll_interval = poll_interval
+        self.heartbeat_seconds = heartbeat_seconds
+        self.retention_seconds = retention_seconds
+        self.max_subscribers = max_subscribers
+        self.enabled = enabled
+        self.reset()
+    
+    def reset(self):
+        """fork后在子进程内调用：父进程的订阅者和轮询线程不属于子进程"""
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._subscribers = {}  # conversation_id -> {EventSubscription}
+        self._subscriber_count = 0
+        self._thread = None
+        self._pid = None
+        self._last_ids = {}  # 分片 -> 已读取的最大事件ID（各分片的事件ID独立分配）
+        self._recorded = 0
+        self._app = None  # 轮询线程读取事件时使用的应用，订阅时记录
+    
+    # 写入
+    def record(self, events):
+        """在当前事务中记录事件，events: [(conversation_id, kind, message_id)]"""
+        if not self.enabled or not events:
+            return
+        db.session.execute(insert(ConversationEvent), [
+            {'conversation_id': conversation_id, 'kind': kind, 'message_id': message_id, 'created_at': datetime.utcnow()}
+            for conversation_id, kind, message_id in events
+        ])
+        self._recorded += len(events)
+        if self._recorded >= self.PRUNE_EVERY:
+            self._recorded = 0
+            cutoff = datetime.utcnow() - timedelta(seconds=self.retention_seconds)
+            db.session.execute(delete(ConversationEvent).where(ConversationEvent.created_at < cutoff))
+    
+    # 订阅
+    def subscribe(self, conversation_id, last_event_id=None):
+        """订阅对话事件；给出last_event_id时先补发之后仍保留的事件。订阅者已满时返回None"""
+        subscription = EventSubscription(conversation_id, last_event_id or 0)
+        shard = use_shard(shard_for(conversation_id))
+        with self._lock:
+            if self._subscriber_count >= self.max_subscribers:
+                return None
+            if shard not in self._last_ids:
+                # 轮询线程尚未读取该分片时从当前最新事件开始，订阅之后提交的事件都会推送
+                self._last_ids[shard] = db.session.query(func.max(ConversationEvent.id)).scalar() or 0
+            self._subscribers.setdefault(conversation_id, set()).add(subscription)
+            self._subscriber_count += 1
+            self._app = current_app._get_current_object()
+        self._ensure_started()
+        
+        if last_event_id is not None:
+            subscription.replay(lambda: self._load(ConversationEvent.conversation_id == conversation_id,
+                                                   ConversationEvent.id > last_event_id))
+        return subscription
+    
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.conversation_id)
+            if subscribers and subscription in subscribers:
+                subscribers.discard(subscription)
+                self._subscriber_count -= 1
+                if not subscribers:
+                    del self._subscribers[subscription.conversation_id]
+    
+    def subscriber_count(self):
+        return self._subscriber_count
+    
+    # 轮询
+    def _ensure_started(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._thread = threading.Thread(target=self._run, name='conversation-events', daemon=True)
+                self._thread.start()
+                self._pid = os.getpid()
+        self._wakeup.set()
+    
+    def _run(self):
+        while True:
+            with self._lock:
+                idle = not self._subscribers
+                if idle:
+                    # 无人订阅时不轮询，下次订阅重新从最新事件开始
+                    self._last_ids = {}
+                    self._wakeup.clear()
+            if idle:
+                self._wakeup.wait()
+                continue
+            try:
+                self.poll()
+            except Exception as e:
+                logger.error(f'💥 轮询对话事件失败: {str(e)}')
+            time.sleep(self.poll_interval)
+    
+    def poll(self):
+        """读取各分片上次之后的新事件并分发给订阅者，返回分发的事件数"""
+        with self._lock:
+            shards = list(self._last_ids)
+        events = []
+        with (self._app or current_app._get_current_object()).app_context():
+            try:
+                for shard in shards:
+                    use_shard(shard)
+                    events.extend(self._poll_shard(shard))
+            finally:
+                db.session.remove()
+        
+        for event_id, conversation_id, text in events:
+            with self._lock:
+                subscribers = list(self._subscribers.get(conversation_id, ()))
+            for subscription in subscribers:
+                subscription.put(event_id, text)
+        return len(events)
+    
+    def _poll_shard(self, shard):
+        rows = (db.session.query(ConversationEvent.id, ConversationEvent.conversation_id)
+                .filter(ConversationEvent.id > self._last_ids[shard])
+                .order_by(ConversationEvent.id).limit(self.POLL_BATCH).all())
+        if not rows:
+            return []
+        first_id, last_id = rows[0][0], rows[-1][0]
+        self._last_ids[shard] = last_id
+        
+        # 只为有订阅者的对话加载消息
+        with self._lock:
+            wanted = {conversation_id for _, conversation_id in rows if conversation_id in self._subscribers}
+        if not wanted:
+            return []
+        return self._load(ConversationEvent.id.between(first_id, last_id),
+                          ConversationEvent.conversation_id.in_(wanted))
+    
+    def _load(self, *criteria):
+        """加载事件对应的消息和景点，返回 [(事件ID, 对话ID, SSE文本)]；消息已删除的事件跳过"""
+        rows = db.session.execute(
+            select(ConversationEvent.id, ConversationEvent.conversation_id,
+                   ConversationEvent.kind, ConversationEvent.message_id)
+            .where(*criteria).order_by(ConversationEvent.id).limit(self.POLL_BATCH)
+        ).all()
+        messages = {}
+        if rows:
+            message_rows = db.session.execute(
+                select(*MESSAGE_LIST_COLUMNS).where(Message.id.in_({row.message_id for row in rows}))
+            ).all()
+            messages = {data['id']: data for data in serialize_message_rows(message_rows)}
+        
+        events = []
+        for row in rows:
+            message = messages.get(row.message_id)
+            if message is None:
+                continue
+            if row.kind == 'message':
+                payload = message
+            else:
+                payload = {
+                    'message_id': message['id'],
+                    'attractions': message.get('attractions', []),
+                    'attractions_status': message.get('attractions_status')
+                }
+            data = json.dumps(payload, ensure_ascii=False)
+            events.append((row.id, row.conversation_id, f'id: {row.id}\nevent: {row.kind}\ndata: {data}\n\n'))
+        return events
+
+event_broker = ConversationEventBroker(
+    app_config.EVENTS_POLL_INTERVAL,
+    app_config.EVENTS_HEARTBEAT_SECONDS,
+    app_config.EVENTS_RETENTION_SECONDS,
+    app_config.EVENTS_MAX_SUBSCRIBERS,
+    enabled=app_config.EVENTS_ENABLED
+)
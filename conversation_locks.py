@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+AI旅行助手 - 对话锁模块
+同一对话的轮次在所有worker之间串行执行
+"""
+
+import fcntl
+import os
+
+from config import app_config
+
+class ConversationLocks:
+    """
+    对话锁 - 同一对话的轮次在所有worker之间串行执行，不同对话互不影响
+    
+    每个对话在本机目录中有自己的锁文件，持有其排他flock即持有锁；flock属于打开的文件，
+    同一进程的不同线程之间同样互斥，进程退出时由内核释放。锁文件按ID范围分到子目录，对话删除时持锁删除；
+    取锁后核对路径仍指向所持有的文件，取到已被删除的旧文件时重新打开，删除与取锁交错时也不会出现两个持有者。
+    """
+    
+    FILES_PER_DIRECTORY = 10000
+    
+    def __init__(self, directory, enabled=True):
+        self.directory = directory
+        self.enabled = enabled
+    
+    def _path(self, conversation_id):
+        conversation_id = int(conversation_id)
+        return os.path.join(self.directory, str(conversation_id // self.FILES_PER_DIRECTORY),
+                            f'conversation-{conversation_id}.lock')
+    
+    def try_acquire(self, conversation_id):
+        """取得对话锁，返回持有锁的文件描述符；已有轮次持有时返回None"""
+        path = self._path(conversation_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        while True:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                return None
+            try:
+                current = os.stat(path)
+            except FileNotFoundError:
+                current = None
+            opened = os.fstat(fd)
+            if current is not None and (current.st_dev, current.st_ino) == (opened.st_dev, opened.st_ino):
+                return fd
+            # 打开后、取锁前文件被删除，持有的是旧文件的锁，重新打开
+            self.release(fd)
+    
+    def release(self, fd):
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+    
+    def discard(self, conversation_ids):
+        """持锁删除已删除对话的锁文件；锁仍被持有时保留文件，避免删除与持有者交错产生第二个持有者"""
+        for conversation_id in conversation_ids:
+            fd = self.try_acquire(conversation_id)
+            if fd is None:
+                continue
+            try:
+                os.unlink(self._path(conversation_id))
+            finally:
+                self.release(fd)
+
+conversation_locks = ConversationLocks(
+    app_config.CONVERSATION_LOCK_DIRECTORY,
+    enabled=app_config.CONVERSATION_LOCK_ENABLED
+)
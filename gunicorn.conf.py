@@ -14,6 +14,9 @@ load_dotenv()
 # 服务器配置
 bind = f"{os.getenv('HOST', '127.0.0.1')}:{os.getenv('PORT', 5000)}"
 workers = int(os.getenv('GUNICORN_WORKERS', 4))
+# 对话事件推送（SSE）是长连接，sync worker下每个订阅连接独占一个worker；
+# 需要保持大量订阅连接时设置 GUNICORN_WORKER_CLASS=gevent，每个订阅连接只是一个协程
+events_enabled = os.getenv('EVENTS_ENABLED', 'True').lower() == 'true'
 worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'sync')
 worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', 1000))
 max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', 1000))
@@ -36,6 +39,11 @@ timeout = int(os.getenv('GUNICORN_TIMEOUT', 120))
 keepalive = int(os.getenv('GUNICORN_KEEPALIVE', 5))
 preload_app = os.getenv('GUNICORN_PRELOAD_APP', 'True').lower() == 'true'
 
+if worker_class == 'gevent':
+    # 在master加载（preload）应用之前打补丁，模块级的锁、线程和socket都使用gevent的协作式实现
+    from gevent import monkey
+    monkey.patch_all()
+
 # SSL配置（如果需要）
 keyfile = os.getenv('SSL_KEYFILE', None)
 certfile = os.getenv('SSL_CERTFILE', None)
@@ -50,6 +58,24 @@ def when_ready(server):
     server.log.info("🚀 AI旅行助手 Gunicorn 服务启动完成")
     server.log.info(f"📍 绑定地址: {bind}")
     server.log.info(f"👥 工作进程数: {workers}")
+    if events_enabled and worker_class == 'sync':
+        server.log.warning("⚠️ sync worker下每个事件订阅连接占用一个worker，订阅较多时请使用 GUNICORN_WORKER_CLASS=gevent")
+    
+    if preload_app:
+        # 在fork worker之前预加载只读数据，worker以写时复制方式共享
+        from app import warm_shared_state
+        warm_shared_state()
+
+def post_fork(server, worker):
+    """worker进程fork后配置应用日志，重建数据库连接池、进程池等不能跨进程共享的资源"""
+    from app import init_worker, setup_logging
+    setup_logging()
+    init_worker()
+
+def post_worker_init(worker):
+    """worker进程初始化完成后启动进程内后台任务（线程不会跨fork继承）"""
+    from app import start_background_jobs
+    start_background_jobs()
 
 def on_exit(server):
     """服务器退出时的回调"""
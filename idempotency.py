@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+AI旅行助手 - 聊天请求幂等模块
+客户端用同一幂等键重试聊天请求时返回首次请求的响应
+"""
+
+import hashlib
+import json
+import uuid
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, insert, or_, select, update
+from sqlalchemy.exc import IntegrityError
+
+from config import app_config
+from models import IdempotencyKey, db
+
+class IdempotencyStore:
+    """聊天接口幂等键 - 记录保存在主库的 idempotency_keys 表，所有worker共享
+    
+    首次请求插入执行中的记录后执行，完成后保存响应；相同幂等键的重试返回保存的响应，
+    首次请求仍在执行时立即告知客户端稍后重试，不重新执行也不占用worker等待。执行租约过期（worker异常退出）的记录由重试接管。
+    """
+    
+    PRUNE_EVERY = 1000  # 每插入N条记录清理一次已过期的记录
+    
+    def __init__(self, ttl_seconds, lease_seconds, retry_after, enabled=True):
+        self.ttl = timedelta(seconds=ttl_seconds)
+        self.lease = timedelta(seconds=lease_seconds)
+        self.retry_after = retry_after
+        self.enabled = enabled
+        self._inserts = 0
+    
+    @staticmethod
+    def fingerprint(payload):
+        """请求体的摘要，与JSON的键顺序和空白无关"""
+        canonical = json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+    
+    def claim(self, user_id, key, fingerprint):
+        """
+        尝试取得幂等键的执行权
+        
+        Returns:
+            tuple: (owner, None) 由本请求执行；(None, 记录) 已有其他请求的记录；
+                   (None, None) 记录在读取前被删除，调用方应重试
+        """
+        table = IdempotencyKey.__table__
+        now = datetime.utcnow()
+        owner = uuid.uuid4().hex
+        values = {'fingerprint': fingerprint, 'owner': owner, 'status_code': None, 'response': None,
+                  'locked_until': now + self.lease, 'expires_at': now + self.ttl, 'created_at': now}
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(insert(table).values(user_id=user_id, key=key, **values))
+        except IntegrityError:
+            pass
+        else:
+            self._prune(now)
+            return owner, None
+        
+        matches = (table.c.user_id == user_id) & (table.c.key == key)
+        with db.engine.begin() as connection:
+            # 已过期的记录，或同一请求租约已过期的执行中记录，由本请求接管
+            stale = or_(table.c.expires_at < now,
+                        (table.c.status_code.is_(None)) & (table.c.locked_until < now) &
+                        (table.c.fingerprint == fingerprint))
+            if connection.execute(update(table).where(matches, stale).values(**values)).rowcount:
+                return owner, None
+            record = connection.execute(select(table.c.fingerprint, table.c.status_code, table.c.response)
+                                        .where(matches)).first()
+        return None, record
+    
+    def acquire(self, user_id, key, fingerprint):
+        """取得执行权或读取已有记录，返回值同claim；记录在读取前被删除时重新尝试"""
+        while True:
+            owner, record = self.claim(user_id, key, fingerprint)
+            if owner is not None or record is not None:
+                return owner, record
+    
+    def complete(self, user_id, key, owner, status_code, body):
+        """保存响应，从现在起保留 IDEMPOTENCY_TTL_SECONDS"""
+        table = IdempotencyKey.__table__
+        with db.engine.begin() as connection:
+            connection.execute(update(table)
+                               .where(table.c.user_id == user_id, table.c.key == key, table.c.owner == owner)
+                               .values(status_code=status_code, response=body, locked_until=None,
+                                       expires_at=datetime.utcnow() + self.ttl))
+    
+    def release(self, user_id, key, owner):
+        """删除执行中的记录，重试时重新执行"""
+        table = IdempotencyKey.__table__
+        with db.engine.begin() as connection:
+            connection.execute(delete(table)
+                               .where(table.c.user_id == user_id, table.c.key == key, table.c.owner == owner))
+    
+    def _prune(self, now):
+        self._inserts += 1
+        if self._inserts % self.PRUNE_EVERY == 0:
+            table = IdempotencyKey.__table__
+            with db.engine.begin() as connection:
+                connection.execute(delete(table).where(table.c.expires_at < now))
+
+idempotency = IdempotencyStore(
+    app_config.IDEMPOTENCY_TTL_SECONDS,
+    app_config.IDEMPOTENCY_LEASE_SECONDS,
+    app_config.IDEMPOTENCY_RETRY_AFTER,
+    enabled=app_config.IDEMPOTENCY_ENABLED
+)
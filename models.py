@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+AI旅行助手 - 数据模型模块
+对话、消息、景点等ORM模型，以及只读接口共用的列查询序列化
+"""
+
+import json
+import os
+import uuid
+import zlib
+from datetime import datetime
+
+import pytz
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import delete, event, func, insert, select
+
+from config import dify_config
+from content_codec import CompressedText
+from sharding import ShardRoutingSession, conversation_id_sequence, shard_count, shard_for, use_shard
+from text_cleaning import clean_ai_text
+
+try:
+    import zstandard
+except ImportError:  # 可选依赖，未安装时归档使用zlib压缩
+    zstandard = None
+
+# 初始化数据库扩展，由create_app绑定到应用
+db = SQLAlchemy(session_options={'class_': ShardRoutingSession})
+
+def display_timezone():
+    """接口返回时间使用的时区，默认北京时间"""
+    return pytz.timezone(os.getenv('TIMEZONE', 'Asia/Shanghai'))
+
+# 数据库模型
+class Conversation(db.Model):
+    """对话会话模型"""
+    __tablename__ = 'conversations'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    title = db.Column(db.String(255), nullable=False)
+    dify_conversation_id = db.Column(db.String(255), nullable=True)  # 存储Dify的对话ID
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    archived_at = db.Column(db.DateTime, nullable=True)  # 非空表示消息已移入归档库
+    user_id = db.Column(db.String(128), nullable=True, default=dify_config.DEFAULT_USER_ID)  # 对话所属用户
+    
+    messages = db.relationship('Message', backref='conversation', lazy=True, cascade='all, delete-orphan')
+    
+    # 对话列表按用户等值 + 更新时间倒序读取，检索和删除也按用户限定范围
+    __table_args__ = (db.Index('ix_conversations_user_id_updated_at', 'user_id', 'updated_at'),)
+    
+    def message_count(self):
+        """统计消息数量，不加载消息行"""
+        if self.archived_at:
+            archive = db.session.get(ConversationArchive, self.id)
+            return archive.message_count if archive else 0
+        return db.session.query(func.count(Message.id)).filter(Message.conversation_id == self.id).scalar()
+    
+    def to_dict(self):
+        return Conversation.serialize(self, self.message_count(), display_timezone())
+    
+    @staticmethod
+    def serialize(row, message_count, tz):
+        """ORM对象和只读查询的列元组共用的序列化，row只需具备同名属性"""
+        return {
+            'id': row.id,
+            'title': row.title,
+            'dify_conversation_id': row.dify_conversation_id,
+            'created_at': row.created_at.replace(tzinfo=pytz.UTC).astimezone(tz).strftime('%Y-%m-%d %H:%M:%S'),
+            'message_count': message_count,
+            'archived': row.archived_at is not None
+        }
+
+class Message(db.Model):
+    """聊天消息模型"""
+    __tablename__ = 'messages'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    conversation_id = db.Column(db.Integer, db.ForeignKey('conversations.id'), nullable=False)
+    content = db.Column(CompressedText, nullable=False)  # 超过阈值的长回复压缩存储
+    display_content = db.Column(CompressedText, nullable=True)  # AI回复移除坐标信息后的展示文本，写入时生成
+    sender_type = db.Column(db.String(10), nullable=False)  # 'user' or 'ai'
+    attractions_status = db.Column(db.String(10), nullable=True)  # AI消息景点提取状态: 'pending'/'ready'/'failed'
+    turn_id = db.Column(db.String(32), nullable=True, index=True)  # 写后队列的对话轮次ID，恢复日志重放时用于去重
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    attractions = db.relationship('Attraction', backref='message', lazy=True,
+                                  cascade='all, delete-orphan', order_by='Attraction.position')
+    
+    # 按对话分页、增量同步和统计都是 conversation_id 等值 + id 范围查询
+    __table_args__ = (db.Index('ix_messages_conversation_id_id', 'conversation_id', 'id'),)
+    
+    def display_text(self):
+        """用于展示的文本：AI回复移除坐标信息，用户消息原样返回"""
+        return Message.display_text_of(self)
+    
+    @staticmethod
+    def display_text_of(row):
+        if row.sender_type != 'ai':
+            return row.content
+        if row.display_content is None:  # 尚未回填的历史消息
+            return clean_ai_text(row.content)
+        return row.display_content
+    
+    def to_dict(self, with_attractions=False):
+        attractions = None
+        if with_attractions and self.sender_type == 'ai':
+            attractions = [attraction.to_dict() for attraction in self.attractions]
+        return Message.serialize(self, display_timezone(), attractions)
+    
+    @staticmethod
+    def serialize(row, tz, attractions=None):
+        """ORM对象和只读查询的列元组共用的序列化；attractions为None时不附带景点字段"""
+        created_beijing = row.created_at.replace(tzinfo=pytz.UTC).astimezone(tz)
+        
+        data = {
+            'id': row.id,
+            'content': row.content,
+            'display_content': Message.display_text_of(row),
+            'sender_type': row.sender_type,
+            'turn_id': row.turn_id,
+            'created_at': created_beijing.strftime('%H:%M:%S'),
+            'timestamp': created_beijing.isoformat()
+        }
+        
+        # AI消息附带已持久化的景点，前端无需再次解析content
+        if attractions is not None:
+            data['attractions'] = attractions
+            data['attractions_status'] = row.attractions_status
+        
+        return data
+
+@event.listens_for(Message, 'before_insert')
+def fill_display_content(mapper, connection, message):
+    """AI回复写入时生成一次展示文本，读取时不再逐条清理"""
+    if message.sender_type == 'ai' and message.display_content is None:
+        message.display_content = clean_ai_text(message.content)
+
+class Attraction(db.Model):
+    """景点模型 - 持久化AI回复中提取的景点，写入一次后直接读取"""
+    __tablename__ = 'attractions'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    message_id = db.Column(db.Integer, db.ForeignKey('messages.id'), nullable=False, index=True)
+    position = db.Column(db.Integer, nullable=False, default=0)  # 在回复中的顺序
+    name = db.Column(db.String(255), nullable=False, index=True)
+    address = db.Column(db.String(255), nullable=True)
+    latitude = db.Column(db.Float, nullable=True)
+    longitude = db.Column(db.Float, nullable=True)
+    image = db.Column(db.String(500), nullable=True)
+    type = db.Column(db.String(50), nullable=False, default='景点')
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    @staticmethod
+    def build_rows(message_id, extracted):
+        """将extract_attractions的结果转换为attractions表的行数据"""
+        rows = []
+        for position, item in enumerate(extracted):
+            coordinates = item.get('coordinates') or {}
+            rows.append({
+                'message_id': message_id,
+                'position': position,
+                'name': item['name'][:255],
+                'address': (item.get('address') or '')[:255],
+                'latitude': coordinates.get('lat'),
+                'longitude': coordinates.get('lng'),
+                'image': item.get('image'),
+                'type': item.get('type', '景点'),
+                'created_at': datetime.utcnow()
+            })
+        return rows
+    
+    def to_dict(self):
+        return Attraction.serialize(self)
+    
+    @staticmethod
+    def serialize(row):
+        # 保持与extract_attractions相同的结构，id由消息ID和顺序确定，刷新后保持稳定
+        data = {
+            'id': f'attraction_{row.message_id}_{row.position}',
+            'name': row.name,
+            'address': row.address,
+            'image': row.image,
+            'type': row.type
+        }
+        if row.latitude is not None and row.longitude is not None:
+            data['coordinates'] = {'lat': row.latitude, 'lng': row.longitude}
+        return data
+
+class ConversationEvent(db.Model):
+    """对话事件日志 - 新消息和景点提取结果随业务数据在同一事务中写入，各worker轮询后推送给SSE订阅者"""
+    __tablename__ = 'conversation_events'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    conversation_id = db.Column(db.Integer, nullable=False)  # 不设外键，删除对话后事件到期清理
+    kind = db.Column(db.String(20), nullable=False)  # 'message' / 'attractions'
+    message_id = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    
+    # 断线重连时按 conversation_id + id 范围补发
+    __table_args__ = (db.Index('ix_conversation_events_conversation_id_id', 'conversation_id', 'id'),)
+
+class ConversationArchive(db.Model):
+    """对话归档模型 - 冷对话的消息和景点以压缩JSON形式存放在独立的归档库"""
+    __bind_key__ = 'archive'
+    __tablename__ = 'conversation_archives'
+    
+    conversation_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    message_count = db.Column(db.Integer, nullable=False, default=0)
+    codec = db.Column(db.String(10), nullable=False)  # 'zstd' or 'zlib'
+    payload = db.Column(db.LargeBinary, nullable=False)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    @staticmethod
+    def pack(records):
+        raw = json.dumps(records, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        if zstandard is not None:
+            return 'zstd', zstandard.ZstdCompressor(level=9).compress(raw)
+        return 'zlib', zlib.compress(raw, 9)
+    
+    def unpack(self):
+        if self.codec == 'zstd':
+            if zstandard is None:
+                raise RuntimeError('归档使用zstd压缩，但未安装zstandard')
+            raw = zstandard.ZstdDecompressor().decompress(self.payload)
+        else:
+            raw = zlib.decompress(self.payload)
+        return json.loads(raw.decode('utf-8'))
+
+class PendingTurn(db.Model):
+    """排队轮次 - 同一对话已有轮次在执行时，新消息在此等待，由持有对话锁的后台线程按ID顺序执行"""
+    __tablename__ = 'pending_turns'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    conversation_id = db.Column(db.Integer, nullable=False)  # 不设外键，对话删除后排队轮次执行前丢弃
+    user_id = db.Column(db.String(128))
+    content = db.Column(db.Text, nullable=False)
+    turn_id = db.Column(db.String(32), default=lambda: uuid.uuid4().hex)  # 返回给客户端，执行后写入本轮两条消息的turn_id
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (db.Index('ix_pending_turns_conversation_id_id', 'conversation_id', 'id'),)
+
+class IdempotencyKey(db.Model):
+    """聊天请求幂等键 - 保存首次请求的响应，客户端用同一 Idempotency-Key 重试时直接返回，不再调用Dify和写入消息
+    记录只在主库中，分片模式下也通过 db.engine 访问，不经过分片路由"""
+    __tablename__ = 'idempotency_keys'
+    
+    user_id = db.Column(db.String(128), primary_key=True)
+    key = db.Column(db.String(255), primary_key=True)
+    fingerprint = db.Column(db.String(64), nullable=False)  # 请求体摘要，同一幂等键不能用于不同的请求
+    owner = db.Column(db.String(32), nullable=False)  # 执行中的请求，租约过期被接管后原请求不能再写入结果
+    status_code = db.Column(db.Integer)  # 为空表示首次请求仍在执行
+    response = db.Column(db.Text)
+    locked_until = db.Column(db.DateTime)  # 执行租约，超过后视为执行请求已异常退出
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+def new_conversation(title, user_id):
+    """构造新对话并选择其所属分片；分片模式下ID由主库的序列表分配，保证跨分片唯一"""
+    if shard_count() <= 1:
+        return Conversation(title=title, user_id=user_id)
+    with db.engine.begin() as connection:
+        conversation_id = connection.execute(insert(conversation_id_sequence)).inserted_primary_key[0]
+        # AUTOINCREMENT记录历史最大值，序列表只需保留最新一行
+        connection.execute(delete(conversation_id_sequence).where(conversation_id_sequence.c.id < conversation_id))
+    use_shard(shard_for(conversation_id))
+    return Conversation(id=conversation_id, title=title, user_id=user_id)
+
+# 只读列表接口直接查询列元组并序列化，不构造ORM对象、不进入identity map，
+# 输出与各模型的to_dict相同；ORM对象只用于写入路径
+MESSAGE_LIST_COLUMNS = (Message.id, Message.content, Message.display_content, Message.sender_type,
+                        Message.turn_id, Message.attractions_status, Message.created_at)
+ATTRACTION_LIST_COLUMNS = (Attraction.message_id, Attraction.position, Attraction.name, Attraction.address,
+                           Attraction.latitude, Attraction.longitude, Attraction.image, Attraction.type)
+
+def serialize_message_rows(rows):
+    """将消息列元组序列化为接口数据，AI消息的景点按消息ID一次批量读取"""
+    attractions = {row.id: [] for row in rows if row.sender_type == 'ai'}
+    if attractions:
+        attraction_rows = db.session.execute(
+            select(*ATTRACTION_LIST_COLUMNS)
+            .where(Attraction.message_id.in_(attractions))
+            .order_by(Attraction.message_id, Attraction.position, Attraction.id)
+        )
+        for row in attraction_rows:
+            attractions[row.message_id].append(Attraction.serialize(row))
+    tz = display_timezone()
+    return [Message.serialize(row, tz, attractions.get(row.id)) for row in rows]
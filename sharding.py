@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+AI旅行助手 - 分片路由模块
+对话按ID的一致性哈希分布到多个SQLite分片库，会话按选择的分片路由对话数据的读写
+"""
+
+from flask import current_app
+from flask_sqlalchemy.session import Session as FlaskSession
+from sqlalchemy import Column, Integer, MetaData, Table
+
+class ShardRoutingSession(FlaskSession):
+    """分片模式下把默认库上的表（对话、消息、景点、事件）路由到 info['shard'] 选择的分片库，归档库等其他bind不变
+    
+    分片由use_shard选择，随会话在请求结束时丢弃；未选择分片就访问对话数据时直接报错，避免误读主库
+    """
+    
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        engine = super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+        if bind is not None or shard_count() <= 1 or engine is not self._db.engines.get(None):
+            return engine
+        shard = self.info.get('shard')
+        if shard is None:
+            raise RuntimeError('分片模式下访问对话数据前需先选择分片')
+        return self._db.engines[shard]
+
+# SQLite分片存储 - 主库只保存对话ID序列，对话、消息、景点和事件都在对话所属的分片库中
+shard_catalog = MetaData()
+conversation_id_sequence = Table('conversation_id_sequence', shard_catalog,
+                                 Column('id', Integer, primary_key=True), sqlite_autoincrement=True)
+
+def shard_count():
+    return current_app.config.get('SHARD_COUNT', 1)
+
+def jump_consistent_hash(key, buckets):
+    """Jump Consistent Hash（Lamping & Veach）：分片数从N增加到N+1时只有约1/(N+1)的键改变归属"""
+    bucket, candidate = -1, 0
+    while candidate < buckets:
+        bucket = candidate
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        candidate = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+def shard_for(conversation_id, count=None):
+    """对话所属分片的bind key；未分片时为None（默认库）"""
+    count = count or shard_count()
+    if count <= 1:
+        return None
+    return f'shard-{jump_consistent_hash(int(conversation_id), count)}'
+
+def shard_keys():
+    """全部分片的bind key；未分片时只有默认库"""
+    count = shard_count()
+    return [f'shard-{index}' for index in range(count)] if count > 1 else [None]
+
+def _session():
+    # 模型模块的db以ShardRoutingSession为会话类，这里从当前应用取得该扩展，避免反向导入
+    return current_app.extensions['sqlalchemy'].session()
+
+def current_shard():
+    return _session().info.get('shard')
+
+def use_shard(shard):
+    """
+    选择当前会话访问的分片
+    
+    切换前把未flush的修改写入原分片，并移出原分片的对象：各分片的消息ID独立分配，
+    不同分片的同ID对象不能共存于一个identity map
+    """
+    session = _session()
+    if session.info.get('shard') != shard:
+        if session.new or session.dirty or session.deleted:
+            session.flush()
+        session.expunge_all()
+        session.info['shard'] = shard
+    return shard
+
+def each_shard(shards=None):
+    """依次选择每个分片（未分片时只有默认库），结束后恢复原来的选择"""
+    previous = current_shard()
+    try:
+        for shard in (shard_keys() if shards is None else shards):
+            use_shard(shard)
+            yield shard
+    finally:
+        use_shard(previous)
+
+def group_by_shard(conversation_ids):
+    """按所属分片分组对话ID: {分片: [对话ID]}"""
+    groups = {}
+    for conversation_id in conversation_ids:
+        groups.setdefault(shard_for(conversation_id), []).append(conversation_id)
+    return groups
@@ -661,55 +661,6 @@ function App() {
     setCurrentScreen('main');
   };
 
-  // 清理AI文本，移除经纬度等技术信息
-  const cleanAIText = useCallback((text: string): string => {
-    console.log('原始AI文本:', text);
-    let cleanedText = text;
-    
-    // 移除经纬度信息的各种格式
-    const coordinatePatterns = [
-      // 中文标识的坐标
-      /经纬度[：:]?\s*[0-9.-]+\s*[,，]\s*[0-9.-]+/g,
-      /纬度[：:]?\s*[0-9.-]+/g,
-      /经度[：:]?\s*[0-9.-]+/g,
-      /坐标[：:]?\s*[0-9.-]+\s*[,，]\s*[0-9.-]+/g,
-      // 括号内的坐标信息
-      /\([^)]*经度[^)]*\)/g,
-      /\([^)]*纬度[^)]*\)/g,
-      /\([^)]*坐标[^)]*\)/g,
-      // 纯数字坐标格式（较精确的格式）
-      /\b[0-9]{1,3}\.[0-9]{5,8}\s*[,，]\s*[0-9]{1,3}\.[0-9]{5,8}\b/g,
-      // GPS坐标格式
-      /GPS[：:]?\s*[0-9.-]+\s*[,，]\s*[0-9.-]+/g,
-      // 位置坐标格式
-      /位置[：:]?\s*[0-9.-]+\s*[,，]\s*[0-9.-]+/g,
-      // 地理坐标
-      /地理坐标[：:]?\s*[0-9.-]+\s*[,，]\s*[0-9.-]+/g,
-    ];
-    
-    coordinatePatterns.forEach(pattern => {
-      cleanedText = cleanedText.replace(pattern, '');
-    });
-    
-    // 清理因移除坐标信息而产生的多余格式
-    cleanedText = cleanedText
-      // 移除空的冒号行
-      .replace(/^[：:]\s*$/gm, '')
-      // 移除连续的换行符
-      .replace(/\n\s*\n\s*\n/g, '\n\n')
-      // 移除行首行尾的冒号和空格
-      .replace(/^\s*[：:]\s*/gm, '')
-      .replace(/\s*[：:]\s*$/gm, '')
-      // 清理首尾空格
-      .replace(/^\s+|\s+$/g, '')
-      // 清理行首行尾空格
-      .replace(/\n\s+/g, '\n')
-      .replace(/\s+\n/g, '\n');
-    
-    console.log('清理后AI文本:', cleanedText);
-    return cleanedText;
-  }, []);
-
   // 发送消息 - 使用 useRef 来避免闭包问题
   const handleSendMessage = useCallback(async (messageText: string) => {
     const userMessage: Message = {
@@ -723,8 +674,9 @@ function App() {
     setIsTyping(true);
 
     try {
-      // 发送消息到后端
-      const response = await chatApi.sendMessage(messageText, conversationIdRef.current || undefined);
+      // 发送消息到后端；每次提交生成一个幂等键，重试沿用同一个键
+      const idempotencyKey = crypto.randomUUID();
+      const response = await chatApi.sendMessageWithRetry(messageText, conversationIdRef.current || undefined, idempotencyKey);
       
       if (response.success && response.data) {
         // 更新对话ID
@@ -732,10 +684,29 @@ function App() {
           setCurrentConversationId(response.data.conversation_id);
         }
 
+        if (response.data.queued) {
+          // 上一条消息仍在生成，本条已排队：按入队返回的turn_id等待本轮的AI回复
+          const reply = await chatApi.waitForQueuedReply(String(response.data.conversation_id), response.data);
+          setMessages(prev => [...prev, reply ? {
+            id: String(reply.id),
+            text: reply.display_content ?? reply.content,
+            isAI: true,
+            timestamp: new Date(reply.timestamp),
+            attractions: reply.attractions || []
+          } : {
+            id: (Date.now() + 1).toString(),
+            text: '排队的消息等待回复超时，请稍后刷新对话查看。',
+            isAI: true,
+            timestamp: new Date()
+          }]);
+          return;
+        }
+
         // 添加AI回复
         const aiMessage: Message = {
           id: response.data.ai_message.id,
-          text: cleanAIText(response.data.ai_message.content),
+          // 后端写入时已移除经纬度等技术信息
+          text: response.data.ai_message.display_content ?? response.data.ai_message.content,
           isAI: true,
           timestamp: new Date(response.data.ai_message.timestamp),
           attractions: response.data.attractions || []
@@ -8,14 +8,19 @@ export interface ApiResponse<T = any> {
   error?: string;
   message?: string;
   code?: string;
+  retryAfter?: number; // 错误响应的Retry-After（秒）
 }
 
 export interface ChatMessage {
   id: string;
   content: string;
+  display_content?: string; // AI回复移除经纬度等技术信息后的展示文本
   sender_type: 'user' | 'ai';
+  turn_id?: string | null; // 排队消息入队时返回的ID，本轮的用户消息和AI回复都带有该ID
   created_at: string;
   timestamp: string;
+  attractions?: Attraction[];
+  attractions_status?: string;
 }
 
 export interface ChatResponse {
@@ -23,14 +28,34 @@ export interface ChatResponse {
   user_message: ChatMessage;
   ai_message: ChatMessage;
   attractions?: Attraction[];
+  // 同一对话的上一条消息仍在生成时本条排队（HTTP 202），只返回以下字段，回复通过对话事件推送
+  queued?: boolean;
+  turn_id?: string;
+  position?: number;
+  after_event_id?: number | null; // 入队时的最新事件ID，从这里订阅不会错过本轮回复；事件推送未启用时为null
+  after_message_id?: number; // 入队时对话的最大消息ID，轮询新消息的起点
 }
 
+// 等待排队消息回复的时限（每个排在前面的轮次）和轮询间隔
+const QUEUED_REPLY_TIMEOUT_MS = 180_000;
+const QUEUED_POLL_INTERVAL_MS = 3_000;
+
+// 发送消息的重试：网络错误最多重试的次数，首次请求仍在处理（409）时按Retry-After重试的总时长
+const SEND_NETWORK_RETRIES = 2;
+const SEND_IN_PROGRESS_WINDOW_MS = 120_000;
+
+const sleep = (ms: number) => new Promise((resolve) => setTimeout(resolve, ms));
+
 export interface Attraction {
   id: string;
   name: string;
   address: string;
   image: string;
   type: string;
+  coordinates?: {
+    lat: number;
+    lng: number;
+  };
 }
 
 export interface LocationInfo {
@@ -75,7 +100,16 @@ async function request<T>(endpoint: string, options: RequestInit = {}): Promise<
     const data = await response.json();
 
     if (!response.ok) {
-      throw new Error(data.error || data.message || `HTTP ${response.status}`);
+      // 保留服务端的错误码和Retry-After，调用方据此决定是否重试
+      console.error(`API请求失败 [${endpoint}]: HTTP ${response.status}`, data);
+      const retryAfter = Number(response.headers.get('Retry-After'));
+      return {
+        ...data,
+        success: false,
+        error: data.error || data.message || `HTTP ${response.status}`,
+        code: data.code || `HTTP_${response.status}`,
+        ...(retryAfter > 0 ? { retryAfter } : {})
+      };
     }
 
     return data;
@@ -91,10 +125,13 @@ async function request<T>(endpoint: string, options: RequestInit = {}): Promise<
 
 // 聊天API
 export const chatApi = {
-  // 发送消息
-  async sendMessage(message: string, conversationId?: string): Promise<ApiResponse<ChatResponse>> {
+  // 发送消息（重试同一条消息时传入相同的idempotencyKey，服务端返回首次的结果而不是再生成一次）
+  async sendMessage(message: string, conversationId?: string, idempotencyKey?: string): Promise<ApiResponse<ChatResponse>> {
     return request<ChatResponse>('/chat/send', {
       method: 'POST',
+      ...(idempotencyKey ? {
+        headers: { 'Content-Type': 'application/json', 'Idempotency-Key': idempotencyKey }
+      } : {}),
       body: JSON.stringify({
         message,
         conversation_id: conversationId
@@ -102,6 +139,20 @@ export const chatApi = {
     });
   },
 
+  // 发送消息，网络错误或同一幂等键的首次请求仍在处理（409）时用同一个键重试，服务端不会重复生成回复
+  async sendMessageWithRetry(message: string, conversationId: string | undefined, idempotencyKey: string): Promise<ApiResponse<ChatResponse>> {
+    const startedAt = Date.now();
+    let networkRetries = 0;
+    for (;;) {
+      const response = await this.sendMessage(message, conversationId, idempotencyKey);
+      const inProgress = response.code === 'IDEMPOTENCY_IN_PROGRESS' && Date.now() - startedAt < SEND_IN_PROGRESS_WINDOW_MS;
+      const networkError = response.code === 'NETWORK_ERROR' && networkRetries < SEND_NETWORK_RETRIES;
+      if (!inProgress && !networkError) return response;
+      if (networkError) networkRetries += 1;
+      await sleep((response.retryAfter ?? 1) * 1000);
+    }
+  },
+
   // 检查AI服务状态
   async checkStatus(): Promise<ApiResponse<{ status: string; message: string; timestamp: string }>> {
     return request('/health');
@@ -112,9 +163,101 @@ export const chatApi = {
     return request('/conversations');
   },
 
-  // 获取对话消息
-  async getMessages(conversationId: string): Promise<ApiResponse<any>> {
-    return request(`/conversations/${conversationId}/messages`);
+  // 获取对话消息（传入afterId时只返回比它新的消息）
+  async getMessages(conversationId: string, afterId?: number): Promise<ApiResponse<any>> {
+    const query = afterId !== undefined ? `?after_id=${afterId}` : '';
+    return request(`/conversations/${conversationId}/messages${query}`);
+  },
+
+  // 批量增量同步：cursors为 {对话ID: 已有的最大消息ID}
+  async syncMessages(cursors: Record<string, number>, limit?: number): Promise<ApiResponse<{ conversations: Record<string, { messages: any[]; has_more: boolean }>; missing: number[] }>> {
+    return request('/messages/sync', {
+      method: 'POST',
+      body: JSON.stringify({ cursors, limit })
+    });
+  },
+
+  // 订阅对话事件（SSE），返回取消订阅函数；断线后浏览器自动重连并按Last-Event-ID补发
+  // 给出lastEventId时先补发它之后的事件；事件接口不可用（如未启用，返回404）时连接关闭并调用onClosed
+  subscribeConversation(
+    conversationId: string,
+    handlers: {
+      onMessage?: (message: any) => void;
+      onAttractions?: (data: { message_id: number; attractions: any[]; attractions_status: string }) => void;
+      onClosed?: () => void;
+    },
+    lastEventId?: number
+  ): () => void {
+    const query = lastEventId !== undefined ? `?last_event_id=${lastEventId}` : '';
+    const source = new EventSource(`${API_BASE_URL}/conversations/${conversationId}/events${query}`);
+    source.addEventListener('message', (event) => handlers.onMessage?.(JSON.parse((event as MessageEvent).data)));
+    source.addEventListener('attractions', (event) => handlers.onAttractions?.(JSON.parse((event as MessageEvent).data)));
+    source.onerror = () => {
+      if (source.readyState === EventSource.CLOSED) handlers.onClosed?.();
+    };
+    return () => source.close();
+  },
+
+  // 等待排队消息的AI回复：按turn_id匹配，从入队时的事件位置订阅；事件推送不可用时轮询入队之后的新消息。
+  // 超时或本轮执行失败未保存回复时返回null
+  waitForQueuedReply(conversationId: string, queued: ChatResponse): Promise<ChatMessage | null> {
+    return new Promise((resolve) => {
+      let settled = false;
+      let reply: ChatMessage | null = null;
+      let unsubscribe = () => {};
+      let pollTimer: ReturnType<typeof setInterval> | undefined;
+      let afterMessageId = queued.after_message_id ?? 0;
+      const finish = (message: ChatMessage | null) => {
+        if (settled) return;
+        settled = true;
+        unsubscribe();
+        clearInterval(pollTimer);
+        clearTimeout(timer);
+        resolve(message);
+      };
+      // 超时时返回已收到但景点尚未提取完成的回复
+      const timer = setTimeout(() => finish(reply), QUEUED_REPLY_TIMEOUT_MS * Math.max(queued.position ?? 1, 1));
+      const isReply = (message: ChatMessage) => message.sender_type === 'ai' && message.turn_id === queued.turn_id;
+      const accept = (message: ChatMessage) => {
+        reply = message;
+        if (message.attractions_status !== 'pending') finish(message);
+      };
+      const poll = () => {
+        pollTimer = setInterval(async () => {
+          try {
+            const response = await this.getMessages(conversationId, afterMessageId);
+            const messages: ChatMessage[] = response.data?.messages || [];
+            const found = messages.find(isReply);
+            if (found) {
+              accept(found);
+            } else if (messages.length) {
+              afterMessageId = Math.max(afterMessageId, ...messages.map((message) => Number(message.id)));
+            }
+          } catch {
+            // 网络错误时等待下次轮询
+          }
+        }, QUEUED_POLL_INTERVAL_MS);
+      };
+
+      if (queued.after_event_id === null || queued.after_event_id === undefined) {
+        poll();
+        return;
+      }
+      unsubscribe = this.subscribeConversation(conversationId, {
+        onMessage: (message) => {
+          if (isReply(message)) accept(message);
+        },
+        onAttractions: (data) => {
+          if (reply && Number(reply.id) === data.message_id) {
+            finish({ ...reply, attractions: data.attractions, attractions_status: data.attractions_status });
+          }
+        },
+        onClosed: () => {
+          unsubscribe = () => {};
+          if (!settled) poll();
+        }
+      }, queued.after_event_id);
+    });
   },
 
   // 创建新对话
@@ -130,6 +273,22 @@ export const chatApi = {
     return request(`/conversations/${conversationId}`, {
       method: 'DELETE'
     });
+  },
+
+  // 批量删除对话
+  async batchDeleteConversations(ids: number[]): Promise<ApiResponse<{ deleted: number[]; missing: number[] }>> {
+    return request('/conversations/batch-delete', {
+      method: 'POST',
+      body: JSON.stringify({ ids })
+    });
+  },
+
+  // 移除文本中的经纬度等技术信息（与消息display_content规则一致）
+  async cleanText(text: string): Promise<ApiResponse<{ display_content: string }>> {
+    return request('/text/clean', {
+      method: 'POST',
+      body: JSON.stringify({ text })
+    });
   }
 };
 
@@ -7,31 +7,79 @@ AI旅行助手 - 测试文件
 
 import unittest
 import json
-from datetime import datetime
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
 from unittest.mock import patch, MagicMock
-from app import app, db, Conversation, Message, DifyService
+from app import (app, create_app, init_worker, DifyService, AttractionExtractionPool, StreamingAttractionExtractor,
+                 check_idle_connection, turn_pipeline, _save_turn, backfill_conversation_users, create_schema,
+                 rebalance_shards)
+from models import db, Conversation, Message, Attraction, ConversationArchive, ConversationEvent, IdempotencyKey, PendingTurn
+from sharding import shard_for, use_shard
+from archive import ArchiveWorker, bulk_insert
+from write_behind import WriteBehindQueue
+from admission import AdmissionController
+from idempotency import IdempotencyStore
+from conversation_locks import ConversationLocks
+from conversation_events import ConversationEventBroker
+from upstream_scheduler import UpstreamScheduler, UpstreamDropped
+from content_codec import ContentCodec, content_codec, train_zlib_dictionary
+from text_cleaning import clean_ai_text
+from sqlalchemy import event, text
+from sqlalchemy.exc import OperationalError
+
+try:
+    import psycopg2
+    import psycopg2.extensions
+except ImportError:  # 可选依赖，只有PostgreSQL集成测试需要
+    psycopg2 = None
+try:
+    import gevent
+except ImportError:  # 可选依赖，只有gevent worker冒烟测试需要
+    gevent = None
 import config
 
+def create_test_app():
+    """创建测试应用：主库和归档库是临时目录中的文件数据库，不会改动仓库中的database/travel.db
+    （:memory:库按线程各自一份，后台线程看不到请求写入的数据），返回 (应用, 临时目录)"""
+    workdir = tempfile.mkdtemp(prefix='travel_test_')
+    test_app = create_app({
+        'TESTING': True,
+        'WTF_CSRF_ENABLED': False,
+        'SQLALCHEMY_DATABASE_URI': f'sqlite:///{workdir}/travel.db',
+        'SQLALCHEMY_BINDS': {'archive': {'url': f'sqlite:///{workdir}/archive.db'}}
+    })
+    return test_app, workdir
+
+def destroy_test_app(app_context, workdir):
+    """释放测试应用的数据库连接并删除临时目录"""
+    db.session.remove()
+    for engine in db.engines.values():
+        engine.dispose()
+    app_context.pop()
+    shutil.rmtree(workdir, ignore_errors=True)
+
 class TestApp(unittest.TestCase):
     """应用测试类"""
     
     def setUp(self):
         """测试前准备"""
-        app.config['TESTING'] = True
-        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
-        app.config['WTF_CSRF_ENABLED'] = False
+        self.test_app, self.workdir = create_test_app()
         
-        self.app = app.test_client()
-        self.app_context = app.app_context()
+        self.app = self.test_app.test_client()
+        self.app_context = self.test_app.app_context()
         self.app_context.push()
         
-        db.create_all()
+        create_schema()
     
     def tearDown(self):
         """测试后清理"""
-        db.session.remove()
-        db.drop_all()
-        self.app_context.pop()
+        destroy_test_app(self.app_context, self.workdir)
     
     def test_health_check(self):
         """测试健康检查接口"""
@@ -42,6 +90,33 @@ class TestApp(unittest.TestCase):
         self.assertEqual(data['status'], 'ok')
         self.assertIn('timestamp', data)
     
+    def test_create_app_factory(self):
+        """测试应用工厂创建独立的应用实例，路由和命令均已注册"""
+        other = create_app({'TESTING': True, 'SQLALCHEMY_DATABASE_URI': f'sqlite:///{self.workdir}/other.db'})
+        self.assertIsNot(other, app)
+        self.assertIn('archive-conversations', other.cli.commands)
+        
+        response = other.test_client().get('/api/health')
+        self.assertEqual(response.status_code, 200)
+        
+        # 空闲连接检测只注册在PostgreSQL引擎的连接池上
+        self.assertFalse(event.contains(db.engine.pool, 'checkout', check_idle_connection))
+        
+        # 后台任务使用创建它的应用，而不是模块级应用
+        with other.app_context():
+            self.assertIs(ArchiveWorker(3600, os.devnull).flask_app, other)
+        self.assertIs(ArchiveWorker(3600, os.devnull).flask_app, self.test_app)
+    
+    def test_init_worker_resets_pools(self):
+        """测试fork后重建进程内资源：继承的排队位置被释放"""
+        pool = AttractionExtractionPool(max_workers=1, max_queue=2)
+        self.assertTrue(pool.reserve() and pool.reserve())
+        self.assertFalse(pool.reserve())
+        
+        with patch('app.attraction_pool', pool):
+            init_worker()
+        self.assertTrue(pool.reserve() and pool.reserve())
+    
     def test_create_conversation(self):
         """测试创建对话"""
         response = self.app.post('/api/conversations',
@@ -80,6 +155,42 @@ class TestApp(unittest.TestCase):
         data = json.loads(response.data)
         self.assertTrue(data['success'])
     
+    def test_batch_delete_conversations(self):
+        """测试批量删除按集合删除消息、景点和事件，不加载消息行"""
+        conversations = [Conversation(title=f'对话{i}') for i in range(3)]
+        db.session.add_all(conversations)
+        db.session.commit()
+        for conversation in conversations:
+            messages = [Message(conversation_id=conversation.id, content=f'消息{i}', sender_type='ai') for i in range(50)]
+            db.session.add_all(messages)
+            db.session.flush()
+            db.session.add(Attraction(message_id=messages[0].id, name='八达岭长城'))
+            db.session.add(ConversationEvent(conversation_id=conversation.id, kind='message', message_id=messages[0].id))
+        db.session.commit()
+        keep_id = conversations[2].id
+        delete_ids = [conversations[0].id, conversations[1].id]
+        db.session.expunge_all()
+        
+        loaded = []
+        listener = lambda target, context: loaded.append(target)
+        db.event.listen(Message, 'load', listener)
+        try:
+            response = self.app.post('/api/conversations/batch-delete', json={'ids': delete_ids + [9999]})
+        finally:
+            db.event.remove(Message, 'load', listener)
+        
+        data = json.loads(response.data)['data']
+        self.assertEqual(data['deleted'], delete_ids)
+        self.assertEqual(data['missing'], [9999])
+        self.assertEqual(loaded, [])
+        self.assertEqual([c.id for c in Conversation.query.all()], [keep_id])
+        self.assertEqual(Message.query.count(), 50)
+        self.assertEqual(Attraction.query.count(), 1)
+        self.assertEqual(ConversationEvent.query.count(), 1)
+        
+        self.assertEqual(self.app.delete(f'/api/conversations/{delete_ids[0]}').status_code, 404)
+        self.assertEqual(self.app.post('/api/conversations/batch-delete', json={'ids': 'x'}).status_code, 400)
+    
     def test_get_messages(self):
         """测试获取消息"""
         # 创建对话和消息
@@ -102,6 +213,227 @@ class TestApp(unittest.TestCase):
         self.assertTrue(data['success'])
         self.assertEqual(len(data['data']['messages']), 1)
     
+    def test_get_messages_pagination(self):
+        """测试消息按页返回最近的消息"""
+        conversation = Conversation(title='测试对话')
+        db.session.add(conversation)
+        db.session.commit()
+        db.session.add_all([
+            Message(conversation_id=conversation.id, content=f'消息{i}', sender_type='user')
+            for i in range(5)
+        ])
+        db.session.commit()
+        
+        response = self.app.get(f'/api/conversations/{conversation.id}/messages?limit=2')
+        data = json.loads(response.data)['data']
+        self.assertTrue(data['has_more'])
+        self.assertEqual([m['content'] for m in data['messages']], ['消息3', '消息4'])
+        
+        before_id = data['messages'][0]['id']
+        response = self.app.get(f'/api/conversations/{conversation.id}/messages?limit=10&before_id={before_id}')
+        data = json.loads(response.data)['data']
+        self.assertFalse(data['has_more'])
+        self.assertEqual([m['content'] for m in data['messages']], ['消息0', '消息1', '消息2'])
+    
+    def test_get_messages_default_page_signals_more_history(self):
+        """测试默认只返回最近一页时告知客户端还有更早的历史，并可据此取回全部消息"""
+        conversation = Conversation(title='测试对话')
+        db.session.add(conversation)
+        db.session.commit()
+        bulk_insert(Message, [{'conversation_id': conversation.id, 'content': f'消息{i}', 'sender_type': 'user',
+                               'created_at': datetime.utcnow()} for i in range(config.app_config.MESSAGES_PAGE_SIZE + 5)])
+        db.session.commit()
+        
+        data = self.app.get(f'/api/conversations/{conversation.id}/messages').get_json()['data']
+        self.assertEqual(len(data['messages']), config.app_config.MESSAGES_PAGE_SIZE)
+        self.assertTrue(data['has_more'])
+        self.assertEqual(data['oldest_id'], data['messages'][0]['id'])
+        
+        data = self.app.get(f"/api/conversations/{conversation.id}/messages?before_id={data['oldest_id']}").get_json()['data']
+        self.assertEqual([m['content'] for m in data['messages']], [f'消息{i}' for i in range(5)])
+        self.assertFalse(data['has_more'])
+    
+    def test_get_messages_after_id(self):
+        """测试after_id只返回更新的消息，按时间正序分页"""
+        conversation = Conversation(title='测试对话')
+        db.session.add(conversation)
+        db.session.commit()
+        messages = [Message(conversation_id=conversation.id, content=f'消息{i}', sender_type='user') for i in range(5)]
+        db.session.add_all(messages)
+        db.session.commit()
+        url = f'/api/conversations/{conversation.id}/messages'
+        
+        data = json.loads(self.app.get(f'{url}?after_id={messages[1].id}&limit=2').data)['data']
+        self.assertTrue(data['has_more'])
+        self.assertEqual([m['content'] for m in data['messages']], ['消息2', '消息3'])
+        
+        data = json.loads(self.app.get(f'{url}?after_id={data["messages"][-1]["id"]}&limit=2').data)['data']
+        self.assertFalse(data['has_more'])
+        self.assertEqual([m['content'] for m in data['messages']], ['消息4'])
+        
+        data = json.loads(self.app.get(f'{url}?after_id={messages[4].id}').data)['data']
+        self.assertEqual(data['messages'], [])
+        self.assertFalse(data['has_more'])
+    
+    def test_sync_messages(self):
+        """测试批量增量同步只返回有新消息的对话，已删除的对话放在missing中"""
+        first = Conversation(title='北京')
+        second = Conversation(title='上海')
+        db.session.add_all([first, second])
+        db.session.commit()
+        first_messages = [Message(conversation_id=first.id, content=f'北京{i}', sender_type='user') for i in range(3)]
+        second_message = Message(conversation_id=second.id, content='上海0', sender_type='user')
+        db.session.add_all(first_messages + [second_message])
+        db.session.commit()
+        
+        response = self.app.post('/api/messages/sync', json={'cursors': {
+            str(first.id): first_messages[0].id,
+            str(second.id): second_message.id,
+            '9999': 0
+        }})
+        data = json.loads(response.data)['data']
+        self.assertEqual(list(data['conversations']), [str(first.id)])
+        self.assertEqual([m['content'] for m in data['conversations'][str(first.id)]['messages']], ['北京1', '北京2'])
+        self.assertEqual(data['missing'], [9999])
+        
+        response = self.app.post('/api/messages/sync', json={'cursors': [first.id]})
+        self.assertEqual(response.status_code, 400)
+    
+    def test_conditional_get_conversations(self):
+        """测试对话列表未变化时返回304，新增和删除对话后ETag改变"""
+        first = Conversation(title='北京')
+        second = Conversation(title='上海')
+        db.session.add_all([first, second])
+        db.session.commit()
+        
+        response = self.app.get('/api/conversations')
+        etag = response.headers['ETag']
+        self.assertIn('Last-Modified', response.headers)
+        self.assertEqual(response.headers['Cache-Control'], 'no-cache')
+        
+        response = self.app.get('/api/conversations', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+        self.assertEqual(response.headers['ETag'], etag)
+        
+        # 删除较早的对话不改变最大更新时间，ETag仍要变化
+        self.app.delete(f'/api/conversations/{first.id}')
+        response = self.app.get('/api/conversations', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([c['title'] for c in json.loads(response.data)['data']], ['上海'])
+        
+        etag = response.headers['ETag']
+        db.session.add(Message(conversation_id=second.id, content='你好', sender_type='user'))
+        db.session.commit()
+        response = self.app.get('/api/conversations', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data)['data'][0]['message_count'], 1)
+    
+    def test_conditional_get_messages(self):
+        """测试消息列表未变化时返回304，新消息和异步景点提取完成后ETag改变"""
+        conversation = Conversation(title='测试对话')
+        db.session.add(conversation)
+        db.session.commit()
+        ai_message = Message(conversation_id=conversation.id, content='推荐：\n1. 八达岭长城\n万里长城精华段',
+                             sender_type='ai', attractions_status='pending')
+        db.session.add(ai_message)
+        db.session.commit()
+        url = f'/api/conversations/{conversation.id}/messages'
+        
+        etag = self.app.get(url).headers['ETag']
+        self.assertEqual(self.app.get(url, headers={'If-None-Match': etag}).status_code, 304)
+        self.assertNotEqual(self.app.get(f'{url}?limit=1').headers['ETag'], etag)
+        
+        ai_message.attractions_status = 'ready'
+        db.session.commit()
+        response = self.app.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data)['data']['messages'][0]['attractions_status'], 'ready')
+        
+        etag = response.headers['ETag']
+        db.session.add(Message(conversation_id=conversation.id, content='还有呢', sender_type='user'))
+        db.session.commit()
+        response = self.app.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(json.loads(response.data)['data']['messages']), 2)
+    
+    def test_list_endpoints_skip_orm(self):
+        """测试列表接口按列元组读取，输出与to_dict一致且不加载ORM对象"""
+        conversation = Conversation(title='测试对话')
+        empty = Conversation(title='空对话')
+        db.session.add_all([conversation, empty])
+        db.session.commit()
+        messages = [
+            Message(conversation_id=conversation.id, content='推荐北京景点', sender_type='user'),
+            Message(conversation_id=conversation.id, content='1. 故宫\n经纬度：39.916,116.397', sender_type='ai',
+                    attractions_status='ready'),
+            Message(conversation_id=conversation.id, content='历史回复 坐标：30.1,120.2', sender_type='ai')
+        ]
+        db.session.add_all(messages)
+        db.session.flush()
+        db.session.add_all([
+            Attraction(message_id=messages[1].id, position=1, name='天坛', address='东城区'),
+            Attraction(message_id=messages[1].id, position=0, name='故宫', latitude=39.916, longitude=116.397)
+        ])
+        messages[2].display_content = None  # 尚未回填展示文本的历史消息
+        db.session.commit()
+        expected_conversations = [c.to_dict() for c in Conversation.query.order_by(Conversation.updated_at.desc())]
+        expected_messages = [m.to_dict(with_attractions=True) for m in messages]
+        db.session.expunge_all()
+        
+        loaded = []
+        listener = lambda target, context: loaded.append(target)
+        for model in (Conversation, Message, Attraction):
+            db.event.listen(model, 'load', listener)
+        try:
+            conversations = json.loads(self.app.get('/api/conversations').data)['data']
+            page = json.loads(self.app.get(f'/api/conversations/{conversation.id}/messages').data)['data']
+        finally:
+            for model in (Conversation, Message, Attraction):
+                db.event.remove(model, 'load', listener)
+        
+        self.assertEqual(conversations, expected_conversations)
+        self.assertEqual(page['messages'], expected_messages)
+        self.assertEqual([a['name'] for a in page['messages'][1]['attractions']], ['故宫', '天坛'])
+        self.assertNotIn('attractions', page['messages'][0])
+        self.assertEqual([target for target in loaded if not isinstance(target, Conversation)], [])
+    
+    def test_archive_and_restore_conversation(self):
+        """测试冷对话归档后访问时透明恢复"""
+        cold = Conversation(title='去年的旅行', updated_at=datetime.utcnow() - timedelta(days=200))
+        hot = Conversation(title='最近的旅行')
+        db.session.add_all([cold, hot])
+        db.session.commit()
+        message = Message(conversation_id=cold.id, content='推荐：\n1. 八达岭长城\n万里长城精华段', sender_type='ai')
+        db.session.add(message)
+        db.session.commit()
+        db.session.add(Attraction(message_id=message.id, position=0, name='八达岭长城', latitude=40.3587, longitude=116.0154))
+        db.session.add(Message(conversation_id=hot.id, content='你好', sender_type='user'))
+        db.session.commit()
+        cold_id, message_id = cold.id, message.id
+        
+        result = self.test_app.test_cli_runner().invoke(args=['archive-conversations', '--days', '30', '--throttle', '0'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        
+        db.session.expire_all()
+        self.assertIsNotNone(db.session.get(Conversation, cold_id).archived_at)
+        self.assertIsNone(db.session.get(Conversation, hot.id).archived_at)
+        self.assertEqual(Message.query.filter_by(conversation_id=cold_id).count(), 0)
+        self.assertEqual(Attraction.query.count(), 0)
+        self.assertEqual(db.session.get(ConversationArchive, cold_id).message_count, 1)
+        
+        response = self.app.get('/api/conversations')
+        listed = {c['id']: c for c in json.loads(response.data)['data']}
+        self.assertTrue(listed[cold_id]['archived'])
+        self.assertEqual(listed[cold_id]['message_count'], 1)
+        
+        response = self.app.get(f'/api/conversations/{cold_id}/messages')
+        data = json.loads(response.data)['data']
+        self.assertFalse(data['conversation']['archived'])
+        self.assertEqual(data['messages'][0]['id'], message_id)
+        self.assertEqual(data['messages'][0]['attractions'][0]['coordinates'], {'lat': 40.3587, 'lng': 116.0154})
+        self.assertIsNone(db.session.get(ConversationArchive, cold_id))
+    
     @patch('app.dify_service.send_message')
     def test_send_message_success(self, mock_send):
         """测试发送消息成功"""
@@ -127,6 +459,64 @@ class TestApp(unittest.TestCase):
         self.assertIn('user_message', data['data'])
         self.assertIn('ai_message', data['data'])
     
+    @patch('app.dify_service.send_message')
+    def test_send_message_display_content(self, mock_send):
+        """测试AI回复写入时生成展示文本，发送和读取接口直接返回"""
+        answer = '1. 天安门广场\n地址：北京市东城区东长安街\n经纬度：39.903179,116.397755'
+        mock_send.return_value = {'success': True, 'data': {'answer': answer, 'conversation_id': 'test-conv-id'}}
+        
+        response = self.app.post('/api/chat/send', json={'message': '北京有什么景点'})
+        data = json.loads(response.data)['data']
+        expected = '1. 天安门广场\n地址：北京市东城区东长安街'
+        self.assertEqual(data['ai_message']['content'], answer)
+        self.assertEqual(data['ai_message']['display_content'], expected)
+        self.assertEqual(data['user_message']['display_content'], '北京有什么景点')
+        
+        message = db.session.get(Message, data['ai_message']['id'])
+        self.assertEqual(message.display_content, expected)
+        response = self.app.get(f"/api/conversations/{data['conversation_id']}/messages")
+        messages = json.loads(response.data)['data']['messages']
+        self.assertEqual(messages[-1]['display_content'], expected)
+        
+        # 历史消息回填
+        Message.query.update({'display_content': None})
+        db.session.commit()
+        result = self.test_app.test_cli_runner().invoke(args=['backfill-display-content'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        db.session.expire_all()
+        self.assertEqual(db.session.get(Message, data['ai_message']['id']).display_content, expected)
+        self.assertIsNone(db.session.get(Message, data['user_message']['id']).display_content)
+        
+        response = self.app.post('/api/text/clean', json={'text': answer})
+        self.assertEqual(json.loads(response.data)['data']['display_content'], expected)
+        self.assertEqual(self.app.post('/api/text/clean', json={'text': None}).status_code, 400)
+    
+    @patch('app.dify_service.stream_message')
+    def test_stream_message(self, mock_stream):
+        """测试流式发送：段落结束即推送景点，结束后持久化整轮对话"""
+        reply = '推荐：\n1. 西湖\n地址：浙江省杭州市西湖区龙井路1号\n2. 灵隐寺\n千年古刹\n3. 雷峰塔\n西湖十景之一'
+        chunks = [reply[i:i + 7] for i in range(0, len(reply), 7)]
+        mock_stream.return_value = iter(
+            [{'event': 'message', 'answer': chunk, 'conversation_id': 'stream-conv'} for chunk in chunks]
+            + [{'event': 'message_end', 'conversation_id': 'stream-conv'}]
+        )
+        
+        response = self.app.post('/api/chat/stream', json={'message': '杭州去哪玩'})
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        events = [(block.split('\n')[0][len('event: '):], json.loads(block.split('\n')[1][len('data: '):]))
+                  for block in response.get_data(as_text=True).strip().split('\n\n')]
+        names = [name for name, _ in events]
+        
+        self.assertEqual(''.join(data['answer'] for name, data in events if name == 'message'), reply)
+        self.assertEqual([data['name'] for name, data in events if name == 'attraction'], ['西湖', '灵隐寺', '雷峰塔'])
+        # 第一个景点在回复结束前推送
+        self.assertLess(names.index('attraction'), len(names) - names[::-1].index('message') - 1)
+        self.assertEqual(names[-1], 'done')
+        done = events[-1][1]
+        self.assertEqual([a['name'] for a in done['attractions']], ['西湖', '灵隐寺', '雷峰塔'])
+        self.assertEqual(Message.query.count(), 2)
+        self.assertEqual(db.session.get(Conversation, done['conversation_id']).dify_conversation_id, 'stream-conv')
+    
     @patch('app.dify_service.send_message')
     def test_send_message_failure(self, mock_send):
         """测试发送消息失败"""
@@ -147,6 +537,264 @@ class TestApp(unittest.TestCase):
         self.assertTrue(data['success'])  # 即使AI失败，也会保存失败消息
         self.assertIn('抱歉，AI服务暂时不可用', data['data']['ai_message']['content'])
     
+    @patch('app.dify_service.send_message')
+    def test_send_message_persists_attractions(self, mock_send):
+        """测试景点在发送时持久化，并随消息列表返回"""
+        mock_send.return_value = {
+            'success': True,
+            'data': {
+                'answer': '为您推荐：\n1. 八达岭长城\n地址：北京市延庆区八达岭镇\n经纬度：40.3587,116.0154\n2. 颐和园\n地址：北京市海淀区新建宫门路19号',
+                'conversation_id': 'test-conv-id'
+            }
+        }
+        
+        response = self.app.post('/api/chat/send',
+                                json={'message': '北京去哪玩', 'user_id': 'test_user'})
+        data = json.loads(response.data)['data']
+        self.assertEqual(len(data['attractions']), 2)
+        self.assertEqual(Attraction.query.count(), 2)
+        
+        response = self.app.get(f"/api/conversations/{data['conversation_id']}/messages?user_id=test_user")
+        messages = json.loads(response.data)['data']['messages']
+        ai_message = messages[-1]
+        self.assertEqual(ai_message['attractions'], data['attractions'])
+        self.assertEqual(ai_message['attractions'][0]['name'], '八达岭长城')
+        self.assertEqual(ai_message['attractions'][0]['coordinates'], {'lat': 40.3587, 'lng': 116.0154})
+        self.assertNotIn('attractions', messages[0])
+    
+    @patch('app.dify_service.send_message')
+    def test_send_message_async_attractions(self, mock_send):
+        """测试async模式下景点由后台进程池提取并写回"""
+        mock_send.return_value = {
+            'success': True,
+            'data': {'answer': '推荐：\n1. 八达岭长城\n万里长城精华段\n2. 颐和园\n皇家园林', 'conversation_id': 'c'}
+        }
+        pool = AttractionExtractionPool(max_workers=1, max_queue=4)
+        
+        with patch('app.attraction_pool', pool), \
+             patch.object(config.dify_config, 'ATTRACTION_EXTRACTION_MODE', 'async'):
+            response = self.app.post('/api/chat/send', json={'message': '北京去哪玩'})
+            data = json.loads(response.data)['data']
+            self.assertEqual(data['attractions'], [])
+            self.assertEqual(data['attractions_status'], 'pending')
+            
+            # 回调在提交之后才减少计数，wait返回True即写回已提交
+            self.assertTrue(pool.wait(timeout=30))
+            pool.shutdown()
+        
+        db.session.remove()
+        response = self.app.get(f"/api/messages/{data['ai_message']['id']}/attractions")
+        result = json.loads(response.data)['data']
+        self.assertEqual(result['status'], 'ready')
+        self.assertEqual([a['name'] for a in result['attractions']], ['八达岭长城', '颐和园'])
+    
+    @patch('app.dify_service.send_message')
+    def test_send_message_async_queue_full_falls_back(self, mock_send):
+        """测试后台队列满载时回退为同步提取"""
+        mock_send.return_value = {
+            'success': True,
+            'data': {'answer': '推荐：\n1. 八达岭长城\n万里长城精华段\n2. 颐和园\n皇家园林', 'conversation_id': 'c'}
+        }
+        
+        with patch('app.attraction_pool', AttractionExtractionPool(max_workers=1, max_queue=0)), \
+             patch.object(config.dify_config, 'ATTRACTION_EXTRACTION_MODE', 'async'):
+            response = self.app.post('/api/chat/send', json={'message': '北京去哪玩'})
+        
+        data = json.loads(response.data)['data']
+        self.assertEqual(data['attractions_status'], 'ready')
+        self.assertEqual(len(data['attractions']), 2)
+    
+    @patch('app.dify_service.extract_attractions', side_effect=ValueError('解析失败'))
+    @patch('app.dify_service.send_message')
+    def test_send_message_extraction_failure_keeps_turn(self, mock_send, mock_extract):
+        """测试景点提取出错时本轮消息仍已提交，景点状态标记为failed"""
+        mock_send.return_value = {'success': True, 'data': {'answer': '推荐：\n1. 八达岭长城', 'conversation_id': 'c'}}
+        
+        response = self.app.post('/api/chat/send', json={'message': '北京去哪玩'})
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data)['data']
+        self.assertEqual(data['attractions'], [])
+        self.assertEqual(data['attractions_status'], 'failed')
+        
+        db.session.remove()
+        messages = Message.query.filter_by(conversation_id=data['conversation_id']).order_by(Message.id).all()
+        self.assertEqual([m.sender_type for m in messages], ['user', 'ai'])
+        self.assertEqual(messages[1].attractions_status, 'failed')
+    
+    def test_backfill_attractions_command(self):
+        """测试历史消息的景点回填命令"""
+        conversation = Conversation(title='测试对话')
+        db.session.add(conversation)
+        db.session.commit()
+        db.session.add(Message(
+            conversation_id=conversation.id,
+            content='推荐：\n1. 西湖\n地址：浙江省杭州市西湖区龙井路1号\n2. 灵隐寺\n千年古刹\n3. 雷峰塔\n西湖十景之一',
+            sender_type='ai'
+        ))
+        db.session.commit()
+        
+        runner = self.test_app.test_cli_runner()
+        result = runner.invoke(args=['backfill-attractions', '--batch-size', '10'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual(Attraction.query.count(), 3)
+        
+        # 重复执行不会重复写入
+        runner.invoke(args=['backfill-attractions'])
+        self.assertEqual(Attraction.query.count(), 3)
+    
+    def test_search_history(self):
+        """测试全文检索对话标题和消息内容"""
+        conversation = Conversation(title='成都三日游')
+        other = Conversation(title='北京周末')
+        db.session.add_all([conversation, other])
+        db.session.commit()
+        db.session.add_all([
+            Message(conversation_id=conversation.id, content='推荐宽窄巷子和大熊猫繁育研究基地', sender_type='ai'),
+            Message(conversation_id=other.id, content='推荐故宫和<天坛>', sender_type='ai')
+        ])
+        db.session.commit()
+        
+        response = self.app.get('/api/search?q=大熊猫')
+        data = json.loads(response.data)['data']
+        self.assertEqual(len(data['results']), 1)
+        self.assertEqual(data['results'][0]['conversation_id'], conversation.id)
+        self.assertIn('<mark>大熊猫</mark>', data['results'][0]['snippet'])
+        
+        # 两个字的词无法使用trigram索引，回退为子串匹配
+        response = self.app.get('/api/search?q=成都')
+        data = json.loads(response.data)['data']
+        self.assertEqual(data['results'][0]['type'], 'conversation')
+        self.assertEqual(data['results'][0]['conversation_title'], '成都三日游')
+        
+        # 片段中的HTML会被转义
+        response = self.app.get('/api/search?q=天坛')
+        snippet = json.loads(response.data)['data']['results'][0]['snippet']
+        self.assertEqual(snippet, '推荐故宫和&lt;<mark>天坛</mark>&gt;')
+        
+        # 删除后索引同步更新
+        Message.query.filter_by(conversation_id=other.id).delete()
+        db.session.commit()
+        response = self.app.get('/api/search?q=天坛')
+        self.assertEqual(json.loads(response.data)['data']['results'], [])
+        
+        response = self.app.get('/api/search?q=')
+        self.assertEqual(response.status_code, 400)
+    
+    def test_search_ranks_older_matches(self):
+        """测试在全部命中中按相关度排序，早于大量新命中的最相关消息排在第一位"""
+        conversation = Conversation(title='行程')
+        db.session.add(conversation)
+        db.session.commit()
+        db.session.add(Message(conversation_id=conversation.id, content='大熊猫大熊猫大熊猫', sender_type='ai'))
+        db.session.commit()
+        bulk_insert(Message, [{'conversation_id': conversation.id, 'sender_type': 'ai',
+                               'content': f'第{i}天去看大熊猫，然后在附近吃饭逛街休息'} for i in range(250)])
+        
+        data = json.loads(self.app.get('/api/search?q=大熊猫&per_page=1').data)['data']
+        self.assertEqual(data['results'][0]['snippet'], '<mark>大熊猫</mark>' * 3)
+        self.assertTrue(data['has_more'])
+    
+    def test_search_pages_are_stable(self):
+        """测试逐页翻阅检索结果不重复、不遗漏"""
+        conversations = [Conversation(title=f'大熊猫之旅{i}') for i in range(3)]
+        db.session.add_all(conversations)
+        db.session.commit()
+        # 多条内容相同的消息相关度同分，翻页顺序依赖固定的次级排序
+        for i in range(22):
+            db.session.add(Message(conversation_id=conversations[i % 3].id, sender_type='ai',
+                                   content='大熊猫' if i % 2 else '去看大熊猫'))
+        db.session.commit()
+        
+        seen, page = [], 1
+        while True:
+            data = json.loads(self.app.get(f'/api/search?q=大熊猫&page={page}&per_page=4').data)['data']
+            seen.extend((r['type'], r['message_id'] or r['conversation_id']) for r in data['results'])
+            if not data['has_more']:
+                break
+            page += 1
+        self.assertEqual(len(seen), len(set(seen)))
+        self.assertEqual(len(seen), 25)
+        self.assertEqual(page, 7)
+    
+    def test_conversations_scoped_by_user(self):
+        """测试对话列表、检索和删除按user_id限定范围"""
+        mine = Conversation(title='成都三日游', user_id='alice')
+        theirs = Conversation(title='成都美食', user_id='bob')
+        legacy = Conversation(title='成都旧对话')
+        db.session.add_all([mine, theirs, legacy])
+        db.session.commit()
+        db.session.add_all([
+            Message(conversation_id=mine.id, content='推荐大熊猫繁育研究基地', sender_type='ai'),
+            Message(conversation_id=theirs.id, content='大熊猫基地附近的火锅', sender_type='ai')
+        ])
+        db.session.commit()
+        self.assertEqual(legacy.user_id, 'user')
+        
+        data = json.loads(self.app.get('/api/conversations?user_id=alice').data)['data']
+        self.assertEqual([c['id'] for c in data], [mine.id])
+        data = json.loads(self.app.get('/api/conversations').data)['data']
+        self.assertEqual([c['id'] for c in data], [legacy.id])
+        
+        response = self.app.post('/api/conversations', json={'title': '新对话', 'user_id': 'alice'})
+        self.assertEqual(db.session.get(Conversation, response.get_json()['data']['id']).user_id, 'alice')
+        
+        for query in ('大熊猫', '成都'):
+            results = json.loads(self.app.get(f'/api/search?q={query}&user_id=alice').data)['data']['results']
+            self.assertEqual({r['conversation_id'] for r in results}, {mine.id})
+        
+        mine_id, theirs_id = mine.id, theirs.id
+        self.assertEqual(self.app.delete(f'/api/conversations/{theirs_id}?user_id=alice').status_code, 404)
+        data = json.loads(self.app.post('/api/conversations/batch-delete',
+                                        json={'ids': [mine_id, theirs_id], 'user_id': 'alice'}).data)['data']
+        self.assertEqual(data, {'deleted': [mine_id], 'missing': [theirs_id]})
+        self.assertIsNotNone(db.session.get(Conversation, theirs_id))
+    
+    @patch('app.dify_service.stream_message')
+    @patch('app.dify_service.send_message')
+    def test_conversation_routes_check_owner(self, mock_send, mock_stream):
+        """测试按对话ID访问的接口对其他用户的对话返回404，与不存在的对话相同"""
+        theirs = Conversation(title='成都美食', user_id='bob')
+        db.session.add(theirs)
+        db.session.commit()
+        message = Message(conversation_id=theirs.id, content='推荐火锅', sender_type='ai')
+        db.session.add(message)
+        db.session.commit()
+        theirs_id, message_id = theirs.id, message.id
+        
+        self.assertEqual(self.app.get(f'/api/conversations/{theirs_id}/messages?user_id=bob').status_code, 200)
+        for user in ('alice', None):
+            query = f'?user_id={user}' if user else ''
+            body = {'user_id': user} if user else {}
+            response = self.app.get(f'/api/conversations/{theirs_id}/messages{query}')
+            self.assertEqual(response.status_code, 404)
+            self.assertEqual(response.get_json()['error'], '对话不存在')
+            self.assertEqual(self.app.get(f'/api/conversations/{theirs_id}/events{query}').status_code, 404)
+            self.assertEqual(self.app.get(f'/api/messages/{message_id}/attractions{query}').status_code, 404)
+            synced = self.app.post('/api/messages/sync', json={'cursors': {str(theirs_id): 0}, **body}).get_json()
+            self.assertEqual(synced['data'], {'conversations': {}, 'missing': [theirs_id]})
+            for path in ('/api/chat/send', '/api/chat/stream'):
+                response = self.app.post(path, json={'message': '再来', 'conversation_id': theirs_id, **body})
+                self.assertEqual(response.status_code, 404)
+        self.assertEqual(self.app.get('/api/conversations/9999/messages').status_code, 404)
+        
+        mock_send.assert_not_called()
+        mock_stream.assert_not_called()
+        self.assertEqual(Message.query.filter_by(conversation_id=theirs_id).count(), 1)
+        self.assertEqual(Conversation.query.count(), 1)
+    
+    def test_backfill_conversation_users(self):
+        """测试为新增user_id列之前的对话回填默认用户，不改变更新时间"""
+        updated_at = datetime(2025, 1, 1)
+        db.session.add_all([Conversation(title=f'对话{i}', updated_at=updated_at) for i in range(3)])
+        db.session.commit()
+        db.session.execute(text('UPDATE conversations SET user_id = NULL'))
+        db.session.commit()
+        
+        self.assertEqual(backfill_conversation_users(batch_size=2), 3)
+        self.assertEqual(backfill_conversation_users(), 0)
+        db.session.expire_all()
+        self.assertEqual({(c.user_id, c.updated_at) for c in Conversation.query.all()}, {('user', updated_at)})
+    
     def test_send_empty_message(self):
         """测试发送空消息"""
         response = self.app.post('/api/chat/send', 
@@ -200,27 +848,1068 @@ class TestDifyService(unittest.TestCase):
         attractions = self.dify_service.extract_attractions(text)
         
         self.assertEqual(attractions, [])
+    
+    def test_clean_ai_text(self):
+        """测试移除坐标信息，与前端cleanAIText结果一致"""
+        text = "1. 天安门广场\n地址：北京市东城区东长安街\n经纬度：39.903179,116.397755\n\n\n颐和园 (经度：116.273567，纬度：39.999912) 是皇家园林"
+        self.assertEqual(clean_ai_text(text),
+                         "1. 天安门广场\n地址：北京市东城区东长安街\n颐和园 (，) 是皇家园林")
+    
+    def test_adversarial_text_linear_time(self):
+        """测试触发正则回溯的长文本在线性时间内完成提取和清理"""
+        size = 20000
+        texts = ['推荐' + '好玩的地方' * (size // 5), '景' * size + '公园', '路街巷号' * (size // 4),
+                 '经纬度：' + '1' * size + ',', '(' * size, '\n' * size + '1', '\n' + ' ' * size + '好']
+        for text in texts:
+            start = time.perf_counter()
+            self.dify_service.extract_attractions(text)
+            clean_ai_text(text)
+            self.assertLess(time.perf_counter() - start, 1.0, text[:20])
+    
+    def test_extraction_time_budget(self):
+        """测试超出时间预算时返回已提取的景点"""
+        text = "推荐景点：\n1. 故宫博物院\n地址：北京市东城区景山前街4号\n2. 八达岭长城\n地址：北京市延庆区\n3. 颐和园\n地址：北京市海淀区新建宫门路19号"
+        self.assertEqual(len(self.dify_service.extract_attractions(text)), 3)
+        with patch.object(config.dify_config, 'EXTRACTION_TIME_BUDGET', 0):
+            self.assertEqual(self.dify_service.extract_attractions(text), [])
+        with patch.object(config.dify_config, 'EXTRACTION_MAX_CHARS', text.index('\n3.')):
+            self.assertEqual([a['name'] for a in self.dify_service.extract_attractions(text)], ['故宫博物院', '八达岭长城'])
+    
+    def test_streaming_extractor(self):
+        """测试增量提取：每个编号段落结束后立即产出，结果与整段提取一致"""
+        reply = '为您推荐：\n1. 故宫博物院\n地址：北京市东城区景山前街4号\n2. 八达岭长城\n经纬度：40.3587,116.0154\n3. 颐和园\n位于北京市海淀区'
+        extractor = StreamingAttractionExtractor(self.dify_service)
+        emitted = []
+        for i in range(len(reply)):
+            for attraction in extractor.feed(reply[i]):
+                emitted.append((i, attraction['name']))
+        emitted.extend((len(reply), attraction['name']) for attraction in extractor.finish())
+        
+        self.assertEqual([name for _, name in emitted], ['故宫博物院', '八达岭长城', '颐和园'])
+        self.assertEqual(emitted[0][0], reply.index('\n2. ') + len('\n2. '))
+        self.assertEqual(emitted[1][0], reply.index('\n3. ') + len('\n3. '))
+        strip_ids = lambda attractions: [{k: v for k, v in a.items() if k != 'id'} for a in attractions]
+        self.assertEqual(strip_ids(extractor.attractions), strip_ids(self.dify_service.extract_attractions(reply)))
+        
+        # 不足两个编号分割时回退为整段提取
+        extractor = StreamingAttractionExtractor(self.dify_service)
+        self.assertEqual(extractor.feed('杭州西湖景区\n\n风景优美'), [])
+        self.assertEqual([a['name'] for a in extractor.finish()], ['杭州西湖景区'])
+    
+    def test_connection_probe(self):
+        """测试连接探测请求应用参数接口，不发送对话消息"""
+        session = MagicMock()
+        session.get.return_value.status_code = 200
+        self.dify_service._session = session
+        self.dify_service._session_pid = os.getpid()
+        
+        with patch.object(self.dify_service, 'send_message') as mock_send:
+            self.dify_service.start_connection_probe().join(timeout=5)
+        
+        mock_send.assert_not_called()
+        self.assertEqual(session.get.call_args.args[0], config.dify_config.PARAMETERS_ENDPOINT)
+        self.assertTrue(self.dify_service.connection_status['success'])
 
 
-class TestModels(unittest.TestCase):
-    """数据模型测试类"""
+class TestContentCompression(unittest.TestCase):
+    """消息内容压缩测试类"""
+    
+    ITINERARY = '\n'.join(
+        f'{i}. 景点{i}号公园\n地址：北京市海淀区某某路{i}号\n推荐理由：环境优美，适合全家出游，建议预留半天时间。'
+        for i in range(1, 30)
+    )
     
     def setUp(self):
         """测试前准备"""
-        app.config['TESTING'] = True
-        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
+        self.test_app, self.workdir = create_test_app()
+        self.app = self.test_app.test_client()
+        self.app_context = self.test_app.app_context()
+        self.app_context.push()
+        create_schema()
         
-        self.app_context = app.app_context()
+        self.dict_dir = tempfile.mkdtemp()
+        self.original_dict_dir = content_codec.dict_dir
+        content_codec.dict_dir = self.dict_dir
+        content_codec._active = None
+    
+    def tearDown(self):
+        """测试后清理"""
+        content_codec.dict_dir = self.original_dict_dir
+        content_codec._active = None
+        shutil.rmtree(self.dict_dir, ignore_errors=True)
+        destroy_test_app(self.app_context, self.workdir)
+    
+    def _stored_type(self, message_id):
+        return db.session.execute(text('SELECT typeof(content) FROM messages WHERE id = :id'),
+                                  {'id': message_id}).scalar()
+    
+    def test_long_content_round_trip(self):
+        """测试长消息压缩存储、短消息原样存储"""
+        conversation = Conversation(title='测试对话')
+        db.session.add(conversation)
+        db.session.commit()
+        long_message = Message(conversation_id=conversation.id, content=self.ITINERARY, sender_type='ai')
+        short_message = Message(conversation_id=conversation.id, content='你好', sender_type='user')
+        db.session.add_all([long_message, short_message])
+        db.session.commit()
+        
+        self.assertEqual(self._stored_type(long_message.id), 'blob')
+        self.assertEqual(self._stored_type(short_message.id), 'text')
+        
+        db.session.expire_all()
+        self.assertEqual(db.session.get(Message, long_message.id).content, self.ITINERARY)
+        
+        # 全文检索读取解压后的明文
+        response = self.app.get('/api/search?q=景点12号公园')
+        results = json.loads(response.data)['data']['results']
+        self.assertEqual(results[0]['message_id'], long_message.id)
+    
+    def test_legacy_uncompressed_rows(self):
+        """测试兼容压缩前写入的长文本"""
+        conversation = Conversation(title='测试对话')
+        db.session.add(conversation)
+        db.session.commit()
+        db.session.execute(text(
+            "INSERT INTO messages (conversation_id, content, sender_type, created_at) VALUES (:cid, :content, 'ai', datetime())"),
+            {'cid': conversation.id, 'content': self.ITINERARY})
+        db.session.commit()
+        
+        message = Message.query.one()
+        self.assertEqual(self._stored_type(message.id), 'text')
+        self.assertEqual(message.content, self.ITINERARY)
+        
+        result = self.test_app.test_cli_runner().invoke(args=['compress-messages'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual(self._stored_type(message.id), 'blob')
+        db.session.expire_all()
+        self.assertEqual(db.session.get(Message, message.id).content, self.ITINERARY)
+    
+    def test_trained_dictionary(self):
+        """测试字典训练后旧数据仍可按原字典解压"""
+        codec = ContentCodec(threshold=64, dict_dir=self.dict_dir)
+        before = codec.encode(self.ITINERARY)
+        
+        samples = [self.ITINERARY.replace('北京', city) for city in ['上海', '杭州', '成都', '西安']]
+        codec.save_dictionary(b'z', train_zlib_dictionary(samples))
+        after = codec.encode(self.ITINERARY)
+        
+        self.assertLess(len(after), len(before))
+        self.assertEqual(codec.decode(before), self.ITINERARY)
+        self.assertEqual(codec.decode(after), self.ITINERARY)
+    
+    def test_train_dictionary_command(self):
+        """测试字典训练命令"""
+        conversation = Conversation(title='测试对话')
+        db.session.add(conversation)
+        db.session.commit()
+        db.session.add_all([
+            Message(conversation_id=conversation.id, content=self.ITINERARY.replace('北京', city), sender_type='ai')
+            for city in ['上海', '杭州', '成都']
+        ])
+        db.session.commit()
+        
+        result = self.test_app.test_cli_runner().invoke(args=['train-content-dictionary', '--size', '4096'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertNotEqual(content_codec.active_dictionary()[1], 0)
+
+
+class TestWriteBehind(unittest.TestCase):
+    """消息写后持久化测试类"""
+    
+    def setUp(self):
+        """测试前准备"""
+        self.test_app, self.workdir = create_test_app()
+        self.app = self.test_app.test_client()
+        self.app_context = self.test_app.app_context()
+        self.app_context.push()
+        create_schema()
+        
+        self.journal_dir = tempfile.mkdtemp()
+        # 提交间隔设得很长，验证读取时会主动提交
+        self.queue = WriteBehindQueue(self.journal_dir, batch_size=100, flush_interval=30,
+                                      fsync_policy='always', read_timeout=5)
+    
+    def tearDown(self):
+        """测试后清理"""
+        self.queue.stop()
+        shutil.rmtree(self.journal_dir, ignore_errors=True)
+        destroy_test_app(self.app_context, self.workdir)
+    
+    @patch('app.dify_service.send_message')
+    def test_send_message_write_behind(self, mock_send):
+        """测试写后模式下消息先入队，后续读取和发送能读到之前的写入"""
+        mock_send.return_value = {
+            'success': True,
+            'data': {'answer': '推荐：\n1. 八达岭长城\n万里长城精华段', 'conversation_id': 'test-conv-id'}
+        }
+        
+        with patch('app.write_behind', self.queue):
+            response = self.app.post('/api/chat/send', json={'message': '北京去哪玩'})
+            data = json.loads(response.data)['data']
+            conversation_id = data['conversation_id']
+            self.assertTrue(data['ai_message']['id'].endswith('-1'))
+            self.assertEqual([a['name'] for a in data['attractions']], ['八达岭长城'])
+            self.assertEqual(Message.query.count(), 0)
+            
+            # 同一对话的下一轮需要沿用已排队的Dify对话ID
+            self.app.post('/api/chat/send', json={'message': '还有呢', 'conversation_id': conversation_id})
+            self.assertEqual(mock_send.call_args.kwargs['conversation_id'], 'test-conv-id')
+            
+            response = self.app.get(f'/api/conversations/{conversation_id}/messages')
+            messages = json.loads(response.data)['data']['messages']
+        
+        self.assertEqual([m['content'] for m in messages[::2]], ['北京去哪玩', '还有呢'])
+        self.assertEqual(messages[1]['attractions'][0]['name'], '八达岭长城')
+        self.assertEqual(messages[1]['attractions_status'], 'ready')
+        self.assertEqual(db.session.get(Conversation, conversation_id).dify_conversation_id, 'test-conv-id')
+        self.assertEqual(len([name for name in os.listdir(self.journal_dir) if name.endswith('.log')]), 1)
+    
+    def test_recover_journal(self):
+        """测试重放遗留日志段，已提交的轮次不会重复写入"""
+        conversation = Conversation(title='恢复测试')
+        db.session.add(conversation)
+        db.session.commit()
+        
+        turns = [self.queue.build_turn(conversation.id, [('user', f'消息{i}', None, None)]) for i in range(3)]
+        lines = [json.dumps(turn, ensure_ascii=False) for turn in turns]
+        with open(os.path.join(self.journal_dir, 'journal-1-1.log'), 'w') as f:
+            f.write('\n'.join(lines[:2]) + '\n' + lines[2][:20])  # 最后一行写了一半
+        with open(os.path.join(self.journal_dir, 'journal-1-2.log'), 'w') as f:
+            f.write(lines[0] + '\n')
+        os.makedirs(self.queue.marker_dir, exist_ok=True)
+        
+        self.assertEqual(self.queue.recover(), 2)
+        db.session.expire_all()
+        self.assertEqual([m.content for m in Message.query.order_by(Message.id)], ['消息0', '消息1'])
+        self.assertEqual([name for name in os.listdir(self.journal_dir) if name.endswith('.log')], [])
+
+class TestAdmissionControl(unittest.TestCase):
+    """聊天接口准入控制测试类"""
+    
+    def setUp(self):
+        """测试前准备"""
+        self.test_app, self.workdir = create_test_app()
+        self.app = self.test_app.test_client()
+        self.app_context = self.test_app.app_context()
+        self.app_context.push()
+        create_schema()
+        
+        self.state_dir = tempfile.mkdtemp()
+        self.admission = AdmissionController(self.state_dir, user_burst=2, user_per_minute=60,
+                                             ip_burst=3, ip_per_minute=60, max_concurrent=1, busy_retry_after=5)
+    
+    def tearDown(self):
+        """测试后清理"""
+        shutil.rmtree(self.state_dir, ignore_errors=True)
+        destroy_test_app(self.app_context, self.workdir)
+    
+    def test_token_buckets(self):
+        """测试令牌桶按user_id和IP分别计数，不足时返回等待秒数且不扣减其他桶"""
+        for _ in range(2):
+            slot, rejection = self.admission.admit('alice', '10.0.0.1')
+            self.assertIsNone(rejection)
+            self.admission.release_slot(slot)
+        
+        slot, rejection = self.admission.admit('alice', '10.0.0.1')
+        self.assertIsNone(slot)
+        self.assertEqual(rejection[0], 'TOO_MANY_REQUESTS')
+        self.assertGreater(rejection[1], 0)
+        self.assertLessEqual(rejection[1], 1)
+        
+        # alice被拒绝时IP桶没有扣减，同一IP的其他用户还剩一个令牌
+        slot, rejection = self.admission.admit('bob', '10.0.0.1')
+        self.assertIsNone(rejection)
+        self.admission.release_slot(slot)
+        self.assertEqual(self.admission.admit('carol', '10.0.0.1')[1][0], 'TOO_MANY_REQUESTS')
+        
+        # 另一个控制器实例（模拟其他worker）看到同一份状态
+        other = AdmissionController(self.state_dir, 2, 60, 3, 60, 1, 5)
+        self.assertGreater(other.take([('user:alice', 2, 1)]), 0)
+        self.assertEqual(other.take([('user:dave', 2, 1)]), 0)
+    
+    def test_concurrency_slots(self):
+        """测试并发名额被占满时拒绝，释放后可以再次占用"""
+        slot = self.admission.acquire_slot()
+        self.assertIsNotNone(slot)
+        self.assertIsNone(self.admission.acquire_slot())
+        self.assertEqual(self.admission.admit('alice', '10.0.0.1')[1], ('SERVER_BUSY', 5))
+        self.admission.release_slot(slot)
+        
+        slot = self.admission.acquire_slot()
+        self.assertIsNotNone(slot)
+        self.admission.release_slot(slot)
+    
+    @patch('app.dify_service.send_message')
+    def test_send_message_rate_limited(self, mock_send):
+        """测试聊天接口超出限流或并发已满时返回429和Retry-After"""
+        mock_send.return_value = {'success': True, 'data': {'answer': '好的', 'conversation_id': 'test-conv-id'}}
+        
+        with patch('app.admission', self.admission):
+            for _ in range(2):
+                response = self.app.post('/api/chat/send', json={'message': '你好', 'user_id': 'alice'})
+                self.assertEqual(response.status_code, 200)
+            
+            response = self.app.post('/api/chat/send', json={'message': '你好', 'user_id': 'alice'})
+            self.assertEqual(response.status_code, 429)
+            self.assertEqual(response.headers['Retry-After'], '1')
+            data = json.loads(response.data)
+            self.assertFalse(data['success'])
+            self.assertEqual(data['code'], 'TOO_MANY_REQUESTS')
+            self.assertEqual(mock_send.call_count, 2)
+            
+            slot = self.admission.acquire_slot()
+            response = self.app.post('/api/chat/send', json={'message': '你好', 'user_id': 'bob'})
+            self.admission.release_slot(slot)
+            self.assertEqual(response.status_code, 429)
+            self.assertEqual(response.headers['Retry-After'], '5')
+            self.assertEqual(json.loads(response.data)['code'], 'SERVER_BUSY')
+
+class TestIdempotency(unittest.TestCase):
+    """聊天请求幂等键测试类"""
+    
+    def setUp(self):
+        """测试前准备（文件数据库，后台线程与请求看到同一份数据）"""
+        self.workdir = tempfile.mkdtemp(prefix='idempotency_')
+        self.idempotent_app = create_app({
+            'TESTING': True,
+            'SQLALCHEMY_DATABASE_URI': f'sqlite:///{self.workdir}/travel.db',
+            'SQLALCHEMY_BINDS': {'archive': {'url': f'sqlite:///{self.workdir}/archive.db'}}
+        })
+        self.app = self.idempotent_app.test_client()
+        self.app_context = self.idempotent_app.app_context()
+        self.app_context.push()
+        create_schema()
+        self.store = IdempotencyStore(ttl_seconds=60, lease_seconds=60, retry_after=2)
+        self.patcher = patch('app.idempotency', self.store)
+        self.patcher.start()
+    
+    def tearDown(self):
+        """测试后清理"""
+        self.patcher.stop()
+        db.session.remove()
+        for engine in db.engines.values():
+            engine.dispose()
+        self.app_context.pop()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+    
+    def send(self, body, key, **headers):
+        return self.app.post('/api/chat/send', json=body, headers={'Idempotency-Key': key, **headers})
+    
+    @patch('app.dify_service.send_message')
+    def test_retry_returns_stored_response(self, mock_send):
+        """测试相同幂等键的重试返回首次响应且不再调用Dify，键被用于不同请求或请求失败时的处理"""
+        mock_send.return_value = {'success': True, 'data': {'answer': '好的', 'conversation_id': 'test-conv-id'}}
+        body = {'message': '你好', 'user_id': 'alice'}
+        
+        first = self.send(body, 'key-1')
+        retry = self.send({'user_id': 'alice', 'message': '你好'}, 'key-1')
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(retry.status_code, 200)
+        self.assertEqual(retry.get_json(), first.get_json())
+        self.assertEqual(retry.headers['Idempotent-Replayed'], 'true')
+        self.assertNotIn('Idempotent-Replayed', first.headers)
+        self.assertEqual(mock_send.call_count, 1)
+        self.assertEqual(Message.query.count(), 2)
+        
+        # 幂等键按用户隔离；同一键用于不同内容时拒绝；键无效时400
+        self.assertNotIn('Idempotent-Replayed', self.send({'message': '你好', 'user_id': 'bob'}, 'key-1').headers)
+        self.assertEqual(self.send({'message': '再见', 'user_id': 'alice'}, 'key-1').status_code, 422)
+        self.assertEqual(self.send(body, 'x' * 256).get_json()['code'], 'IDEMPOTENCY_KEY_INVALID')
+        self.assertEqual(mock_send.call_count, 2)
+        
+        # 服务端错误不保存，重试时重新执行
+        mock_send.side_effect = RuntimeError('连接中断')
+        self.assertEqual(self.send(body, 'key-2').status_code, 500)
+        mock_send.side_effect = None
+        retry = self.send(body, 'key-2')
+        self.assertEqual(retry.status_code, 200)
+        self.assertNotIn('Idempotent-Replayed', retry.headers)
+        self.assertEqual(mock_send.call_count, 4)
+    
+    @patch('app.dify_service.send_message')
+    def test_retry_during_in_flight_request(self, mock_send):
+        """测试首次请求仍在执行时重试立即返回409和Retry-After，完成后重试取回其响应，租约过期后由重试接管"""
+        body = {'message': '你好', 'user_id': 'alice'}
+        fingerprint = self.store.fingerprint(body)
+        owner, _ = self.store.claim('alice', 'key-1', fingerprint)
+        self.assertIsNotNone(owner)
+        
+        started = time.monotonic()
+        response = self.send(body, 'key-1')
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.get_json()['code'], 'IDEMPOTENCY_IN_PROGRESS')
+        self.assertEqual(response.headers['Retry-After'], '2')
+        
+        self.store.complete('alice', 'key-1', owner, 200, json.dumps({'success': True, 'data': {'first': True}}))
+        response = self.send(body, 'key-1')
+        self.assertEqual(response.get_json()['data'], {'first': True})
+        self.assertEqual(response.headers['Idempotent-Replayed'], 'true')
+        mock_send.assert_not_called()
+        
+        owner, _ = self.store.claim('alice', 'key-2', fingerprint)
+        self.assertEqual(self.send(body, 'key-2').status_code, 409)
+        mock_send.assert_not_called()
+        
+        # 执行请求异常退出（租约过期）后由重试接管执行，原请求不能再写入结果
+        IdempotencyKey.query.update({'locked_until': datetime.utcnow() - timedelta(seconds=1)})
+        db.session.commit()
+        mock_send.return_value = {'success': True, 'data': {'answer': '好的', 'conversation_id': 'test-conv-id'}}
+        response = self.send(body, 'key-2')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Idempotent-Replayed', response.headers)
+        self.assertEqual(mock_send.call_count, 1)
+        self.store.complete('alice', 'key-2', owner, 200, '{}')
+        self.assertEqual(self.send(body, 'key-2').get_json(), response.get_json())
+
+class TestConversationSerialization(unittest.TestCase):
+    """同一对话轮次串行执行测试类"""
+    
+    def setUp(self):
+        """测试前准备（文件数据库，后台线程与请求看到同一份数据）"""
+        self.workdir = tempfile.mkdtemp(prefix='serialization_')
+        self.serial_app = create_app({
+            'TESTING': True,
+            'SQLALCHEMY_DATABASE_URI': f'sqlite:///{self.workdir}/travel.db',
+            'SQLALCHEMY_BINDS': {'archive': {'url': f'sqlite:///{self.workdir}/archive.db'}}
+        })
+        self.app = self.serial_app.test_client()
+        self.app_context = self.serial_app.app_context()
+        self.app_context.push()
+        create_schema()
+        self.locks = ConversationLocks(os.path.join(self.workdir, 'locks'))
+        # 聊天接口、排队轮次和删除对话使用同一组对话锁
+        self.patchers = [patch(f'{module}.conversation_locks', self.locks) for module in ('app', 'turn_pipeline', 'archive')]
+        for patcher in self.patchers:
+            patcher.start()
+    
+    def tearDown(self):
+        """测试后清理"""
+        for patcher in self.patchers:
+            patcher.stop()
+        db.session.remove()
+        for engine in db.engines.values():
+            engine.dispose()
+        self.app_context.pop()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+    
+    @patch('app.dify_service.send_message')
+    def test_concurrent_sends_share_dify_conversation(self, mock_send):
+        """测试同一对话的并发消息排队后依次执行，都在首轮绑定的Dify对话中继续，请求不等待上一轮"""
+        first_started, release_first = threading.Event(), threading.Event()
+        def reply(message, conversation_id=None, **kwargs):
+            if message == '第一条':
+                first_started.set()
+                release_first.wait(5)
+            return {'success': True, 'data': {'answer': f'回复{message}', 'conversation_id': conversation_id or 'dify-1'}}
+        mock_send.side_effect = reply
+        
+        conversation_id = self.app.post('/api/conversations', json={'title': '北京'}).get_json()['data']['id']
+        responses = {}
+        first = threading.Thread(target=lambda: responses.update(first=self.app.post(
+            '/api/chat/send', json={'message': '第一条', 'conversation_id': conversation_id})))
+        first.start()
+        self.assertTrue(first_started.wait(5))
+        
+        # 上一轮仍在调用Dify时立即返回202，不调用Dify
+        queued = []
+        for position, message in enumerate(['第二条', '第三条'], start=1):
+            response = self.app.post('/api/chat/send', json={'message': message, 'conversation_id': conversation_id})
+            self.assertEqual(response.status_code, 202)
+            data = response.get_json()['data']
+            self.assertTrue(data['queued'])
+            self.assertEqual(data['position'], position)
+            self.assertEqual(data['after_message_id'], 0)
+            queued.append(data)
+        self.assertEqual(mock_send.call_count, 1)
+        
+        release_first.set()
+        first.join()
+        self.assertTrue(turn_pipeline.wait(5))
+        self.assertEqual(responses['first'].status_code, 200)
+        
+        self.assertEqual([call.args[0] for call in mock_send.call_args_list], ['第一条', '第二条', '第三条'])
+        self.assertEqual([call.kwargs['conversation_id'] for call in mock_send.call_args_list], [None, 'dify-1', 'dify-1'])
+        self.assertEqual([m.content for m in Message.query.order_by(Message.id)],
+                         ['第一条', '回复第一条', '第二条', '回复第二条', '第三条', '回复第三条'])
+        self.assertEqual(PendingTurn.query.count(), 0)
+        self.assertEqual(db.session.get(Conversation, conversation_id).dify_conversation_id, 'dify-1')
+        
+        # 排队轮次的两条消息带有入队时返回的turn_id，客户端据此认出本轮回复（内容相同的消息也不会混淆）
+        messages = self.app.get(f'/api/conversations/{conversation_id}/messages').get_json()['data']['messages']
+        replies = {m['turn_id']: m['content'] for m in messages if m['sender_type'] == 'ai'}
+        self.assertEqual([replies[data['turn_id']] for data in queued], ['回复第二条', '回复第三条'])
+        
+        # 已绑定的对话不会被并发首轮的结果覆盖
+        _save_turn(db.session.get(Conversation, conversation_id), '问题', '回答', 'dify-2', extracted=[])
+        db.session.expire_all()
+        self.assertEqual(db.session.get(Conversation, conversation_id).dify_conversation_id, 'dify-1')
+    
+    @patch('app.dify_service.send_message')
+    def test_locks_are_per_conversation(self, mock_send):
+        """测试对话锁按对话区分：ID同余的两个对话（原先共用一个锁文件）互不阻塞，删除对话时删除其锁文件"""
+        mock_send.return_value = {'success': True, 'data': {'answer': '好的', 'conversation_id': 'dify-b'}}
+        db.session.add_all([Conversation(id=1, title='北京'), Conversation(id=1 + 4096, title='上海')])
+        db.session.commit()
+        
+        fd = self.locks.try_acquire(1)
+        self.assertIsNone(self.locks.try_acquire(1))
+        try:
+            response = self.app.post('/api/chat/send', json={'message': '你好', 'conversation_id': 1 + 4096})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(mock_send.call_count, 1)
+            
+            # 另一个对话的排队轮次在该对话的锁释放后执行，不受仍被持有的锁影响
+            other = self.locks.try_acquire(1 + 4096)
+            response = self.app.post('/api/chat/send', json={'message': '再来', 'conversation_id': 1 + 4096})
+            self.assertEqual(response.status_code, 202)
+            self.locks.release(other)
+            turn_pipeline.resume(1 + 4096)
+            self.assertTrue(turn_pipeline.wait(5))
+            self.assertEqual(mock_send.call_count, 2)
+            self.assertEqual(PendingTurn.query.count(), 0)
+        finally:
+            self.locks.release(fd)
+        
+        lock_path = self.locks._path(1 + 4096)
+        self.assertTrue(os.path.exists(lock_path))
+        self.assertEqual(self.app.delete(f'/api/conversations/{1 + 4096}').status_code, 200)
+        self.assertFalse(os.path.exists(lock_path))
+    
+    def test_discard_never_creates_second_holder(self):
+        """测试删除锁文件与取锁交错时只有一个持有者：持有中的锁文件不删除，取到已删除的旧文件时重新打开"""
+        held = self.locks.try_acquire(7)
+        self.locks.discard([7])
+        self.assertTrue(os.path.exists(self.locks._path(7)))
+        self.assertIsNone(self.locks.try_acquire(7))
+        self.locks.release(held)
+        
+        # 在打开文件和取锁之间删除锁文件
+        real_open, interleaved = os.open, []
+        def open_then_discard(path, *args):
+            fd = real_open(path, *args)
+            if not interleaved:
+                interleaved.append(path)
+                self.locks.discard([7])
+            return fd
+        with patch('conversation_locks.os.open', open_then_discard):
+            fd = self.locks.try_acquire(7)
+        self.assertEqual(interleaved, [self.locks._path(7)])
+        self.assertEqual(os.fstat(fd).st_ino, os.stat(self.locks._path(7)).st_ino)
+        self.assertIsNone(self.locks.try_acquire(7))
+        self.locks.release(fd)
+    
+    def test_invalid_conversation_id_rejected(self):
+        """测试对话ID不是正整数时聊天接口返回400，不创建对话"""
+        for path in ('/api/chat/send', '/api/chat/stream'):
+            for conversation_id in ('abc', '1/../2', -3, 1.5, True):
+                response = self.app.post(path, json={'message': '你好', 'conversation_id': conversation_id})
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(response.get_json()['code'], 'INVALID_CONVERSATION_ID')
+        self.assertEqual(Conversation.query.count(), 0)
+    
+    @patch('app.dify_service.send_message')
+    def test_queued_turns_respect_concurrency_cap(self, mock_send):
+        """测试排队轮次占用上游并发名额：名额占满时不调用Dify，多个对话的排队轮次合计不超过上限"""
+        running, peak, guard = [0], [0], threading.Lock()
+        def reply(message, conversation_id=None, **kwargs):
+            with guard:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            time.sleep(0.05)
+            with guard:
+                running[0] -= 1
+            return {'success': True, 'data': {'answer': f'回复{message}', 'conversation_id': 'dify-1'}}
+        mock_send.side_effect = reply
+        state_dir = os.path.join(self.workdir, 'admission')
+        limited = AdmissionController(state_dir, 0, 0, 0, 0, max_concurrent=1, busy_retry_after=5)
+        conversations = [Conversation(title='北京'), Conversation(title='上海'), Conversation(title='成都')]
+        db.session.add_all(conversations)
+        db.session.commit()
+        
+        with patch('turn_pipeline.admission', limited):
+            slot = limited.acquire_slot()
+            for conversation in conversations:
+                for message in ['第一条', '第二条']:
+                    self.assertTrue(turn_pipeline.enqueue(conversation.id, message, 'user')['queued'])
+            time.sleep(0.5)
+            mock_send.assert_not_called()
+            
+            limited.release_slot(slot)
+            self.assertTrue(turn_pipeline.wait(10))
+        self.assertEqual(mock_send.call_count, 6)
+        self.assertEqual(peak[0], 1)
+        self.assertEqual(PendingTurn.query.count(), 0)
+    
+    @patch('app.dify_service.send_message')
+    @patch('app.dify_service.stream_message')
+    def test_stream_queues_behind_running_turn(self, mock_stream, mock_send):
+        """测试流式接口在上一轮执行中时排队返回202（不在流中等待），响应关闭后释放对话锁"""
+        mock_stream.return_value = iter([{'event': 'message', 'answer': '好的', 'conversation_id': 'dify-1'},
+                                         {'event': 'message_end', 'conversation_id': 'dify-1'}])
+        mock_send.return_value = {'success': True, 'data': {'answer': '排队的回复', 'conversation_id': 'dify-1'}}
+        conversation_id = self.app.post('/api/conversations', json={'title': '北京'}).get_json()['data']['id']
+        
+        fd = self.locks.try_acquire(conversation_id)
+        response = self.app.post('/api/chat/stream', json={'message': '你好', 'conversation_id': conversation_id})
+        self.assertEqual(response.status_code, 202)
+        self.assertTrue(response.get_json()['data']['queued'])
+        mock_stream.assert_not_called()
+        
+        # 上一轮结束后排队的轮次由后台线程执行
+        use_shard(shard_for(conversation_id))
+        Conversation.query.filter_by(id=conversation_id).update({'dify_conversation_id': 'dify-1'})
+        db.session.commit()
+        self.locks.release(fd)
+        turn_pipeline.resume(conversation_id)
+        self.assertTrue(turn_pipeline.wait(5))
+        self.assertEqual(mock_send.call_args.kwargs['conversation_id'], 'dify-1')
+        
+        # 流式轮次持有对话锁直到响应关闭
+        response = self.app.post('/api/chat/stream', json={'message': '再来', 'conversation_id': conversation_id})
+        self.assertIn('event: done', response.get_data(as_text=True))
+        self.assertEqual(mock_stream.call_args.kwargs['conversation_id'], 'dify-1')
+        self.assertIsNone(self.locks.try_acquire(conversation_id))
+        response.close()
+        self.assertIsNotNone(self.locks.try_acquire(conversation_id))
+        self.assertEqual([m.content for m in Message.query.order_by(Message.id)], ['你好', '排队的回复', '再来', '好的'])
+
+class TestUpstreamScheduler(unittest.TestCase):
+    """上游调用调度测试类"""
+    
+    def setUp(self):
+        """测试前准备"""
+        self.test_app, self.workdir = create_test_app()
+        self.app = self.test_app.test_client()
+        self.app_context = self.test_app.app_context()
+        self.app_context.push()
+        create_schema()
+        self.scheduler = UpstreamScheduler(max_concurrent=1, poll_interval=0.01)
+    
+    def tearDown(self):
+        """测试后清理"""
+        destroy_test_app(self.app_context, self.workdir)
+    
+    def test_priority_order(self):
+        """测试名额释放后按 健康探测 > 继续对话 > 新对话 的顺序分配，同级先到先得"""
+        running = self.scheduler.enqueue(UpstreamScheduler.PRIORITY_NEW)
+        self.assertTrue(running.granted)
+        
+        new_first = self.scheduler.enqueue(UpstreamScheduler.PRIORITY_NEW)
+        new_second = self.scheduler.enqueue(UpstreamScheduler.PRIORITY_NEW)
+        continuing = self.scheduler.enqueue(UpstreamScheduler.PRIORITY_CONTINUING)
+        probe = self.scheduler.enqueue(UpstreamScheduler.PRIORITY_PROBE)
+        self.assertEqual(self.scheduler.metrics()['queue_depth'], 4)
+        
+        order = []
+        for ticket in [running, probe, continuing, new_first]:
+            self.scheduler.release(ticket)
+            order.append([t for t in (probe, continuing, new_first, new_second) if t.granted])
+        self.assertEqual(order, [[probe], [continuing], [new_first], [new_second]])
+        
+        metrics = self.scheduler.metrics()
+        self.assertEqual(metrics['queue_depth'], 0)
+        self.assertEqual(metrics['granted'], {'probe': 1, 'continuing': 1, 'new': 3})
+    
+    def test_drop_expired_and_disconnected(self):
+        """测试超过截止时间或客户端断开的排队调用被丢弃，不占用名额"""
+        running = self.scheduler.enqueue(UpstreamScheduler.PRIORITY_NEW)
+        
+        with self.assertRaises(UpstreamDropped):
+            self.scheduler.acquire(UpstreamScheduler.PRIORITY_NEW, deadline=time.monotonic() + 0.05)
+        with self.assertRaises(UpstreamDropped):
+            self.scheduler.acquire(UpstreamScheduler.PRIORITY_NEW, cancelled=lambda: True)
+        
+        # 出队时才过期的调用被跳过，名额交给后面的调用
+        expiring = self.scheduler.enqueue(UpstreamScheduler.PRIORITY_PROBE, deadline=time.monotonic() + 0.01)
+        waiting = self.scheduler.enqueue(UpstreamScheduler.PRIORITY_NEW)
+        time.sleep(0.02)
+        self.scheduler.release(running)
+        self.assertFalse(expiring.granted)
+        self.assertTrue(waiting.granted)
+        with self.assertRaises(UpstreamDropped):
+            self.scheduler.wait(expiring)
+        
+        metrics = self.scheduler.metrics()
+        self.assertEqual(metrics['dropped'], {'deadline': 2, 'disconnected': 1})
+        self.assertEqual(metrics['queue_depth'], 0)
+        self.assertEqual(metrics['running'], 1)
+    
+    def test_send_message_deadline_exceeded(self):
+        """测试排队超过客户端时限的消息返回503，不调用Dify也不保存，并计入指标"""
+        self.scheduler.enqueue(UpstreamScheduler.PRIORITY_PROBE)
+        
+        with patch('app.dify_service.scheduler', self.scheduler), \
+                patch('requests.Session.post') as mock_post:
+            response = self.app.post('/api/chat/send', json={'message': '北京去哪玩'},
+                                     headers={'X-Request-Timeout': '0.05'})
+            metrics = json.loads(self.app.get('/api/metrics').data)['data']['upstream']
+        
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(json.loads(response.data)['code'], 'DEADLINE_EXCEEDED')
+        mock_post.assert_not_called()
+        self.assertEqual(Conversation.query.count(), 0)
+        self.assertEqual(Message.query.count(), 0)
+        self.assertEqual(metrics['dropped']['deadline'], 1)
+        self.assertEqual(metrics['running'], 1)
+
+class TestConversationEvents(unittest.TestCase):
+    """对话事件推送测试类"""
+    
+    def setUp(self):
+        """测试前准备"""
+        self.test_app, self.workdir = create_test_app()
+        self.app = self.test_app.test_client()
+        self.app_context = self.test_app.app_context()
+        self.app_context.push()
+        create_schema()
+        self.broker = ConversationEventBroker(poll_interval=0.01, heartbeat_seconds=0.05,
+                                              retention_seconds=600, max_subscribers=10)
+        self.conversation = Conversation(title='测试对话')
+        db.session.add(self.conversation)
+        db.session.commit()
+        self.conversation_id = self.conversation.id
+    
+    def tearDown(self):
+        """测试后清理"""
+        destroy_test_app(self.app_context, self.workdir)
+    
+    def read_events(self, chunks, count, timeout=5):
+        """从SSE响应中读取count个事件，返回 [(事件名, 数据)]"""
+        events = []
+        deadline = time.monotonic() + timeout
+        while len(events) < count and time.monotonic() < deadline:
+            for block in next(chunks).decode('utf-8').split('\n\n'):
+                fields = dict(line.split(': ', 1) for line in block.split('\n') if ': ' in line and not line.startswith(':'))
+                if 'event' in fields:
+                    events.append((fields['event'], json.loads(fields['data']), int(fields['id'])))
+        return events
+    
+    @patch('app.dify_service.send_message')
+    def test_push_new_messages(self, mock_send):
+        """测试订阅后提交的消息和景点提取结果推送给订阅者，心跳保持连接"""
+        mock_send.return_value = {
+            'success': True,
+            'data': {'answer': '推荐：\n1. 八达岭长城\n万里长城精华段', 'conversation_id': 'test-conv-id'}
+        }
+        
+        with patch('app.event_broker', self.broker):
+            response = self.app.get(f'/api/conversations/{self.conversation_id}/events', buffered=False)
+            self.assertEqual(response.mimetype, 'text/event-stream')
+            chunks = iter(response.response)
+            self.assertTrue(next(chunks).startswith(b'retry:'))
+            self.assertEqual(next(chunks), b': keepalive\n\n')
+            
+            self.app.post('/api/chat/send', json={'message': '北京去哪玩', 'conversation_id': self.conversation_id})
+            # 用户消息和AI回复，以及消息提交之后写入景点的事件
+            events = self.read_events(chunks, 3)
+            self.assertEqual([(name, data['content']) for name, data, _ in events[:2]],
+                             [('message', '北京去哪玩'), ('message', '推荐：\n1. 八达岭长城\n万里长城精华段')])
+            name, data, _ = events[2]
+            self.assertEqual(name, 'attractions')
+            self.assertEqual(data['attractions_status'], 'ready')
+            self.assertEqual(data['attractions'][0]['name'], '八达岭长城')
+            
+            self.assertEqual(self.broker.subscriber_count(), 1)
+            response.close()
+        self.assertEqual(self.broker.subscriber_count(), 0)
+    
+    @patch('app.dify_service.send_message')
+    def test_replay_after_last_event_id(self, mock_send):
+        """测试断线重连时按Last-Event-ID补发之后的事件"""
+        mock_send.return_value = {'success': True, 'data': {'answer': '好的', 'conversation_id': 'test-conv-id'}}
+        
+        with patch('app.event_broker', self.broker):
+            for message in ['第一条', '第二条']:
+                self.app.post('/api/chat/send', json={'message': message, 'conversation_id': self.conversation_id})
+            first_event_id = db.session.query(db.func.min(ConversationEvent.id)).scalar()
+            
+            response = self.app.get(f'/api/conversations/{self.conversation_id}/events', buffered=False,
+                                    headers={'Last-Event-ID': str(first_event_id)})
+            chunks = iter(response.response)
+            next(chunks)
+            events = self.read_events(chunks, 5)
+            response.close()
+        
+        # 每轮：用户消息、AI回复，以及消息提交后写入景点的事件
+        self.assertEqual([name for name, _, _ in events], ['message', 'attractions', 'message', 'message', 'attractions'])
+        self.assertEqual([data['content'] for name, data, _ in events if name == 'message'], ['好的', '第二条', '好的'])
+        self.assertEqual([event_id for _, _, event_id in events],
+                         list(range(first_event_id + 1, first_event_id + 6)))
+        self.assertEqual(self.app.get('/api/conversations/9999/events').status_code, 404)
+
+class TestShardedStorage(unittest.TestCase):
+    """SQLite分片存储测试类"""
+    
+    def setUp(self):
+        """测试前准备"""
+        self.workdir = tempfile.mkdtemp(prefix='shards_')
+        self.shard_app = self.make_app(3)
+        self.app = self.shard_app.test_client()
+        self.app_context = self.shard_app.app_context()
+        self.app_context.push()
+        create_schema()
+    
+    def tearDown(self):
+        """测试后清理"""
+        db.session.remove()
+        for engine in db.engines.values():
+            engine.dispose()
+        self.app_context.pop()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+    
+    def make_app(self, shard_count):
+        return create_app({
+            'TESTING': True,
+            'SQLALCHEMY_DATABASE_URI': f'sqlite:///{self.workdir}/travel.db',
+            'SQLALCHEMY_BINDS': {'archive': {'url': f'sqlite:///{self.workdir}/archive.db'}},
+            'SHARD_COUNT': shard_count,
+            'SHARD_DIRECTORY': os.path.join(self.workdir, 'shards')
+        })
+    
+    @patch('app.dify_service.send_message')
+    def start_conversations(self, count, mock_send):
+        mock_send.return_value = {
+            'success': True,
+            'data': {'answer': '为您推荐：\n1. 八达岭长城\n地址：北京市延庆区八达岭镇\n经纬度：40.3587,116.0154',
+                     'conversation_id': 'test-conv-id'}
+        }
+        return [self.app.post('/api/chat/send', json={'message': f'北京第{i}天', 'user_id': 'alice'})
+                .get_json()['data']['conversation_id'] for i in range(count)]
+    
+    def test_routing_and_merged_listing(self):
+        """测试对话按ID分布到各分片，列表按更新时间跨分片归并，检索、同步和批量删除覆盖全部分片"""
+        conversation_ids = self.start_conversations(6)
+        self.assertEqual(len(set(conversation_ids)), 6)
+        self.assertGreater(len({shard_for(conversation_id) for conversation_id in conversation_ids}), 1)
+        
+        conversations = self.app.get('/api/conversations?user_id=alice').get_json()['data']
+        self.assertEqual([c['id'] for c in conversations], conversation_ids[::-1])
+        self.assertEqual({c['message_count'] for c in conversations}, {2})
+        
+        for conversation_id in conversation_ids:
+            messages = self.app.get(f'/api/conversations/{conversation_id}/messages?user_id=alice').get_json()['data']['messages']
+            self.assertEqual(messages[0]['content'], f'北京第{conversation_ids.index(conversation_id)}天')
+            self.assertEqual(messages[1]['attractions'][0]['name'], '八达岭长城')
+        
+        results = self.app.get('/api/search?q=八达岭&user_id=alice').get_json()['data']['results']
+        self.assertEqual(sorted(r['conversation_id'] for r in results), sorted(conversation_ids))
+        
+        synced = self.app.post('/api/messages/sync', json={'cursors': {str(c): 0 for c in conversation_ids + [9999]}, 'user_id': 'alice'}).get_json()['data']
+        self.assertEqual(sorted(map(int, synced['conversations'])), sorted(conversation_ids))
+        self.assertEqual(synced['missing'], [9999])
+        
+        deleted = self.app.post('/api/conversations/batch-delete', json={'ids': conversation_ids[:3], 'user_id': 'alice'}).get_json()['data']
+        self.assertEqual(sorted(deleted['deleted']), sorted(conversation_ids[:3]))
+        remaining = self.app.get('/api/conversations?user_id=alice').get_json()['data']
+        self.assertEqual([c['id'] for c in remaining], conversation_ids[:2:-1])
+    
+    def test_rebalance_after_adding_shards(self):
+        """测试增加分片后只移动改变归属的对话，消息和景点随对话移动，重复执行不再移动"""
+        conversation_ids = self.start_conversations(12)
+        def contents(conversation_id):
+            messages = self.app.get(f'/api/conversations/{conversation_id}/messages?user_id=alice').get_json()['data']['messages']
+            return [(m['content'], [a['name'] for a in m.get('attractions', [])]) for m in messages]
+        before = {conversation_id: contents(conversation_id) for conversation_id in conversation_ids}
+        
+        db.session.remove()
+        self.app_context.pop()
+        self.shard_app = self.make_app(4)
+        self.app = self.shard_app.test_client()
+        self.app_context = self.shard_app.app_context()
         self.app_context.push()
+        create_schema()
+        
+        expected = {(shard_for(c, 3), shard_for(c)) for c in conversation_ids if shard_for(c, 3) != shard_for(c)}
+        self.assertTrue(expected)
+        self.assertEqual({pair for pair in rebalance_shards(dry_run=True)}, expected)
+        moved = rebalance_shards()
+        self.assertEqual(set(moved), expected)
+        self.assertEqual({target for _, target in moved}, {'shard-3'})
+        self.assertEqual(rebalance_shards(dry_run=True), {})
         
+        conversations = self.app.get('/api/conversations?user_id=alice').get_json()['data']
+        self.assertEqual([c['id'] for c in conversations], conversation_ids[::-1])
+        self.assertEqual({conversation_id: contents(conversation_id) for conversation_id in conversation_ids}, before)
+        
+        # 新对话的ID接在已有对话之后
+        self.assertEqual(self.start_conversations(1), [max(conversation_ids) + 1])
+
+# gevent worker冒烟测试：monkey patch必须在导入应用之前完成，因此在子进程中运行
+GEVENT_SMOKE_SCRIPT = """
+from gevent import monkey
+monkey.patch_all()
+import json, sqlite3, sys
+import gevent
+from unittest.mock import patch
+from app import create_app, create_schema
+from admission import AdmissionController
+
+workdir = sys.argv[1]
+flask_app = create_app({'TESTING': True, 'SQLALCHEMY_DATABASE_URI': f'sqlite:///{workdir}/travel.db',
+                        'SQLALCHEMY_BINDS': {'archive': {'url': f'sqlite:///{workdir}/archive.db'}}})
+with flask_app.app_context():
+    create_schema()
+client = flask_app.test_client()
+admission = AdmissionController(f'{workdir}/admission', 100, 600, 100, 600, 2, 1)
+reply = {'success': True, 'data': {'answer': '好的', 'conversation_id': 'dify-1'}}
+
+def chat(i):
+    gevent.sleep(0)
+    response = client.post('/api/chat/send', json={'message': f'你好{i}', 'user_id': f'user{i}'})
+    return response.status_code
+
+with patch('app.admission', admission), patch('app.dify_service.send_message', return_value=reply), \\
+        patch('admission.sqlite3.connect', wraps=sqlite3.connect) as connect:
+    jobs = [gevent.spawn(chat, i) for i in range(20)]
+    gevent.joinall(jobs, timeout=30)
+    listing = client.get('/api/conversations?user_id=user0').get_json()
+print(json.dumps({'statuses': [job.value for job in jobs], 'connections': connect.call_count,
+                  'conversations': len(listing['data'])}))
+"""
+
+class TestGeventWorker(unittest.TestCase):
+    """gevent worker冒烟测试类 - 需要安装gevent（GUNICORN_WORKER_CLASS=gevent时使用）"""
+    
+    @unittest.skipUnless(gevent, '未安装gevent')
+    def test_concurrent_chat_under_gevent(self):
+        """测试monkey patch后并发协程的聊天请求正常完成，限流状态在进程内只打开一个SQLite连接"""
+        workdir = tempfile.mkdtemp(prefix='gevent_test_')
+        try:
+            result = subprocess.run([sys.executable, '-c', GEVENT_SMOKE_SCRIPT, workdir], capture_output=True,
+                                    text=True, timeout=120, cwd=os.path.dirname(os.path.abspath(__file__)))
+            self.assertEqual(result.returncode, 0, result.stderr[-2000:])
+            data = json.loads(result.stdout.strip().splitlines()[-1])
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+        self.assertEqual(data['statuses'], [200] * 20)
+        self.assertEqual(data['connections'], 1)
+        self.assertEqual(data['conversations'], 1)
+
+POSTGRES_URL = config.normalize_database_url(os.getenv('TEST_POSTGRES_URL', ''))  # 例如 postgresql://postgres@127.0.0.1:5432/travel_test
+
+class TestPostgresProfile(unittest.TestCase):
+    """PostgreSQL配置测试类 - 集成测试需要设置TEST_POSTGRES_URL指向本地容器或临时实例"""
+    
+    def setUp(self):
+        """测试前准备"""
+        if not POSTGRES_URL:
+            return
+        options = config.postgresql_engine_options(2, 5, 1800, 200, 60000)
+        self.pg_app = create_app({
+            'TESTING': True,
+            'SQLALCHEMY_DATABASE_URI': POSTGRES_URL,
+            'SQLALCHEMY_ENGINE_OPTIONS': options,
+            'SQLALCHEMY_BINDS': {'archive': {'url': POSTGRES_URL, **options}}
+        })
+        self.app = self.pg_app.test_client()
+        self.app_context = self.pg_app.app_context()
+        self.app_context.push()
+        db.drop_all()
         db.create_all()
     
     def tearDown(self):
         """测试后清理"""
+        if not POSTGRES_URL:
+            return
         db.session.remove()
         db.drop_all()
+        for engine in db.engines.values():
+            engine.dispose()
         self.app_context.pop()
     
+    def test_engine_options(self):
+        """测试PostgreSQL连接池参数和URL写法兼容"""
+        options = config.postgresql_engine_options(10, 5, 1800, 15000, 60000)
+        self.assertEqual((options['pool_size'], options['max_overflow']), (10, 0))
+        self.assertFalse(options['pool_pre_ping'])
+        self.assertIn('statement_timeout=15000', options['connect_args']['options'])
+        self.assertEqual(config.normalize_database_url('postgres://u@h/db'), 'postgresql+psycopg2://u@h/db')
+        self.assertEqual(config.normalize_database_url('postgresql+psycopg2://u@h/db'), 'postgresql+psycopg2://u@h/db')
+        self.assertEqual(config.normalize_database_url('sqlite:///a.db'), 'sqlite:///a.db')
+    
+    @unittest.skipUnless(POSTGRES_URL, '未设置TEST_POSTGRES_URL')
+    @patch('app.dify_service.send_message')
+    def test_chat_and_list(self, mock_send):
+        """测试在PostgreSQL上发送消息、列出对话和检索（无FTS5时回退为LIKE）"""
+        mock_send.return_value = {
+            'success': True,
+            'data': {'answer': '为您推荐：\n1. 八达岭长城\n地址：北京市延庆区八达岭镇\n经纬度：40.3587,116.0154',
+                     'conversation_id': 'pg-conv'}
+        }
+        response = self.app.post('/api/chat/send', json={'message': '北京有什么景点', 'user_id': 'alice'})
+        self.assertEqual(response.status_code, 200, response.data)
+        conversation_id = response.get_json()['data']['conversation_id']
+        
+        conversations = self.app.get('/api/conversations?user_id=alice').get_json()['data']
+        self.assertEqual([(c['id'], c['message_count']) for c in conversations], [(conversation_id, 2)])
+        messages = self.app.get(f'/api/conversations/{conversation_id}/messages?user_id=alice').get_json()['data']['messages']
+        self.assertEqual(messages[1]['attractions'][0]['coordinates'], {'lat': 40.3587, 'lng': 116.0154})
+        results = self.app.get('/api/search?q=八达岭&user_id=alice').get_json()['data']['results']
+        self.assertEqual(results[0]['conversation_id'], conversation_id)
+    
+    @unittest.skipUnless(POSTGRES_URL, '未设置TEST_POSTGRES_URL')
+    def test_bulk_insert_copy(self):
+        """测试批量写入使用COPY，特殊字符、空值和列默认值正确写入"""
+        conversation = Conversation(title='测试对话')
+        db.session.add(conversation)
+        db.session.commit()
+        message = Message(conversation_id=conversation.id, content='回复', sender_type='ai')
+        db.session.add(message)
+        db.session.commit()
+        rows = [{'message_id': message.id, 'position': i, 'name': f'景点\t{i}\\N\n换行', 'address': None,
+                 'latitude': 39.9 + i, 'longitude': None} for i in range(3)]
+        
+        # 达到阈值时不经过INSERT语句
+        with patch.object(config.app_config, 'DB_BULK_COPY_THRESHOLD', 1), \
+                patch('archive.insert', side_effect=AssertionError('应使用COPY写入')):
+            bulk_insert(Attraction, rows)
+            db.session.commit()
+        
+        saved = Attraction.query.order_by(Attraction.position).all()
+        self.assertEqual([(a.name, a.address, a.latitude, a.longitude) for a in saved],
+                         [(row['name'], None, row['latitude'], None) for row in rows])
+        self.assertEqual({a.type for a in saved}, {'景点'})
+        self.assertTrue(all(a.created_at for a in saved))
+    
+    @unittest.skipUnless(POSTGRES_URL, '未设置TEST_POSTGRES_URL')
+    def test_statement_timeout(self):
+        """测试服务端语句超时生效"""
+        with self.assertRaises(OperationalError):
+            db.session.execute(text('SELECT pg_sleep(2)'))
+        db.session.rollback()
+    
+    @unittest.skipUnless(POSTGRES_URL, '未设置TEST_POSTGRES_URL')
+    def test_idle_connection_replaced(self):
+        """测试空闲连接被服务端断开后，借出时检测到并重建，查询不失败"""
+        pid = db.session.execute(text('SELECT pg_backend_pid()')).scalar()
+        db.session.remove()
+        killer = psycopg2.connect(**db.engine.url.translate_connect_args(username='user', database='dbname'))
+        killer.autocommit = True
+        killer.cursor().execute('SELECT pg_terminate_backend(%s)', (pid,))
+        killer.close()
+        
+        self.assertTrue(event.contains(db.engine.pool, 'checkout', check_idle_connection))
+        with patch.object(config.app_config, 'DB_LIVENESS_IDLE_SECONDS', 0):
+            new_pid = db.session.execute(text('SELECT pg_backend_pid()')).scalar()
+        self.assertNotEqual(new_pid, pid)
+
+class TestModels(unittest.TestCase):
+    """数据模型测试类"""
+    
+    def setUp(self):
+        """测试前准备"""
+        self.test_app, self.workdir = create_test_app()
+        
+        self.app_context = self.test_app.app_context()
+        self.app_context.push()
+        
+        create_schema()
+    
+    def tearDown(self):
+        """测试后清理"""
+        destroy_test_app(self.app_context, self.workdir)
+    
     def test_conversation_model(self):
         """测试对话模型"""
         conversation = Conversation(title='测试对话')
@@ -4,10 +4,10 @@
 完整的文本清理功能测试脚本
 """
 
-import re
+from text_cleaning import COORDINATE_PATTERNS, clean_ai_text
 
 def test_cleanAIText():
-    """测试文本清理函数的JavaScript逻辑（Python模拟版）"""
+    """测试文本清理函数（后端 text_cleaning.clean_ai_text，前端直接使用其结果display_content）"""
     
     # 模拟包含坐标信息的AI回复文本
     test_texts = [
@@ -42,27 +42,6 @@ GPS：40.3587,116.0154
 """
     ]
     
-    # JavaScript正则表达式模式（转换为Python格式）
-    coordinate_patterns = [
-        # 中文标识的坐标
-        r'经纬度[：:]?\s*[0-9.-]+\s*[,，]\s*[0-9.-]+',
-        r'纬度[：:]?\s*[0-9.-]+',
-        r'经度[：:]?\s*[0-9.-]+',
-        r'坐标[：:]?\s*[0-9.-]+\s*[,，]\s*[0-9.-]+',
-        # 括号内的坐标信息
-        r'\([^)]*经度[^)]*\)',
-        r'\([^)]*纬度[^)]*\)',
-        r'\([^)]*坐标[^)]*\)',
-        # 纯数字坐标格式（较精确的格式）
-        r'\b[0-9]{1,3}\.[0-9]{5,8}\s*[,，]\s*[0-9]{1,3}\.[0-9]{5,8}\b',
-        # GPS坐标格式
-        r'GPS[：:]?\s*[0-9.-]+\s*[,，]\s*[0-9.-]+',
-        # 位置坐标格式
-        r'位置[：:]?\s*[0-9.-]+\s*[,，]\s*[0-9.-]+',
-        # 地理坐标
-        r'地理坐标[：:]?\s*[0-9.-]+\s*[,，]\s*[0-9.-]+',
-    ]
-    
     print("=== 文本清理功能测试 ===")
     print()
     
@@ -73,23 +52,11 @@ GPS：40.3587,116.0154
         print()
         
         # 应用清理规则
-        cleaned_text = original_text
         matches_found = []
-        
-        for pattern in coordinate_patterns:
-            found_matches = re.findall(pattern, cleaned_text)
-            if found_matches:
-                matches_found.extend(found_matches)
-            cleaned_text = re.sub(pattern, '', cleaned_text)
-        
-        # 清理因移除坐标信息而产生的多余格式
-        cleaned_text = re.sub(r'^[：:]\s*$', '', cleaned_text, flags=re.MULTILINE)  # 移除空的冒号行
-        cleaned_text = re.sub(r'\n\s*\n\s*\n', '\n\n', cleaned_text)  # 移除连续的换行符
-        cleaned_text = re.sub(r'^[\s]*[：:]\s*', '', cleaned_text, flags=re.MULTILINE)  # 移除行首的冒号和空格
-        cleaned_text = re.sub(r'\s*[：:]\s*$', '', cleaned_text, flags=re.MULTILINE)  # 移除行尾的冒号和空格
-        cleaned_text = re.sub(r'^\s+|\s+$', '', cleaned_text)  # 清理首尾空格
-        cleaned_text = re.sub(r'\n\s+', '\n', cleaned_text)  # 清理行首空格
-        cleaned_text = re.sub(r'\s+\n', '\n', cleaned_text)  # 清理行尾空格
+        for pattern, _ in COORDINATE_PATTERNS:
+            if pattern is not None:
+                matches_found.extend(pattern.findall(original_text))
+        cleaned_text = clean_ai_text(original_text)
         
         print("找到的坐标信息:")
         for match in matches_found:
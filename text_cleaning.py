@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+AI旅行助手 - AI回复文本清理
+与前端 cleanAIText（src/App.tsx）规则一致：移除经纬度等坐标信息，并整理移除后留下的空行和冒号
+各规则的结果与前端正则相同，但会在长串上逐位置重扫的规则改写为只从括号块或空白串的起点开始匹配，保证线性时间
+"""
+
+import re
+from functools import partial
+
+def remove_parenthesized(text, keyword):
+    """移除内容包含keyword的括号，等价于 \\([^)]*keyword[^)]*\\)
+    同一个右括号之前只有第一个左括号可能成为最左匹配，因此每个括号块只检查一次"""
+    pieces = []
+    last_end = 0
+    start = text.find('(')
+    while start != -1:
+        close = text.find(')', start)
+        if close == -1:
+            break
+        if keyword in text[start + 1:close]:
+            pieces.append(text[last_end:start])
+            last_end = close + 1
+        start = text.find('(', close + 1)
+    pieces.append(text[last_end:])
+    return ''.join(pieces)
+
+# 坐标信息的各种格式，顺序与前端一致；pattern为None时replacement直接处理整段文本
+COORDINATE_PATTERNS = [
+    # 中文标识的坐标
+    (re.compile(r'经纬度[：:]?\s*[0-9.-]+\s*[,，]\s*[0-9.-]+'), ''),
+    (re.compile(r'纬度[：:]?\s*[0-9.-]+'), ''),
+    (re.compile(r'经度[：:]?\s*[0-9.-]+'), ''),
+    (re.compile(r'坐标[：:]?\s*[0-9.-]+\s*[,，]\s*[0-9.-]+'), ''),
+    # 括号内的坐标信息
+    (None, partial(remove_parenthesized, keyword='经度')),
+    (None, partial(remove_parenthesized, keyword='纬度')),
+    (None, partial(remove_parenthesized, keyword='坐标')),
+    # 纯数字坐标格式（JavaScript的\b只按ASCII判断单词边界）
+    (re.compile(r'\b[0-9]{1,3}\.[0-9]{5,8}\s*[,，]\s*[0-9]{1,3}\.[0-9]{5,8}\b', re.ASCII), ''),
+    # GPS坐标格式
+    (re.compile(r'GPS[：:]?\s*[0-9.-]+\s*[,，]\s*[0-9.-]+'), ''),
+    # 位置坐标格式
+    (re.compile(r'位置[：:]?\s*[0-9.-]+\s*[,，]\s*[0-9.-]+'), ''),
+    # 地理坐标
+    (re.compile(r'地理坐标[：:]?\s*[0-9.-]+\s*[,，]\s*[0-9.-]+'), ''),
+]
+
+# 行尾的冒号，向前补齐冒号前的空白后等价于 \s*[：:]\s*$
+TRAILING_COLON = re.compile(r'[：:]\s*$', re.MULTILINE)
+
+def remove_trailing_colons(text):
+    """移除行尾的冒号及其前后空白，冒号前的空白不越过上一处匹配"""
+    pieces = []
+    last_end = 0
+    for match in TRAILING_COLON.finditer(text):
+        start = match.start()
+        while start > last_end and text[start - 1].isspace():
+            start -= 1
+        pieces.append(text[last_end:start])
+        last_end = match.end()
+    pieces.append(text[last_end:])
+    return ''.join(pieces)
+
+# 清理因移除坐标信息而产生的多余格式，顺序与前端一致
+FORMAT_RULES = [
+    (re.compile(r'^[：:]\s*$', re.MULTILINE), ''),      # 移除空的冒号行
+    (re.compile(r'\n\s*\n\s*\n'), '\n\n'),              # 移除连续的换行符
+    (re.compile(r'^\s*[：:]\s*', re.MULTILINE), ''),    # 移除行首的冒号和空格
+    (None, remove_trailing_colons),                     # 移除行尾的冒号和空格
+    (None, str.strip),                                  # 清理首尾空格（与\s相同的空白字符）
+    (re.compile(r'\n\s+'), '\n'),                       # 清理行首空格
+    (re.compile(r'\s(?<!\s\s)\s*\n'), '\n'),             # 清理行尾空格，只从空白串的起点匹配
+]
+
+def clean_ai_text(text):
+    """移除AI回复中的坐标信息，返回用于展示的文本"""
+    if not text:
+        return text
+    for pattern, replacement in COORDINATE_PATTERNS + FORMAT_RULES:
+        text = replacement(text) if pattern is None else pattern.sub(replacement, text)
+    return text
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+AI旅行助手 - 排队轮次执行模块
+对话已有轮次在执行时，新消息排队后由后台线程按顺序执行
+"""
+
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+from sqlalchemy import func
+
+from admission import admission
+from config import dify_config
+from conversation_events import event_broker
+from conversation_locks import conversation_locks
+from models import Conversation, ConversationEvent, Message, PendingTurn, db
+from sharding import each_shard, shard_for, use_shard
+
+logger = logging.getLogger(f'app.{__name__}')
+
+class TurnPipeline:
+    """
+    排队轮次的后台执行 - 对话锁被占用时，新消息写入 pending_turns 后请求立即返回，不占用worker线程等待
+    
+    持锁的一方释放锁后检查排队轮次，有则重新取锁交给本进程的后台线程，按顺序执行到队列为空，
+    回复随消息事件推送给对话的订阅者。入队后再尝试取锁、释放锁后再检查队列，两者交错时也不会遗漏排队轮次。
+    每个排队轮次执行前占用一个上游并发名额（与聊天接口共用 CHAT_MAX_CONCURRENT），名额已满时在后台线程中等待。
+    
+    run_turn(content, conversation_id, user_id, deadline, queued, turn_id) 执行一轮对话，由应用的聊天接口提供。
+    """
+    
+    def __init__(self, max_workers, run_turn):
+        self.max_workers = max_workers
+        self.run_turn = run_turn
+        self._executor = None
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+    
+    def _get_executor(self):
+        # 延迟创建，保证线程池在gunicorn worker进程内生成
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='turn-pipeline')
+            return self._executor
+    
+    def enqueue(self, conversation_id, content, user_id):
+        """
+        把一轮对话加入对话的排队轮次，返回接口响应的data部分；对话不存在时返回None
+        
+        客户端按turn_id认出本轮的回复：从after_event_id订阅对话事件（事件推送未启用时为None），
+        或轮询after_message_id之后的消息；两者都在入队前读取，不会错过本轮的消息
+        """
+        use_shard(shard_for(conversation_id))
+        if db.session.get(Conversation, conversation_id) is None:
+            return None
+        after_event_id = (db.session.query(func.max(ConversationEvent.id)).scalar() or 0) if event_broker.enabled else None
+        after_message_id = (db.session.query(func.max(Message.id))
+                            .filter(Message.conversation_id == conversation_id).scalar() or 0)
+        turn = PendingTurn(conversation_id=conversation_id, user_id=user_id, content=content)
+        db.session.add(turn)
+        db.session.commit()
+        position = PendingTurn.query.filter(PendingTurn.conversation_id == conversation_id,
+                                            PendingTurn.id <= turn.id).count()
+        logger.info(f'⏳ 对话 {conversation_id} 有轮次正在执行，新消息排在第 {position} 位')
+        data = {'conversation_id': int(conversation_id), 'queued': True, 'turn_id': turn.turn_id, 'position': position,
+                'after_event_id': after_event_id, 'after_message_id': after_message_id}
+        self.resume(conversation_id)  # 持锁的一方可能在入队前已经释放锁
+        return data
+    
+    def resume(self, conversation_id):
+        """对话有排队轮次且对话锁空闲时，取锁并在后台线程中执行"""
+        try:
+            use_shard(shard_for(conversation_id))
+            waiting = db.session.query(PendingTurn.query.filter_by(conversation_id=conversation_id).exists()).scalar()
+            db.session.commit()
+            if not waiting:
+                return
+            fd = conversation_locks.try_acquire(conversation_id)
+            if fd is None:
+                return  # 持锁的一方释放后会再次检查
+            with self._lock:
+                self._pending += 1
+            self._get_executor().submit(self._drain, current_app._get_current_object(), conversation_id, fd)
+        except Exception as e:
+            logger.error(f'💥 调度排队轮次失败 (对话 {conversation_id}): {str(e)}')
+    
+    def resume_all(self, flask_app=None):
+        """恢复进程重启前遗留的排队轮次"""
+        with (flask_app or current_app._get_current_object()).app_context():
+            for _ in each_shard():
+                conversation_ids = [conversation_id for (conversation_id,) in
+                                    db.session.query(PendingTurn.conversation_id).distinct()]
+                for conversation_id in conversation_ids:
+                    self.resume(conversation_id)
+    
+    def _drain(self, flask_app, conversation_id, fd):
+        try:
+            with flask_app.app_context():
+                try:
+                    while True:
+                        # 先占用并发名额再出队，等待期间进程退出时轮次仍留在队列中
+                        slot = admission.wait_for_slot()
+                        try:
+                            if not self._run_next(conversation_id):
+                                break
+                        finally:
+                            if slot is not None:
+                                admission.release_slot(slot)
+                finally:
+                    conversation_locks.release(fd)
+                    db.session.remove()
+                    self.resume(conversation_id)  # 释放锁前入队、取锁失败的轮次
+                    db.session.remove()
+        finally:
+            with self._lock:
+                self._pending -= 1
+                self._idle.notify_all()
+    
+    def _run_next(self, conversation_id):
+        """执行对话最早的一个排队轮次，队列为空时返回False"""
+        use_shard(shard_for(conversation_id))
+        turn = PendingTurn.query.filter_by(conversation_id=conversation_id).order_by(PendingTurn.id).first()
+        if turn is None:
+            return False
+        content, user_id, turn_id = turn.content, turn.user_id, turn.turn_id
+        # 先出队再执行，异常退出时不会重复调用Dify
+        db.session.delete(turn)
+        db.session.commit()
+        if db.session.get(Conversation, conversation_id) is None:
+            logger.warning(f'⚠️ 对话 {conversation_id} 已删除，丢弃排队轮次')
+            return True
+        try:
+            self.run_turn(content, conversation_id, user_id,
+                          time.monotonic() + dify_config.REQUEST_DEADLINE, queued=True, turn_id=turn_id)
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f'💥 排队轮次执行失败 (对话 {conversation_id}): {str(e)}')
+        finally:
+            db.session.remove()
+        return True
+    
+    def wait(self, timeout=None):
+        """等待当前所有后台轮次执行完成"""
+        with self._lock:
+            return self._idle.wait_for(lambda: self._pending == 0, timeout=timeout)
+    
+    def reset(self):
+        """fork后在子进程内调用：父进程的线程池在子进程中不可用"""
+        self._executor = None
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+AI旅行助手 - 上游调用调度模块
+限制进程内同时调用Dify的数量，排队的调用按优先级和截止时间获得名额
+"""
+
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+
+class UpstreamDropped(Exception):
+    """排队的上游调用在获得名额前超过截止时间或客户端已断开"""
+
+class UpstreamTicket:
+    """一次上游调用的排队凭据"""
+    
+    def __init__(self, priority, deadline, cancelled):
+        self.priority = priority
+        self.deadline = deadline  # time.monotonic() 时间，None表示不限
+        self.cancelled = cancelled  # 返回True表示客户端已断开
+        self.enqueued_at = time.monotonic()
+        self.granted = False
+        self.abandoned = False
+        self.drop_reason = None
+        self.event = threading.Event()
+    
+    def expired(self, now=None):
+        return self.deadline is not None and (now or time.monotonic()) >= self.deadline
+
+class UpstreamScheduler:
+    """
+    上游调用调度器 - 限制进程内同时调用Dify的数量，排队的调用按优先级、同级按到达顺序获得名额
+    
+    超过截止时间或客户端已断开的调用在出队时直接丢弃，不再占用上游；
+    跨worker的总并发由 AdmissionController 限制，这里决定同一进程内排队请求的先后。
+    """
+    
+    PRIORITY_PROBE = 0  # 健康探测
+    PRIORITY_CONTINUING = 1  # 继续已有对话
+    PRIORITY_NEW = 2  # 新对话
+    PRIORITY_NAMES = {PRIORITY_PROBE: 'probe', PRIORITY_CONTINUING: 'continuing', PRIORITY_NEW: 'new'}
+    WAIT_SAMPLES = 1000  # 排队时间分位数按最近N次计算
+    
+    def __init__(self, max_concurrent, poll_interval=1.0):
+        self.max_concurrent = max_concurrent
+        self.poll_interval = poll_interval
+        self.reset()
+    
+    def reset(self):
+        """fork后在子进程内调用：父进程的锁、排队和计数在子进程中均不可用"""
+        self._lock = threading.Lock()
+        self._heap = []
+        self._sequence = itertools.count()
+        self._running = 0
+        self._queued = {priority: 0 for priority in self.PRIORITY_NAMES}
+        self._granted = {priority: 0 for priority in self.PRIORITY_NAMES}
+        self._dropped = {'deadline': 0, 'disconnected': 0}
+        self._waits = deque(maxlen=self.WAIT_SAMPLES)
+        self._max_wait = 0.0
+    
+    def enqueue(self, priority, deadline=None, cancelled=None):
+        """申请名额；有空闲名额且无人排队时立即获得，否则进入队列"""
+        ticket = UpstreamTicket(priority, deadline, cancelled)
+        with self._lock:
+            if self._running < self.max_concurrent and not any(self._queued.values()):
+                self._grant(ticket)
+            else:
+                self._queued[priority] += 1
+                heapq.heappush(self._heap, (priority, next(self._sequence), ticket))
+        return ticket
+    
+    def wait(self, ticket, timeout=None):
+        """等待名额，最长timeout秒；获得名额返回True，仍在排队返回False，被丢弃时抛出UpstreamDropped"""
+        if not ticket.granted and not ticket.abandoned:
+            remaining = None if ticket.deadline is None else ticket.deadline - time.monotonic()
+            if timeout is not None and (remaining is None or timeout < remaining):
+                ticket.event.wait(timeout)
+            elif remaining is None or remaining > 0:
+                ticket.event.wait(remaining)
+        
+        with self._lock:
+            if ticket.granted:
+                return True
+            if ticket.abandoned:
+                reason = ticket.drop_reason
+            elif ticket.expired():
+                reason = self._abandon(ticket, 'deadline')
+            elif ticket.cancelled is not None and ticket.cancelled():
+                reason = self._abandon(ticket, 'disconnected')
+            else:
+                return False
+        raise UpstreamDropped(reason)
+    
+    def acquire(self, priority, deadline=None, cancelled=None):
+        """阻塞直到获得名额，每 poll_interval 秒检查一次客户端是否断开"""
+        ticket = self.enqueue(priority, deadline, cancelled)
+        while not self.wait(ticket, self.poll_interval):
+            pass
+        return ticket
+    
+    def release(self, ticket):
+        """归还名额或放弃排队；获得名额前的调用方退出（如流式响应被客户端关闭）也应调用"""
+        with self._lock:
+            if ticket.granted:
+                ticket.granted = False
+                self._running -= 1
+                self._grant_next()
+            elif not ticket.abandoned:
+                self._abandon(ticket, 'disconnected')
+    
+    def _grant(self, ticket):
+        waited = time.monotonic() - ticket.enqueued_at
+        self._waits.append(waited)
+        self._max_wait = max(self._max_wait, waited)
+        self._granted[ticket.priority] += 1
+        self._running += 1
+        ticket.granted = True
+        ticket.event.set()
+    
+    def _grant_next(self):
+        now = time.monotonic()
+        while self._heap and self._running < self.max_concurrent:
+            _, _, ticket = heapq.heappop(self._heap)
+            if ticket.abandoned:
+                continue
+            self._queued[ticket.priority] -= 1
+            if ticket.expired(now):
+                self._drop(ticket, 'deadline')
+            elif ticket.cancelled is not None and ticket.cancelled():
+                self._drop(ticket, 'disconnected')
+            else:
+                self._grant(ticket)
+    
+    def _abandon(self, ticket, reason):
+        # 还在堆中的凭据只做标记，出队时跳过
+        self._queued[ticket.priority] -= 1
+        self._drop(ticket, reason)
+        return reason
+    
+    def _drop(self, ticket, reason):
+        ticket.abandoned = True
+        ticket.drop_reason = reason
+        ticket.event.set()
+        self._dropped[reason] += 1
+    
+    def metrics(self):
+        """当前进程的排队深度、各优先级获得名额和丢弃的次数、排队时间分布"""
+        with self._lock:
+            waits = sorted(self._waits)
+            
+            def percentile(p):
+                return round(waits[min(len(waits) - 1, int(len(waits) * p))], 4) if waits else 0.0
+            
+            return {
+                'max_concurrent': self.max_concurrent,
+                'running': self._running,
+                'queue_depth': sum(self._queued.values()),
+                'queued': {self.PRIORITY_NAMES[p]: count for p, count in self._queued.items()},
+                'granted': {self.PRIORITY_NAMES[p]: count for p, count in self._granted.items()},
+                'dropped': dict(self._dropped),
+                'wait_seconds': {
+                    'samples': len(waits),
+                    'p50': percentile(0.5),
+                    'p95': percentile(0.95),
+                    'p99': percentile(0.99),
+                    'max': round(self._max_wait, 4)
+                }
+            }
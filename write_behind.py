@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+AI旅行助手 - 消息写后持久化模块
+对话轮次先追加到恢复日志，由后台线程按批次提交到数据库
+"""
+
+import atexit
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import update
+
+from config import app_config
+from conversation_events import event_broker
+from models import Attraction, Conversation, Message, db
+from sharding import shard_for, use_shard
+from text_cleaning import clean_ai_text
+
+logger = logging.getLogger(f'app.{__name__}')
+
+class WriteBehindQueue:
+    """消息写后队列 - 对话轮次先追加到恢复日志，再由后台线程按批次合并为一个事务提交
+    
+    每个进程写自己的日志段并持有其文件锁；提交成功后删除对应日志段。
+    启动时重放无人持有锁的日志段（所属进程已退出），按turn_id去重。
+    """
+    
+    FSYNC_POLICIES = ('always', 'interval', 'off')
+    
+    def __init__(self, journal_dir, batch_size, flush_interval, fsync_policy, read_timeout, enabled=True):
+        if fsync_policy not in self.FSYNC_POLICIES:
+            raise ValueError(f'不支持的fsync策略: {fsync_policy}')
+        self.journal_dir = journal_dir
+        self.marker_dir = os.path.join(journal_dir, 'pending')
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.fsync_policy = fsync_policy
+        self.read_timeout = read_timeout
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._flushed = threading.Condition(self._lock)
+        self._queue = []
+        self._pending = {}  # conversation_id -> 未提交的轮次数
+        self._segment = None
+        self._retired_segments = []  # 已轮换、等待提交成功后删除的日志段
+        self._dirty = False
+        self._flush_requested = False
+        self._generation = 0
+        self._thread = None
+        self._pid = None
+        self._stopping = False
+        self._app = None  # 后台线程提交时使用的应用
+    
+    # 生命周期
+    def start(self, flask_app=None):
+        """恢复遗留日志并启动后台提交线程（gunicorn下在每个worker进程内启动）"""
+        self._app = flask_app or current_app._get_current_object()
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            # fork继承的状态属于父进程，子进程重新开始
+            self._queue, self._pending, self._retired_segments = [], {}, []
+            self._stopping = False
+            
+            os.makedirs(self.marker_dir, exist_ok=True)
+            self.recover()
+            self._segment = self._open_segment()
+            self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+        atexit.register(self.stop)
+        logger.info(f'📝 消息写后队列已启动: 批次 {self.batch_size}, 间隔 {self.flush_interval}s, fsync {self.fsync_policy}')
+    
+    def stop(self, timeout=5):
+        """提交剩余写入并停止后台线程"""
+        if self._thread is None or self._pid != os.getpid():
+            return
+        with self._lock:
+            self._stopping = True
+            self._wakeup.notify_all()
+        self._thread.join(timeout)
+        self._thread = None
+        self._pid = None
+    
+    def _open_segment(self):
+        path = os.path.join(self.journal_dir, f'journal-{os.getpid()}-{time.time_ns()}.log')
+        journal = open(path, 'ab')
+        fcntl.flock(journal, fcntl.LOCK_EX)
+        return journal
+    
+    def _marker_path(self, conversation_id, pid=None):
+        return os.path.join(self.marker_dir, f'{conversation_id}.{pid or os.getpid()}')
+    
+    # 写入
+    def build_turn(self, conversation_id, messages, dify_conversation_id=None, turn_id=None):
+        """构造一轮对话的写入记录，messages为(sender_type, content, attractions_status, extracted)列表"""
+        now = datetime.utcnow()
+        return {
+            'turn_id': turn_id or uuid.uuid4().hex,
+            'conversation_id': conversation_id,
+            'dify_conversation_id': dify_conversation_id,
+            'updated_at': now.isoformat(),
+            'messages': [{
+                'sender_type': sender_type,
+                'content': content,
+                'display_content': clean_ai_text(content) if sender_type == 'ai' else None,
+                'attractions_status': attractions_status,
+                'created_at': now.isoformat(),
+                'attractions': [
+                    {**row, 'created_at': row['created_at'].isoformat()}
+                    for row in Attraction.build_rows(None, extracted or [])
+                ]
+            } for sender_type, content, attractions_status, extracted in messages]
+        }
+    
+    def enqueue(self, turn):
+        """追加恢复日志后入队，返回时该轮对话已按fsync策略持久化到日志"""
+        self.start()
+        line = json.dumps(turn, ensure_ascii=False).encode('utf-8') + b'\n'
+        conversation_id = turn['conversation_id']
+        with self._lock:
+            self._segment.write(line)
+            self._segment.flush()
+            if self.fsync_policy == 'always':
+                os.fsync(self._segment.fileno())
+            else:
+                self._dirty = True
+            
+            self._queue.append(turn)
+            if not self._pending.get(conversation_id):
+                # 标记文件供其他worker进程判断该对话是否有未提交写入
+                open(self._marker_path(conversation_id), 'w').close()
+            self._pending[conversation_id] = self._pending.get(conversation_id, 0) + 1
+            if len(self._queue) >= self.batch_size:
+                self._wakeup.notify()
+    
+    def _run(self):
+        while True:
+            with self._lock:
+                self._wakeup.wait_for(
+                    lambda: len(self._queue) >= self.batch_size or self._flush_requested or self._stopping,
+                    timeout=self.flush_interval
+                )
+                if self._dirty and self.fsync_policy == 'interval':
+                    # 每个提交周期合并一次fsync
+                    os.fsync(self._segment.fileno())
+                self._dirty = False
+                self._flush_requested = False
+                stopping = self._stopping
+                turns, self._queue = self._queue, []
+                if turns:
+                    # 轮换日志段：旧段恰好包含本批次及之前失败批次的全部记录
+                    self._retired_segments.append(self._segment)
+                    self._segment = self._open_segment()
+            
+            if turns:
+                try:
+                    self._write_turns(turns)
+                except Exception as e:
+                    logger.error(f'💥 写后队列提交失败，稍后重试: {str(e)}')
+                    with self._lock:
+                        self._queue[:0] = turns
+                    if stopping:
+                        return
+                    time.sleep(self.flush_interval)
+                    continue
+                self._committed(turns)
+            
+            if stopping:
+                with self._lock:
+                    if not self._queue:
+                        return
+    
+    def _write_turns(self, turns, skip_existing=False):
+        """写入多轮对话，每个分片一个事务；分片模式下可能只有部分分片提交成功，
+        因此跨分片的批次总是按turn_id去重，整批重试时不会重复写入已提交的轮次"""
+        committed = 0
+        with (self._app or current_app._get_current_object()).app_context():
+            groups = {}
+            for turn in turns:
+                groups.setdefault(shard_for(turn['conversation_id']), []).append(turn)
+            for shard, shard_turns in groups.items():
+                use_shard(shard)
+                committed += self._write_shard_turns(shard_turns, skip_existing or len(groups) > 1)
+        return committed
+    
+    def _write_shard_turns(self, turns, skip_existing):
+        """在一个事务中写入同一分片的多轮对话"""
+        try:
+            if skip_existing:
+                turn_ids = [turn['turn_id'] for turn in turns]
+                written = {turn_id for (turn_id,) in
+                           db.session.query(Message.turn_id).filter(Message.turn_id.in_(turn_ids)).distinct()}
+                turns = [turn for turn in turns if turn['turn_id'] not in written]
+            
+            latest = {}
+            written_messages = []
+            for turn in turns:
+                for record in turn['messages']:
+                    message = Message(
+                        conversation_id=turn['conversation_id'],
+                        content=record['content'],
+                        display_content=record.get('display_content'),
+                        sender_type=record['sender_type'],
+                        attractions_status=record['attractions_status'],
+                        turn_id=turn['turn_id'],
+                        created_at=datetime.fromisoformat(record['created_at'])
+                    )
+                    message.attractions = [
+                        Attraction(**{**row, 'created_at': datetime.fromisoformat(row['created_at'])})
+                        for row in record['attractions']
+                    ]
+                    db.session.add(message)
+                    written_messages.append(message)
+                latest[turn['conversation_id']] = turn
+            
+            if written_messages and event_broker.enabled:
+                db.session.flush()
+                event_broker.record([(message.conversation_id, 'message', message.id) for message in written_messages])
+            for conversation_id, turn in latest.items():
+                db.session.execute(update(Conversation)
+                                   .where(Conversation.id == conversation_id)
+                                   .values(updated_at=datetime.fromisoformat(turn['updated_at'])))
+            for turn in turns:
+                if turn.get('dify_conversation_id'):
+                    db.session.execute(update(Conversation)
+                                       .where(Conversation.id == turn['conversation_id'],
+                                              Conversation.dify_conversation_id.is_(None))
+                                       .values(dify_conversation_id=turn['dify_conversation_id']))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        finally:
+            db.session.remove()
+        return len(turns)
+    
+    def _committed(self, turns):
+        with self._lock:
+            segments, self._retired_segments = self._retired_segments, []
+            # 先删除已提交的日志段，再通知等待提交的读取方
+            for segment in segments:
+                os.remove(segment.name)
+                segment.close()
+            for turn in turns:
+                conversation_id = turn['conversation_id']
+                self._pending[conversation_id] -= 1
+                if not self._pending[conversation_id]:
+                    del self._pending[conversation_id]
+                    try:
+                        os.remove(self._marker_path(conversation_id))
+                    except FileNotFoundError:
+                        pass
+            self._generation += 1
+            self._flushed.notify_all()
+    
+    # 读取一致性
+    def flush(self, timeout=None):
+        """立即提交当前进程内所有排队的写入"""
+        if self._thread is None or self._pid != os.getpid():
+            return True
+        with self._lock:
+            if not self._queue and not self._retired_segments:
+                return True
+            target = self._generation + 1
+            self._flush_requested = True
+            self._wakeup.notify_all()
+            return self._flushed.wait_for(
+                lambda: self._generation >= target and not self._queue and not self._retired_segments,
+                timeout=timeout
+            )
+    
+    def ensure_visible(self, conversation_id):
+        """读取对话前确保之前的写入已提交（读己之写），包括其他worker进程排队中的写入"""
+        if not self.enabled:
+            return True
+        if self._pid == os.getpid() and self._pending.get(conversation_id):
+            self.flush(self.read_timeout)
+        
+        # 其他进程的写入由其后台线程按周期提交，轮询标记文件直到消失
+        deadline = time.monotonic() + self.read_timeout
+        prefix = f'{conversation_id}.'
+        while True:
+            try:
+                others = [name for name in os.listdir(self.marker_dir)
+                          if name.startswith(prefix) and name != f'{prefix}{os.getpid()}']
+            except FileNotFoundError:
+                return True
+            others = [name for name in others if self._pid_alive(int(name[len(prefix):]))]
+            if not others:
+                return True
+            if time.monotonic() >= deadline:
+                logger.warning(f'⚠️ 等待对话 {conversation_id} 的未提交写入超时')
+                return False
+            time.sleep(min(self.flush_interval, 0.05))
+    
+    @staticmethod
+    def _pid_alive(pid):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+    
+    # 崩溃恢复
+    def recover(self):
+        """重放已退出进程遗留的日志段，返回恢复的轮次数"""
+        recovered = 0
+        for name in sorted(os.listdir(self.journal_dir)):
+            if not (name.startswith('journal-') and name.endswith('.log')):
+                continue
+            path = os.path.join(self.journal_dir, name)
+            with open(path, 'rb') as journal:
+                try:
+                    fcntl.flock(journal, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue  # 所属进程仍在运行
+                turns = []
+                for line in journal:
+                    try:
+                        turns.append(json.loads(line))
+                    except ValueError:
+                        break  # 崩溃时写了一半的最后一行
+                if turns:
+                    recovered += self._write_turns(turns, skip_existing=True)
+                os.remove(path)
+        
+        # 清理已退出进程遗留的标记文件
+        for name in os.listdir(self.marker_dir):
+            pid = name.rsplit('.', 1)[-1]
+            if pid.isdigit() and not self._pid_alive(int(pid)):
+                try:
+                    os.remove(os.path.join(self.marker_dir, name))
+                except FileNotFoundError:
+                    pass
+        
+        if recovered:
+            logger.info(f'📝 从恢复日志重放 {recovered} 轮对话')
+        return recovered
+
+write_behind = WriteBehindQueue(
+    app_config.WRITE_BEHIND_JOURNAL_DIRECTORY,
+    app_config.WRITE_BEHIND_BATCH_SIZE,
+    app_config.WRITE_BEHIND_FLUSH_INTERVAL,
+    app_config.WRITE_BEHIND_FSYNC,
+    app_config.WRITE_BEHIND_READ_TIMEOUT,
+    enabled=app_config.WRITE_BEHIND_ENABLED
+)